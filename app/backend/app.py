@@ -1,21 +1,61 @@
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User, StepLog, Journey, Boss, UserLevel, BossAttack, BossManager, Friendship
-from config import load_config, BADGE_MILESTONES, PRESET_JOURNEYS
-from datetime import datetime, date, timedelta
+from models import db, User, Journey, Boss, UserLevel, BossManager, Friendship
+from config import load_config
+from auth_pool import password_hasher, AuthPoolBusy
+import engine_profile
+import fast_json
+import read_models
+import payload
+import server_timing
+import dashboard
+from delta_sync import changes_since, next_cursor, InvalidCursor
+from payload import requested_fields, wants, PROFILE_FIELDS, LEADERBOARD_FIELDS, FRIEND_FIELDS
+from replica import use_replica
+import replica
+from sharding import shard_router
+from coalesce import micro_cache
+from invalidation import invalidation_bus
+from jobs import job_queue
+import step_ledger
+from metrics import metrics
+from slow_queries import slow_query_log
+from profiling import request_profiler
+from step_series import step_series, default_range
+from datetime import datetime, date
 from functools import wraps
 import jwt
-import os
 
 from dotenv import load_dotenv
 load_dotenv()
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+fast_json.init_app(app)
+payload.init_app(app)
+server_timing.init_app(app)
 
 load_config(app)
 db.init_app(app)
+replica.init_app(app)
+engine_profile.init_app(app, db)
+shard_router.init_app(app)
+password_hasher.init_app(app)
+micro_cache.init_app(app)
+invalidation_bus.init_app(app)
+for topic in ('leaderboard', 'bosses'):
+    invalidation_bus.subscribe(topic, micro_cache.invalidate)
+metrics.init_app(app)
+metrics.add_source('stepup_microcache_events_total', 'Micro-cache lookups by outcome', 'event',
+                   lambda: micro_cache.stats)
+metrics.add_source('stepup_invalidation_messages_total', 'Cache invalidation bus activity', 'event',
+                   lambda: invalidation_bus.stats)
+job_queue.init_app(app)
+metrics.add_source('stepup_jobs_total', 'Background jobs finished by outcome', 'outcome', lambda: job_queue.stats)
+metrics.add_gauge('stepup_job_queue_depth', 'Background jobs by status', 'status', job_queue.depth)
+metrics.add_gauge('stepup_job_queue_lag_seconds', 'How long the oldest due pending job has waited, by kind', 'kind',
+                  job_queue.lag)
+slow_query_log.init_app(app)
+request_profiler.init_app(app)
 
 def generate_token(user_id):
     return jwt.encode({"user_id": user_id}, app.config['SECRET_KEY'], algorithm="HS256")
@@ -30,16 +70,24 @@ def decode_token(token):
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if token and token.startswith("Bearer "):
-            token = token[7:]
-        user_id = decode_token(token)
+        with server_timing.phase('auth'):
+            token = request.headers.get('Authorization')
+            if token and token.startswith("Bearer "):
+                token = token[7:]
+            user_id = decode_token(token)
+            if user_id:
+                g.user_id = user_id
+                current_user = User.query.get(user_id)
         if not user_id:
             return jsonify({'message': 'Invalid or missing token'}), 401
-        current_user = User.query.get(user_id)
         return f(current_user, *args, **kwargs)
     return decorated
 
+def auth_busy_response():
+    response = jsonify({"message": "Server busy, please try again"})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @app.route("/api/register", methods=["POST"])
 def register():
     data = request.json
@@ -49,7 +97,10 @@ def register():
     if User.query.filter_by(username=username).first():
         return jsonify({"message": "User already exists"}), 400
 
-    hashed_pw = generate_password_hash(password)
+    try:
+        hashed_pw = password_hasher.hash(password)
+    except AuthPoolBusy:
+        return auth_busy_response()
     user = User(username=username, password_hash=hashed_pw)
     db.session.add(user)
     db.session.commit()
@@ -63,7 +114,14 @@ def login():
     password = data.get("password")
 
     user = User.query.filter_by(username=username).first()
-    if not user or not check_password_hash(user.password_hash, password):
+    try:
+        if user:
+            valid = password_hasher.verify(user.password_hash, password)
+        else:
+            valid = password_hasher.verify_missing(password)
+    except AuthPoolBusy:
+        return auth_busy_response()
+    if not valid:
         return jsonify({"message": "Invalid credentials"}), 401
 
     token = generate_token(user.id)
@@ -71,48 +129,29 @@ def login():
 
 
 @app.route("/api/user/profile", methods=["GET"])
+@use_replica
 @token_required
 def profile(current_user):
     try:
-        user_level = UserLevel.query.filter_by(user_id=current_user.id).first()
-        if not user_level:
-            user_level = UserLevel(user_id=current_user.id)
-            db.session.add(user_level)
-            db.session.commit()
-
-        badges = []
-        for milestone, badge_info in BADGE_MILESTONES.items():
-            if current_user.total_steps_life >= milestone:
-                badges.append(badge_info)
-
-        today_steps = current_user.get_today_steps()
-        streak = current_user.get_streak()
-        journey_info = None
-        if current_user.current_journey_id:
-            journey = current_user.current_journey
-            journey_info = {
-                'id': journey.id,
-                'start_city': journey.start_city,
-                'end_city': journey.end_city,
-                'total_distance_miles': journey.total_distance_miles,
-                'personal_progress_miles': journey.personal_progress_miles,
-                'progress_percentage': round((journey.personal_progress_miles / journey.total_distance_miles) * 100, 2),
-                'is_complete': journey.finished_at is not None
-            }
-
-        return jsonify({
-            "username": current_user.username,
-            "display_name": current_user.display_name or current_user.username,
-            "total_steps_life": current_user.total_steps_life,
-            "today_steps": today_steps,
-            "streak": streak,
-            "total_miles": round(current_user.total_steps_life / 2000, 2),
-            "level": user_level.current_level,
-            "current_exp": user_level.current_exp,
-            "exp_to_next_level": user_level.exp_to_next_level(),
-            "badges": badges,
-            "current_journey": journey_info
-        })
+        try:
+            fields = requested_fields(PROFILE_FIELDS)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+
+        user_level = None
+        if wants(fields, 'level', 'current_exp', 'exp_to_next_level'):
+            user_level = dashboard.get_or_create_level(current_user.id)
+
+        lifetime_steps, today_steps = current_user.total_steps_life, None
+        if wants(fields, 'total_steps_life', 'total_miles', 'badges', 'today_steps', 'streak'):
+            # Snapshot plus tail, so a refresh right after a sync shows its steps before they are folded
+            lifetime_steps, today_steps = step_ledger.current_steps(current_user, date.today())
+        streak = current_user.get_streak(today_active=today_steps > 0) if wants(fields, 'streak') else None
+        if not wants(fields, 'today_steps'):
+            today_steps = None
+        return jsonify(dashboard.profile_payload(
+            current_user, lifetime_steps, user_level, today_steps, streak, fields
+        ))
     except Exception as e:
         return jsonify({'message': 'Failed to get profile'}), 500
 
@@ -129,152 +168,128 @@ def sync_steps(current_user):
             return jsonify({'message': 'Invalid steps_count'}), 400
 
         today = date.today()
-        user_level = UserLevel.query.filter_by(user_id=current_user.id).first()
-        if not user_level:
-            user_level = UserLevel(user_id=current_user.id)
-            db.session.add(user_level)
-
-        existing_log = StepLog.query.filter_by(
-            user_id=current_user.id,
-            date=today
-        ).first()
-
+        user_level = dashboard.get_or_create_level(current_user.id)
+        # Steps are appended to the ledger; the steps.project job applies them to step_logs (step_ledger.py)
+        lifetime_steps, steps_today = step_ledger.current_steps(current_user, today)
         if mode == 'add':
             # Add steps to existing count
-            if existing_log:
-                steps_difference = steps_count
-                existing_log.steps_count += steps_count
-                existing_log.distance_miles = existing_log.steps_count / 2000
-                existing_log.timestamp = datetime.utcnow()
-            else:
-                steps_difference = steps_count
-                new_log = StepLog(
-                    user_id=current_user.id,
-                    steps_count=steps_count,
-                    date=today,
-                    source=data.get('source', 'manual')
-                )
-                db.session.add(new_log)
+            steps_difference = steps_count
         else:
             # Set total steps for the day (original behavior)
-            if existing_log:
-                steps_difference = steps_count - existing_log.steps_count
-                existing_log.steps_count = steps_count
-                existing_log.distance_miles = steps_count / 2000
-                existing_log.timestamp = datetime.utcnow()
-            else:
-                steps_difference = steps_count
-                new_log = StepLog(
-                    user_id=current_user.id,
-                    steps_count=steps_count,
-                    date=today,
-                    source=data.get('source', 'healthkit')
-                )
-                db.session.add(new_log)
+            steps_difference = steps_count - steps_today
+        if steps_difference:
+            step_ledger.record(
+                db.session, current_user.id, today, 'sync' if mode == 'add' else 'set', steps_difference,
+                lifetime_delta=max(steps_difference, 0),
+                source=data.get('source', 'manual' if mode == 'add' else 'healthkit')
+            )
 
-        level_ups = 0
+        # EXP, journey progress and the completion bonus are applied by a background job (jobs.py)
+        progress_job_id = None
         if steps_difference > 0:
-            current_user.total_steps_life += steps_difference
-            exp_gained = steps_difference // 100
-            level_ups = user_level.add_exp(exp_gained)
-
-            if current_user.current_journey_id:
-                personal_journey = current_user.current_journey
-                if personal_journey and personal_journey.is_active:
-                    distance_miles = steps_difference / 2000
-                    personal_journey.personal_progress_miles += distance_miles
-
-                    if (personal_journey.personal_progress_miles >= personal_journey.total_distance_miles and not personal_journey.finished_at):
-                        personal_journey.finished_at = datetime.utcnow()
-                        personal_journey.is_active = False
-                        current_user.current_journey_id = None
-                        completion_exp = 500
-                        level_ups += user_level.add_exp(completion_exp)
+            progress_job_id = job_queue.enqueue(db.session, 'steps.progress', {
+                'user_id': current_user.id, 'steps': steps_difference, 'journey_id': current_user.current_journey_id
+            })
         current_user.last_active = datetime.utcnow()
+        # Level and journey as they were before the job applies this sync
+        response = dashboard.sync_payload(steps_difference, steps_today, lifetime_steps, user_level,
+                                          current_user.current_journey, progress_job_id)
         db.session.commit()
-
-        # Get the final step count for today
-        final_log = StepLog.query.filter_by(
-            user_id=current_user.id,
-            date=today
-        ).first()
-        
-        current_steps_today = final_log.steps_count if final_log else 0
-
-        response_data = {
-            'message': 'Steps synced successfully',
-            'steps_added': steps_difference,
-            'total_steps_today': current_steps_today,
-            'total_steps_life': current_user.total_steps_life,
-            'level': user_level.current_level,
-            'current_exp': user_level.current_exp,
-            'exp_to_next_level': user_level.exp_to_next_level(),
-            'level_ups': level_ups
-        }
-        if current_user.current_journey_id:
-            journey = current_user.current_journey
-            response_data['journey_progress'] = {
-                'journey_name': f'{journey.start_city} to {journey.end_city}',
-                'progress_miles': round(journey.personal_progress_miles, 2),
-                'total_miles': journey.total_distance_miles,
-                'progress_percentage': round((journey.personal_progress_miles / journey.total_distance_miles) * 100, 2),
-                'miles_added': round(steps_difference/2000, 2),
-                'is_completed': journey.finished_at is not None
-            }
-            if journey.finished_at and journey.finished_at > (datetime.utcnow() - timedelta(minutes=1)):
-                response_data['completion_message'] = f'Congratulations! You completed your journey from {journey.start_city} to {journey.end_city}!'
-        return jsonify(response_data)
+        if steps_difference:
+            job_queue.notify()
+        return jsonify(response)
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': 'Failed to sync steps'}), 500
 
+@job_queue.handler('steps.progress')
+def apply_step_progress(session, job):
+    """EXP and journey progress for the steps a sync added"""
+    user = session.get(User, job['user_id'])
+    if not user:
+        return
+    user_level = session.query(UserLevel).filter_by(user_id=user.id).first()
+    if not user_level:
+        user_level = UserLevel(user_id=user.id, current_level=1, current_exp=0, total_exp=0)
+        session.add(user_level)
+    user_level.add_exp(job['steps'] // 100)
+
+    # Only the journey the steps were walked on, if the user hasn't left it since
+    journey_id = job.get('journey_id')
+    if journey_id and user.current_journey_id == journey_id:
+        journey = session.get(Journey, journey_id)
+        if journey and journey.is_active:
+            journey.personal_progress_miles += job['steps'] / 2000
+            if journey.personal_progress_miles >= journey.total_distance_miles and not journey.finished_at:
+                journey.finished_at = datetime.utcnow()
+                journey.is_active = False
+                user.current_journey_id = None
+                job_queue.enqueue(session, 'journey.completed', {'user_id': user.id, 'journey_id': journey.id},
+                                  idempotency_key=f'journey.completed:{journey.id}')
+
+@job_queue.handler('journey.completed')
+def reward_journey_completion(session, job):
+    user_level = session.query(UserLevel).filter_by(user_id=job['user_id']).first()
+    if user_level:
+        user_level.add_exp(500)
+
 @app.route('/api/steps/history', methods=['GET'])
+@use_replica
 @token_required
 def get_step_history(current_user):
     try:
         days = request.args.get('days', 30, type=int)
         days = min(days, 365)
-        step_logs = StepLog.query.filter_by(user_id=current_user.id).order_by(StepLog.date.desc()).limit(days).all()
+        try:
+            since = changes_since(request.args.get('since'))
+        except InvalidCursor as e:
+            return jsonify({'message': str(e)}), 400
+        cursor = next_cursor()
+        step_history = read_models.step_history(current_user.id, days, since)
         return jsonify({
-            'step_history': [log.to_dict() for log in step_logs],
-            'total_days': len(step_logs)
+            'step_history': step_history,
+            'total_days': len(step_history),
+            'full': since is None,
+            'next_cursor': cursor
         })
     except Exception as e:
         return jsonify({'message': 'Failed to get step history'}), 500
 
 @app.route('/api/user/weekly-steps', methods=['GET'])
+@use_replica
 @token_required
 def get_weekly_steps(current_user):
     try:
-        # Get the last 7 days including today
         today = date.today()
-        start_date = today - timedelta(days=6)
-        
-        # Get step logs for the past 7 days
-        step_logs = StepLog.query.filter(
-            StepLog.user_id == current_user.id,
-            StepLog.date >= start_date,
-            StepLog.date <= today
-        ).order_by(StepLog.date.asc()).all()
-        
-        # Create a dictionary for quick lookup
-        step_dict = {log.date: log.steps_count for log in step_logs}
-        
-        # Create the weekly data with all 7 days (fill missing days with 0)
-        weekly_data = []
-        for i in range(7):
-            current_date = start_date + timedelta(days=i)
-            weekly_data.append({
-                'date': current_date.isoformat(),
-                'steps': step_dict.get(current_date, 0)
-            })
-        
-        return jsonify(weekly_data)
+        recent = dashboard.recent_steps(current_user.id, today)
+        _, recent[today] = step_ledger.current_steps(current_user, today)  # today may not be folded yet
+        return jsonify(dashboard.weekly_payload(recent, today))
     except Exception as e:
         print(f"Error fetching weekly steps: {e}")
         return jsonify({'message': 'Failed to get weekly steps'}), 500
 
+@app.route('/api/steps/series', methods=['GET'])
+@use_replica
+@token_required
+def get_step_series(current_user):
+    try:
+        resolution = request.args.get('resolution', 'day')
+        if resolution not in ('day', 'week', 'month'):
+            return jsonify({'message': 'resolution must be day, week or month'}), 400
+        default_from, default_to = default_range(resolution)
+        try:
+            start = date.fromisoformat(request.args['from']) if request.args.get('from') else default_from
+            end = date.fromisoformat(request.args['to']) if request.args.get('to') else default_to
+            series = step_series(current_user.id, start, end, resolution)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+        return jsonify(series)
+    except Exception:
+        app.logger.exception('Error fetching step series')
+        return jsonify({'message': 'Failed to get step series'}), 500
+
 @app.route('/api/user/level', methods=['GET'])
+@use_replica
 @token_required
 def get_user_level(current_user):
     try:
@@ -294,10 +309,10 @@ def get_user_level(current_user):
         return jsonify({'message': 'Failed to get user level'}), 500
 
 @app.route("/api/journeys", methods=["GET"])
+@use_replica
 def journeys():
     try:
-        journey_templates = Journey.query.filter_by(is_template=True, is_active=True).all()
-        return jsonify({'journeys': [j.to_dict() for j in journey_templates]})
+        return jsonify({'journeys': read_models.journey_templates()})
     except Exception as e:
         return jsonify({'message': 'Failed to get journeys'}), 500
 
@@ -351,123 +366,90 @@ def end_journey(current_user):
         return jsonify({'message': 'Failed to end journey'}), 500
 
 @app.route("/api/leaderboard", methods=["GET"])
+@use_replica
 @token_required
 def leaderboard(current_user):
     try:
         timeframe = request.args.get('timeframe', 'all')
         limit = min(request.args.get('limit', 10, type=int), 50)
         friends_only = request.args.get('friends_only', 'false').lower() == 'true'
+        try:
+            fields = requested_fields(LEADERBOARD_FIELDS)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
         
-        # Get friend user IDs if friends_only is requested
-        friend_user_ids = set()
-        if friends_only:
-            friendships = db.session.query(Friendship).filter(
-                db.or_(
-                    db.and_(Friendship.sender_id == current_user.id, Friendship.status == 'accepted'),
-                    db.and_(Friendship.receiver_id == current_user.id, Friendship.status == 'accepted')
-                )
-            ).all()
-            
-            for friendship in friendships:
-                friend_id = friendship.receiver_id if friendship.sender_id == current_user.id else friendship.sender_id
-                friend_user_ids.add(friend_id)
-            
-            # Always include current user in friends leaderboard
-            friend_user_ids.add(current_user.id)
-        
-        if timeframe == 'day':
-            today = date.today()
-            step_logs_query = db.session.query(
-                StepLog.user_id,
-                db.func.sum(StepLog.steps_count).label('total_steps')
-            ).filter(StepLog.date == today)
-            
-            if friends_only and friend_user_ids:
-                step_logs_query = step_logs_query.filter(StepLog.user_id.in_(friend_user_ids))
-            
-            step_logs = step_logs_query.group_by(StepLog.user_id).all()
-            
-        elif timeframe == 'week':
-            week_ago = date.today() - timedelta(days=7)
-            step_logs_query = db.session.query(
-                StepLog.user_id,
-                db.func.sum(StepLog.steps_count).label('total_steps')
-            ).filter(StepLog.date >= week_ago)
-            
-            if friends_only and friend_user_ids:
-                step_logs_query = step_logs_query.filter(StepLog.user_id.in_(friend_user_ids))
-                
-            step_logs = step_logs_query.group_by(StepLog.user_id).all()
-            
-        elif timeframe == 'month':
-            current_month = date.today().replace(day=1)
-            step_logs_query = db.session.query(
-                StepLog.user_id,
-                db.func.sum(StepLog.steps_count).label('total_steps')
-            ).filter(StepLog.date >= current_month)
-            
-            if friends_only and friend_user_ids:
-                step_logs_query = step_logs_query.filter(StepLog.user_id.in_(friend_user_ids))
-                
-            step_logs = step_logs_query.group_by(StepLog.user_id).all()
-        else:
-            # All time leaderboard
-            if friends_only and friend_user_ids:
-                users = User.query.filter(
-                    User.total_steps_life > 0,
-                    User.id.in_(friend_user_ids)
-                ).all()
-            else:
-                users = User.query.filter(User.total_steps_life > 0).all()
-            step_logs = [(user.id, user.total_steps_life) for user in users]
-
-        leaderboard_data = []
-        for user_id, total_steps in step_logs:
-            user = User.query.get(user_id)
-            if user and total_steps > 0:
-                user_level = UserLevel.query.filter_by(user_id=user.id).first()
-                
-                # Check if this user is the current user or a friend
-                is_current_user = user.id == current_user.id
-                is_friend = user.id in friend_user_ids if friends_only else False
-                
-                leaderboard_data.append({
-                    'rank': 0,
-                    'user_id': user.id,
-                    'username': user.username,
-                    'display_name': user.display_name or user.username,
-                    'avatar_url': user.avatar_url,
-                    'steps': total_steps,
-                    'miles': round(total_steps/2000, 2),
-                    'level': user_level.current_level if user_level else 1,
-                    'is_current_user': is_current_user,
-                    'is_friend': is_friend
-                })
-
-        leaderboard_data.sort(key=lambda x: x['steps'], reverse=True)
-        for i, entry in enumerate(leaderboard_data[:limit]):
-            entry['rank'] = i + 1
-
-        return jsonify({
-            'timeframe': timeframe,
-            'friends_only': friends_only,
-            'total_entries': len(leaderboard_data),
-            'leaderboard': leaderboard_data[:limit]
-        })
+        return jsonify(dashboard.leaderboard_for(current_user.id, timeframe, limit, friends_only, fields))
     except Exception as e:
         return jsonify({'message': 'Failed to get leaderboard', 'error': str(e)}), 500
 
+@app.route('/api/dashboard', methods=['GET'])
+@use_replica
+@token_required
+def get_dashboard(current_user):
+    """Profile, weekly steps, bosses and leaderboard in one round trip"""
+    try:
+        include = request.args.get('include')
+        parts = [part.strip() for part in include.split(',')] if include else list(dashboard.DASHBOARD_PARTS)
+        unknown = [part for part in parts if part not in dashboard.DASHBOARD_PARTS]
+        if unknown:
+            return jsonify({'message': f"Unknown dashboard part '{unknown[0]}'"}), 400
+
+        # Parts that only read shared tables run on the pool while the per-user parts load here
+        user_id, journey_id = current_user.id, current_user.current_journey_id
+        timeframe = request.args.get('timeframe', 'all')
+        limit = min(request.args.get('limit', 10, type=int), 50)
+        pooled = {}
+        if 'bosses' in parts:
+            pooled['bosses'] = lambda: dashboard.shared_bosses(journey_id)[0]
+        if 'leaderboard' in parts:
+            pooled['leaderboard'] = lambda: dashboard.leaderboard_for(user_id, timeframe, limit)
+        futures = dashboard.submit_parts(pooled)
+
+        # One StepLog read feeds today_steps, the streak and the weekly chart
+        result = {}
+        today = date.today()
+        if 'profile' in parts or 'weekly_steps' in parts:
+            recent = dashboard.recent_steps(user_id, today)
+            lifetime_steps, recent[today] = step_ledger.current_steps(current_user, today)  # includes unfolded steps
+            if 'profile' in parts:
+                user_level = dashboard.get_or_create_level(user_id)
+                streak = dashboard.streak_from_recent(current_user, recent, today)
+                result['profile'] = dashboard.profile_payload(
+                    current_user, lifetime_steps, user_level, recent[today], streak
+                )
+            if 'weekly_steps' in parts:
+                result['weekly_steps'] = dashboard.weekly_payload(recent, today)
+
+        result.update(dashboard.collect_parts(pooled, futures))
+        return jsonify({part: result[part] for part in parts})
+    except Exception:
+        app.logger.exception('Error building dashboard')
+        return jsonify({'message': 'Failed to get dashboard'}), 500
+
 @app.route('/api/bosses', methods=['GET'])
+@use_replica
 @token_required
 def get_bosses(current_user):
     try:
-        journey_id = current_user.current_journey_id
-        bosses = BossManager.get_available_bosses(
-            user_id=current_user.id,
-            journey_id=journey_id
-        )
+        # The set of visible bosses depends on the journey, so cursors are only valid for the same one
+        journey_id = current_user.current_journey_id or 0
+        try:
+            since = changes_since(request.args.get('since'), journey=journey_id)
+        except InvalidCursor as e:
+            return jsonify({'error': str(e)}), 400
+        if since is None:
+            # Full lists are shared between users; the cursor starts from when the shared copy was read
+            bosses, computed_at = dashboard.shared_bosses(journey_id)
+            removed = []
+            cursor = next_cursor(computed_at, journey=journey_id)
+        else:
+            cursor = next_cursor(journey=journey_id)
+            bosses, removed = read_models.changed_bosses(journey_id, since)
         return jsonify({
-            'bosses': [boss.to_dict() for boss in bosses]
+            'bosses': bosses,
+            'removed': removed,
+            'full': since is None,
+            'next_cursor': cursor
         }), 200
 
     except Exception as e:
@@ -485,8 +467,7 @@ def attack_boss(current_user, boss_id):
             return jsonify({'error': 'steps_to_use must be a postive integer'}), 400
 
         today = date.today()
-        today_log = StepLog.query.filter_by(user_id=current_user.id, date=today).first()
-        available_steps = today_log.steps_count if today_log else 0
+        _, available_steps = step_ledger.current_steps(current_user, today)
 
         if steps_to_use > available_steps:
             return jsonify({
@@ -495,21 +476,19 @@ def attack_boss(current_user, boss_id):
                 'requested_steps': steps_to_use
             }), 400
 
-        result = BossManager.attack_boss(current_user, boss_id, steps_to_use)
+        boss = db.session.get(Boss, boss_id)
+        if not BossManager.can_attack(boss):
+            return jsonify({'error': 'Boss not available for attack'}), 400
 
-        # Subtract the steps used from today's step count
-        if 'error' not in result:
-            # Refresh the step log to avoid any stale data issues
-            db.session.refresh(today_log)
-            today_log.steps_count -= steps_to_use
-            if today_log.steps_count < 0:
-                today_log.steps_count = 0
-            db.session.commit()
-            print(f"DEBUG: Subtracted {steps_to_use} steps from user {current_user.id}. New count: {today_log.steps_count}")
-
-        if 'error' in result:
-            return jsonify(result), 400
-        return jsonify(result), 200
+        user_level = dashboard.get_or_create_level(current_user.id)
+        attack, outcome = BossManager.strike(current_user, boss, user_level, steps_to_use)
+        # Spend the steps used from today's step count, committed with the damage (see step_ledger.py)
+        attack_job_id = step_ledger.spend_on_attack(db.session, attack, today)
+        db.session.commit()
+        if attack_job_id:
+            job_queue.run_now(attack_job_id)
+        job_queue.notify()
+        return jsonify(BossManager.attack_result(outcome, boss, current_user, user_level)), 200
 
     except Exception as e:
         db.session.rollback()
@@ -517,55 +496,36 @@ def attack_boss(current_user, boss_id):
 
 # Friendship endpoints
 @app.route('/api/friends', methods=['GET'])
+@use_replica
 @token_required
 def get_friends(current_user):
     """Get user's friends and friend requests"""
     try:
-        # Get accepted friendships
-        friends_query = db.session.query(Friendship).filter(
-            db.or_(
-                db.and_(Friendship.sender_id == current_user.id, Friendship.status == 'accepted'),
-                db.and_(Friendship.receiver_id == current_user.id, Friendship.status == 'accepted')
-            )
-        )
-        
-        friends = []
-        for friendship in friends_query:
-            friend_user = friendship.receiver if friendship.sender_id == current_user.id else friendship.sender
-            friends.append({
-                'id': friend_user.id,
-                'username': friend_user.username,
-                'display_name': friend_user.display_name or friend_user.username,
-                'avatar_url': friend_user.avatar_url,
-                'total_steps': friend_user.total_steps_life,
-                'last_active': friend_user.last_active.isoformat() if friend_user.last_active else None,
-                'friendship_date': friendship.accepted_at.isoformat() if friendship.accepted_at else None
-            })
-        
-        # Get pending requests received
-        pending_requests = db.session.query(Friendship).filter(
-            Friendship.receiver_id == current_user.id,
-            Friendship.status == 'pending'
-        )
-        
-        requests = []
-        for request in pending_requests:
-            requests.append({
-                'id': request.id,
-                'sender': {
-                    'id': request.sender.id,
-                    'username': request.sender.username,
-                    'display_name': request.sender.display_name or request.sender.username,
-                    'avatar_url': request.sender.avatar_url,
-                    'total_steps': request.sender.total_steps_life
-                },
-                'sent_at': request.sent_at.isoformat()
-            })
-        
-        return jsonify({
+        try:
+            fields = requested_fields(FRIEND_FIELDS)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        try:
+            since = changes_since(request.args.get('since'))
+        except InvalidCursor as e:
+            return jsonify({'error': str(e)}), 400
+        cursor = next_cursor()
+        friends = read_models.friends(current_user.id, fields, since)
+        requests = read_models.pending_requests(current_user.id, fields, since)
+        
+        response = {
             'friends': friends,
-            'friend_requests': requests
-        })
+            'friend_requests': requests,
+            'full': since is None,
+            'next_cursor': cursor
+        }
+        if since is not None:
+            removed = read_models.tombstones(current_user.id, since)
+            response['removed_friends'] = removed.get('friend', [])
+            response['removed_requests'] = removed.get('friend_request', []) + read_models.accepted_request_ids(
+                current_user.id, since
+            )
+        return jsonify(response)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -682,6 +642,7 @@ def remove_friend(current_user):
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/users/search', methods=['GET'])
+@use_replica
 @token_required
 def search_users(current_user):
     """Search for users by username"""
@@ -695,16 +656,22 @@ def search_users(current_user):
             User.id != current_user.id
         ).limit(20).all()
         
-        results = []
-        for user in users:
-            # Check friendship status
-            friendship = Friendship.query.filter(
+        # Friendship status for all results in one query instead of one per user
+        user_ids = [user.id for user in users]
+        friendships = {}
+        if user_ids:
+            for friendship in Friendship.query.filter(
                 db.or_(
-                    db.and_(Friendship.sender_id == current_user.id, Friendship.receiver_id == user.id),
-                    db.and_(Friendship.sender_id == user.id, Friendship.receiver_id == current_user.id)
+                    db.and_(Friendship.sender_id == current_user.id, Friendship.receiver_id.in_(user_ids)),
+                    db.and_(Friendship.sender_id.in_(user_ids), Friendship.receiver_id == current_user.id)
                 )
-            ).first()
-            
+            ).order_by(Friendship.id):
+                other_id = friendship.receiver_id if friendship.sender_id == current_user.id else friendship.sender_id
+                friendships.setdefault(other_id, friendship)
+
+        results = []
+        for user in users:
+            friendship = friendships.get(user.id)
             friendship_status = 'none'
             if friendship:
                 if friendship.status == 'accepted':
@@ -746,21 +713,16 @@ def home():
     })
 
 def init_db():
-    """Initialize database and create journey templates"""
+    """Check the schema version and apply any pending migrations (or refuse to start without AUTO_MIGRATE)"""
+    from migrations import ensure_schema
     with app.app_context():
-        db.create_all()
-        if Journey.query.filter_by(is_template=True).count() == 0:
-            print('Creating journey templates...')
-            for journey_data in PRESET_JOURNEYS:
-                template = Journey(
-                    is_template=True,
-                    user_id=None,
-                    **journey_data
-                )
-                db.session.add(template)
-            db.session.commit()
-            print(f'Created {len(PRESET_JOURNEYS)} journey templates')
+        applied = ensure_schema(db.engine, auto_migrate=app.config.get('AUTO_MIGRATE', True))
+        if applied:
+            print(f'Applied migrations: {applied}')
 
-if __name__ == "__main__":
+# At import rather than under __main__, so gunicorn and uvicorn (asgi.py) workers check the schema too
+if app.config.get('SCHEMA_CHECK_ON_STARTUP', True):
     init_db()
+
+if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
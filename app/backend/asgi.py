@@ -0,0 +1,481 @@
+"""
+ASGI serving mode.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5001 --workers 4
+
+The hot routes (step sync, boss attack, profile and leaderboard) are served by
+native async handlers on an async SQLAlchemy engine with its own connection
+pool, so a slow mobile client only costs a coroutine instead of a worker
+thread. Every other route falls through to the regular Flask app through
+WsgiToAsgi, so both serving modes expose exactly the same API and the WSGI
+path (`python app.py` / gunicorn) keeps working unchanged.
+
+The handlers only load data asynchronously; responses are built by the same
+builders as the Flask views (dashboard.py, BossManager), and CORS headers come
+from the options flask_cors resolved for the app. The shared leaderboard,
+which fans out across shards and is computed once per worker, runs the Flask
+builder on a thread. With sharding, each request's session sends the sharded
+tables to the current user's shard on async engines of their own.
+
+Blocking I/O outside the async engines stays off the event loop: a background
+task polls the cache invalidation log and flushes metrics on a thread, jobs
+that run inline (run_now, eager mode) run on a thread, and invalidations an
+async session commits are published from the default executor (see
+invalidation.py).
+"""
+import asyncio
+import json
+import re
+import time
+from itertools import chain
+from urllib.parse import parse_qsl
+from datetime import datetime, date, timedelta
+
+from asgiref.wsgi import WsgiToAsgi
+from flask_cors.core import get_cors_options, get_cors_headers
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from werkzeug.datastructures import Headers
+
+from app import app as flask_app, decode_token
+from models import (
+    db, User, StepLog, StepLogMonthly, StepEvent, Boss, UserLevel, BossManager, daily_streak, monthly_streak
+)
+from engine_profile import install_sqlite_pragmas
+from sharding import shard_router, SHARDED_TABLES
+from coalesce import micro_cache
+from invalidation import invalidation_bus
+from jobs import job_queue, job_insert, inserted_id
+from step_ledger import current_steps_query, steps_from_row, attack_payload
+from metrics import metrics
+from profiling import request_profiler, HEADER as PROFILE_HEADER
+from server_timing import phase, add_header as add_server_timing, REQUEST_HEADER
+from dashboard import (
+    leaderboard_payload, leaderboard_cache_key, shared_fields_for, personalize_leaderboard, profile_payload, sync_payload
+)
+from payload import parse_fields, wants, compress, choose_encoding, PROFILE_FIELDS, LEADERBOARD_FIELDS
+
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+}
+
+
+def async_url(sync_url):
+    return sync_url.set(drivername=ASYNC_DRIVERS.get(sync_url.get_backend_name(), sync_url.drivername))
+
+
+def create_engine_for(url, config):
+    engine_options = {}
+    if not str(url).startswith('sqlite'):
+        engine_options = {
+            'pool_size': config.get('ASYNC_POOL_SIZE', 20),
+            'max_overflow': config.get('ASYNC_MAX_OVERFLOW', 10),
+            'pool_pre_ping': True,
+        }
+    engine = create_async_engine(url, **engine_options)
+    install_sqlite_pragmas(engine.sync_engine, config)
+    return engine
+
+
+def create_async_db(app):
+    """Build the async engine from the Flask config, reusing the resolved sync URL"""
+    url = app.config.get('ASYNC_DATABASE_URL')
+    if not url:
+        with app.app_context():
+            url = async_url(db.engine.url)
+    engine = create_engine_for(url, app.config)
+    return engine, async_sessionmaker(engine, expire_on_commit=False)
+
+
+async_engine, AsyncSession = create_async_db(flask_app)
+# One per STEP_SHARD_URLS entry, in shard_router's order
+shard_engines = [create_engine_for(async_url(engine.url), flask_app.config) for engine in shard_router.engines]
+# What CORS(app) resolved from the CORS_* config, so native routes answer like the Flask ones
+cors_options = get_cors_options(flask_app)
+
+
+def bind_user_shard(session, user_id):
+    """Send the session's statements on sharded tables to the user's shard, as RoutingSession does"""
+    engine = shard_engines[shard_router.shard_index(user_id)].sync_engine
+    for name in SHARDED_TABLES:
+        session.sync_session.bind_table(db.metadata.tables[name], engine)
+
+
+async def in_app_context(builder, *args):
+    """Run a synchronous builder shared with the Flask views on a thread, with an app context and session"""
+    def run():
+        with flask_app.app_context():
+            return builder(*args)
+    return await asyncio.to_thread(run)
+
+
+async def notify_jobs():
+    """job_queue.notify() without blocking the event loop: in eager mode it runs the jobs on the calling thread"""
+    if job_queue.eager:
+        await asyncio.to_thread(job_queue.notify)
+    else:
+        job_queue.notify()
+
+
+async def housekeeping():
+    """Poll the invalidation bus and flush metrics on a thread, instead of doing that file I/O in requests"""
+    flushed_at = time.monotonic()
+    while True:
+        await asyncio.to_thread(invalidation_bus.poll)
+        if metrics.directory and time.monotonic() - flushed_at >= metrics.flush_interval:
+            flushed_at = time.monotonic()
+            await asyncio.to_thread(metrics.flush)
+        await asyncio.sleep(invalidation_bus.poll_interval)
+
+
+class JSONResponse:
+    def __init__(self, data, status=200, headers=None):
+        with phase('serialize'):
+            self.body = json.dumps(data).encode()
+        self.status = status
+        self.headers = headers or {}
+
+    def compress(self, config, accept_encoding):
+        """Same negotiation and threshold as the Flask after_request hook (payload.py)"""
+        self.headers['Vary'] = 'Accept-Encoding'
+        if len(self.body) < config.get('COMPRESS_MIN_SIZE', 1024):
+            return
+        encoding = choose_encoding(accept_encoding)
+        if encoding:
+            self.body = compress(self.body, encoding, config)
+            self.headers['Content-Encoding'] = encoding
+
+    def add_cors(self, request, method):
+        for key, value in get_cors_headers(cors_options, request.headers, method).items(multi=True):
+            if key in self.headers:
+                value = f'{self.headers[key]}, {value}'
+            self.headers[key] = value
+
+    async def __call__(self, send):
+        headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(self.body)).encode()),
+        ]
+        headers += [(k.encode(), v.encode()) for k, v in self.headers.items()]
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+class Request:
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self._receive = receive
+        self.headers = Headers([(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope.get('headers', [])])
+        self.args = {}
+        for key, value in parse_qsl(scope.get('query_string', b'').decode()):
+            self.args.setdefault(key, value)
+
+    async def json(self):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await self._receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        try:
+            return json.loads(body) if body else None
+        except ValueError:
+            return None
+
+    def arg_int(self, name, default):
+        try:
+            return int(self.args.get(name, default))
+        except ValueError:
+            return default
+
+
+async def load_current_user(session, request):
+    token = request.headers.get('authorization')
+    if token and token.startswith('Bearer '):
+        token = token[7:]
+    user_id = decode_token(token)
+    if not user_id:
+        return None
+    return await session.get(User, user_id)
+
+
+async def get_or_create_level(session, user_id):
+    user_level = (await session.execute(
+        select(UserLevel).where(UserLevel.user_id == user_id)
+    )).scalar_one_or_none()
+    if not user_level:
+        user_level = UserLevel(user_id=user_id)
+        session.add(user_level)
+        await session.flush()
+    return user_level
+
+
+async def get_streak(session, user_id, today_active=None):
+    """Same as User.get_streak"""
+    today = date.today()
+    last_day = today if today_active is None else today - timedelta(days=1)
+    active_dates = (await session.execute(
+        select(StepLog.date)
+        .where(StepLog.user_id == user_id, StepLog.date <= last_day, StepLog.steps_count > 0)
+        .order_by(StepLog.date.desc())
+    )).scalars()
+    streak, reached_oldest = daily_streak(today, chain([today], active_dates) if today_active else active_dates)
+    if not reached_oldest:
+        return streak
+
+    # Continue through compacted months using their active run up to month end (see retention.py)
+    day = today - timedelta(days=streak)
+    months = await session.execute(
+        select(StepLogMonthly.month, StepLogMonthly.trailing_active_days)
+        .where(StepLogMonthly.user_id == user_id, StepLogMonthly.month <= day.replace(day=1))
+        .order_by(StepLogMonthly.month.desc())
+    )
+    return streak + monthly_streak(day, months)
+
+
+async def profile(session, request, current_user):
+    try:
+        try:
+            fields = parse_fields(request.args.get('fields'), PROFILE_FIELDS)
+        except ValueError as e:
+            return JSONResponse({'message': str(e)}, 400)
+
+        user_level = None
+        if wants(fields, 'level', 'current_exp', 'exp_to_next_level'):
+            user_level = await get_or_create_level(session, current_user.id)
+            await session.commit()
+
+        lifetime_steps, today_steps = current_user.total_steps_life, None
+        if wants(fields, 'total_steps_life', 'total_miles', 'badges', 'today_steps', 'streak'):
+            # Snapshot plus tail, so a refresh right after a sync shows its steps before they are folded
+            lifetime_steps, today_steps = steps_from_row(
+                (await session.execute(current_steps_query(current_user.id, date.today()))).one(),
+                current_user.total_steps_life
+            )
+        streak = await get_streak(session, current_user.id, today_steps > 0) if wants(fields, 'streak') else None
+        if not wants(fields, 'today_steps'):
+            today_steps = None
+
+        if current_user.current_journey_id and wants(fields, 'current_journey'):
+            await session.refresh(current_user, ['current_journey'])  # profile_payload can't lazy load it here
+        return JSONResponse(profile_payload(current_user, lifetime_steps, user_level, today_steps, streak, fields))
+    except Exception as e:
+        return JSONResponse({'message': 'Failed to get profile'}, 500)
+
+
+async def sync_steps(session, request, current_user):
+    try:
+        data = await request.json() or {}
+        steps_count = data.get('steps_count', 0)
+        mode = data.get('mode', 'add')
+
+        if not isinstance(steps_count, int) or steps_count < 0:
+            return JSONResponse({'message': 'Invalid steps_count'}, 400)
+
+        today = date.today()
+        user_level = await get_or_create_level(session, current_user.id)
+        # Steps are appended to the ledger; the steps.project job applies them to step_logs (step_ledger.py)
+        lifetime_steps, steps_today = steps_from_row(
+            (await session.execute(current_steps_query(current_user.id, today))).one(), current_user.total_steps_life
+        )
+        steps_difference = steps_count if mode == 'add' else steps_count - steps_today
+        if steps_difference:
+            session.add(StepEvent(
+                user_id=current_user.id, date=today, kind='sync' if mode == 'add' else 'set',
+                steps_delta=steps_difference, lifetime_delta=max(steps_difference, 0),
+                source=data.get('source', 'manual' if mode == 'add' else 'healthkit')
+            ))
+            await session.execute(job_insert(
+                session.bind.dialect, 'steps.project', {'user_id': current_user.id}, max_attempts=job_queue.max_attempts
+            ))
+
+        # EXP, journey progress and the completion bonus are applied by a background job (jobs.py)
+        progress_job_id = None
+        if steps_difference > 0:
+            progress_job_id = inserted_id(await session.execute(job_insert(
+                session.bind.dialect, 'steps.progress',
+                {'user_id': current_user.id, 'steps': steps_difference, 'journey_id': current_user.current_journey_id},
+                max_attempts=job_queue.max_attempts
+            )))
+        current_user.last_active = datetime.utcnow()
+        if current_user.current_journey_id:
+            await session.refresh(current_user, ['current_journey'])  # sync_payload can't lazy load it here
+        # Level and journey as they were before the job applies this sync
+        response = sync_payload(steps_difference, steps_today, lifetime_steps, user_level,
+                                current_user.current_journey if current_user.current_journey_id else None,
+                                progress_job_id)
+        await session.commit()
+        if steps_difference:
+            await notify_jobs()
+        return JSONResponse(response)
+    except Exception as e:
+        await session.rollback()
+        return JSONResponse({'message': 'Failed to sync steps'}, 500)
+
+
+async def leaderboard(session, request, current_user):
+    try:
+        timeframe = request.args.get('timeframe', 'all')
+        limit = min(request.arg_int('limit', 10), 50)
+        friends_only = request.args.get('friends_only', 'false').lower() == 'true'
+        try:
+            fields = parse_fields(request.args.get('fields'), LEADERBOARD_FIELDS)
+        except ValueError as e:
+            return JSONResponse({'message': str(e)}, 400)
+
+        if friends_only:
+            return JSONResponse(
+                await in_app_context(leaderboard_payload, current_user.id, timeframe, limit, True, fields)
+            )
+
+        shared_fields = shared_fields_for(fields)
+
+        async def compute():
+            return await in_app_context(leaderboard_payload, None, timeframe, limit, False, shared_fields)
+
+        shared, _ = await micro_cache.get_async(leaderboard_cache_key(timeframe, limit, shared_fields), compute)
+        return JSONResponse(personalize_leaderboard(shared, current_user.id, fields))
+    except Exception as e:
+        return JSONResponse({'message': 'Failed to get leaderboard', 'error': str(e)}, 500)
+
+
+async def attack_boss(session, request, current_user, boss_id):
+    try:
+        data = await request.json()
+        if not data or 'steps_to_use' not in data:
+            return JSONResponse({'error': 'steps_to_use required'}, 400)
+        steps_to_use = data['steps_to_use']
+        if not isinstance(steps_to_use, int) or steps_to_use <= 0:
+            return JSONResponse({'error': 'steps_to_use must be a postive integer'}, 400)
+
+        today = date.today()
+        _, available_steps = steps_from_row(
+            (await session.execute(current_steps_query(current_user.id, today))).one(), current_user.total_steps_life
+        )
+        if steps_to_use > available_steps:
+            return JSONResponse({
+                'error': 'Insufficient steps',
+                'available_steps': available_steps,
+                'requested_steps': steps_to_use
+            }, 400)
+
+        boss = await session.get(Boss, boss_id)
+        if not BossManager.can_attack(boss):
+            return JSONResponse({'error': 'Boss not available for attack'}, 400)
+
+        user_level = await get_or_create_level(session, current_user.id)
+        attack, outcome = BossManager.strike(current_user, boss, user_level, steps_to_use)
+        # Spend the steps used from today's step count, committed with the damage (step_ledger.spend_on_attack)
+        attack_job_id = None
+        if shard_engines:
+            attack_job_id = inserted_id(await session.execute(job_insert(
+                session.bind.dialect, 'attack.record', attack_payload(attack, today),
+                max_attempts=job_queue.max_attempts
+            )))
+        else:
+            session.add(attack)
+            session.add(StepEvent(user_id=current_user.id, date=today, kind='attack', steps_delta=-steps_to_use))
+            await session.execute(job_insert(
+                session.bind.dialect, 'steps.project', {'user_id': current_user.id},
+                max_attempts=job_queue.max_attempts
+            ))
+        await session.commit()
+        if attack_job_id:
+            await asyncio.to_thread(job_queue.run_now, attack_job_id)
+        await notify_jobs()
+        return JSONResponse(BossManager.attack_result(outcome, boss, current_user, user_level))
+    except Exception as e:
+        await session.rollback()
+        return JSONResponse({'error': 'Failed to attack boss'}, 500)
+
+
+ASYNC_ROUTES = [
+    ('GET', re.compile(r'^/api/user/profile$'), profile),
+    ('POST', re.compile(r'^/api/steps/sync$'), sync_steps),
+    ('GET', re.compile(r'^/api/leaderboard$'), leaderboard),
+    ('POST', re.compile(r'^/api/bosses/(?P<boss_id>\d+)/attack$'), attack_boss),
+]
+
+
+class StepUpASGI:
+    """Dispatches hot routes to async handlers and everything else to Flask"""
+
+    def __init__(self, wsgi_app, routes):
+        self.wsgi = WsgiToAsgi(wsgi_app)
+        self.routes = routes
+        self._rules = {}
+        self._housekeeping = None
+
+    def rule_for(self, handler, scope):
+        """The Flask route rule a native handler stands in for, so metrics use the same labels"""
+        if handler not in self._rules:
+            rule, _ = flask_app.url_map.bind('localhost').match(scope['path'], scope['method'], return_rule=True)
+            self._rules[handler] = rule.rule
+        return self._rules[handler]
+
+    def match(self, scope):
+        for method, pattern, handler in self.routes:
+            if scope['method'] == method:
+                match = pattern.match(scope['path'])
+                if match:
+                    return handler, {k: int(v) for k, v in match.groupdict().items()}
+        return None, None
+
+    def start_housekeeping(self):
+        """Once per event loop; from the first request too, for servers that don't send lifespan events"""
+        if self._housekeeping is None or self._housekeeping.done():
+            self._housekeeping = asyncio.get_running_loop().create_task(housekeeping())
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        self.start_housekeeping()
+
+        handler, params = (None, None)
+        if scope['type'] == 'http':
+            handler, params = self.match(scope)
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+
+        request = Request(scope, receive)
+        if request_profiler.signed(request.headers.get(PROFILE_HEADER)):
+            # Profile on a Flask thread, where other requests' coroutines don't show up in the stats
+            return await self.wsgi(scope, receive, send)
+        with metrics.track() as stats:
+            async with AsyncSession() as session:
+                with phase('auth'):
+                    current_user = await load_current_user(session, request)
+                if not current_user:
+                    response = JSONResponse({'message': 'Invalid or missing token'}, 401)
+                else:
+                    if shard_engines:
+                        bind_user_shard(session, current_user.id)
+                    response = await handler(session, request, current_user, **params)
+            add_server_timing(response.headers, flask_app.config, request.headers.get(REQUEST_HEADER))
+            response.compress(flask_app.config, request.headers.get('accept-encoding'))
+            response.add_cors(request, scope['method'])
+        metrics.record(scope['method'], self.rule_for(handler, scope), response.status,
+                       time.perf_counter() - stats.started, len(response.body), stats, flush=False)
+        await response(send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                job_queue.ensure_started()  # native routes don't pass through Flask's before_request
+                self.start_housekeeping()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._housekeeping is not None:
+                    self._housekeeping.cancel()
+                await asyncio.to_thread(job_queue.stop, 5)
+                for engine in [async_engine] + shard_engines:
+                    await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = StepUpASGI(flask_app, ASYNC_ROUTES)
@@ -0,0 +1,103 @@
+import os
+import threading
+from concurrent.futures import TimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class AuthPoolBusy(Exception):
+    """Raised when the hashing pool is full or a hash takes too long"""
+    pass
+
+
+class PasswordHasher:
+    """Runs password hashing and verification in a bounded process pool.
+
+    Request threads only wait on the result, so a burst of logins can't
+    starve other endpoints of CPU on the same worker. When more than
+    AUTH_POOL_MAX_PENDING jobs are queued we reject straight away instead
+    of letting the backlog grow. AUTH_POOL_WORKERS = 0 hashes inline.
+
+    A job holds its slot until it finishes: a timed out job that already
+    started keeps running in its process, so it still counts as pending.
+    """
+
+    def __init__(self, app=None):
+        self.workers = 0
+        self.max_pending = 0
+        self.timeout = None
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._dummy_hash = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.workers = app.config.get('AUTH_POOL_WORKERS', 0)
+        self.max_pending = app.config.get('AUTH_POOL_MAX_PENDING', 32)
+        self.timeout = app.config.get('AUTH_POOL_TIMEOUT', 5)
+        self._pending = 0
+        app.extensions['password_hasher'] = self
+
+    def _get_executor(self):
+        # Created lazily so each forked gunicorn worker gets its own pool
+        from concurrent.futures import ProcessPoolExecutor
+
+        pid = os.getpid()
+        if self._executor is None or self._pid != pid:
+            with self._lock:
+                if self._executor is None or self._pid != pid:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    self._pid = pid
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        with self._lock:
+            if self._pending >= self.workers + self.max_pending:
+                raise AuthPoolBusy('Password hashing queue is full')
+            self._pending += 1
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._release()
+            raise
+        # Called once the job finished, or right away if cancel() below took it off the queue
+        future.add_done_callback(lambda _: self._release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()  # only stops jobs that haven't started; running ones keep their slot until done
+            raise AuthPoolBusy('Password hashing timed out')
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def verify_missing(self, password):
+        """Same work as verify() for a username that doesn't exist, so response times don't reveal which do"""
+        if self._dummy_hash is None:
+            self._dummy_hash = generate_password_hash('stepup-no-such-user')
+        self._run(check_password_hash, self._dummy_hash, password)
+        return False
+
+    def pending(self):
+        return self._pending
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Mixed login + step sync benchmark.
+
+Runs a burst of login threads alongside step sync threads, first with password
+hashing inline on the request thread and then through the auth process pool,
+and prints the sync latency and login outcome for each mode.
+
+    python benchmarks/bench_auth_pool.py --duration 10 --login-threads 16
+"""
+import argparse
+import threading
+import time
+
+from harness import load_app, register_and_login, auth_header, summarize
+
+
+def run_mode(app_module, workers, args, sync_token):
+    app = app_module.app
+    hasher = app_module.password_hasher
+    hasher.shutdown()
+    app.config['AUTH_POOL_WORKERS'] = workers
+    app.config['AUTH_POOL_MAX_PENDING'] = args.max_pending
+    hasher.init_app(app)
+
+    stop = threading.Event()
+    sync_latencies = []
+    login_counts = {'ok': 0, 'busy': 0, 'other': 0}
+    lock = threading.Lock()
+
+    def login_loop():
+        client = app.test_client()
+        while not stop.is_set():
+            response = client.post('/api/login', json={'username': 'bench_login', 'password': 'password123'})
+            key = 'ok' if response.status_code == 200 else 'busy' if response.status_code == 503 else 'other'
+            with lock:
+                login_counts[key] += 1
+
+    def sync_loop():
+        client = app.test_client()
+        while not stop.is_set():
+            start = time.perf_counter()
+            client.post('/api/steps/sync', json={'steps_count': 10}, headers=auth_header(sync_token))
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                sync_latencies.append(elapsed)
+            time.sleep(args.sync_interval)
+
+    threads = [threading.Thread(target=login_loop) for _ in range(args.login_threads)]
+    threads += [threading.Thread(target=sync_loop) for _ in range(args.sync_threads)]
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    label = 'inline hashing' if not workers else f'process pool ({workers} workers)'
+    print(f'\n== {label} ==')
+    summarize('sync latency', sync_latencies)
+    print(f'logins: {login_counts["ok"]} ok, {login_counts["busy"]} rejected busy, '
+          f'{login_counts["other"]} other ({login_counts["ok"] / args.duration:.1f}/s)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--login-threads', type=int, default=8)
+    parser.add_argument('--sync-threads', type=int, default=2)
+    parser.add_argument('--sync-interval', type=float, default=0.01)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--max-pending', type=int, default=4)
+    args = parser.parse_args()
+
+    app_module, db_path = load_app()
+    client = app_module.app.test_client()
+    register_and_login(client, 'bench_login')
+    sync_token = register_and_login(client, 'bench_sync')
+    print(f'Database: {db_path}')
+
+    run_mode(app_module, 0, args, sync_token)
+    run_mode(app_module, args.workers, args, sync_token)
+    app_module.password_hasher.shutdown()
+
+
+if __name__ == '__main__':
+    main()
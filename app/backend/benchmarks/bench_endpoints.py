@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Endpoint and model micro-benchmarks with saved baselines.
+
+`run` generates a synthetic population (synthetic_data.py) for each --sizes
+entry, in a fresh process per size. It then times every route in app.py
+through the Flask test client as the population's best-connected user, and
+the model hot spots directly: User.get_streak, UserLevel.add_exp,
+BossManager.attack_boss and Journey.to_dict. Each case gets warmup calls and
+then --rounds timed calls. The min/median/mean/p95/stddev go to a JSON file,
+which serves as the baseline for later runs.
+
+`compare` matches two result files by case and size. Cases whose median got
+slower by more than --threshold are flagged, and the command exits 1 if any
+were, so a change is measured against the baseline rather than guessed.
+
+    python benchmarks/bench_endpoints.py run --sizes 1000,10000 --output before.json
+    python benchmarks/bench_endpoints.py run --sizes 1000,10000 --output after.json
+    python benchmarks/bench_endpoints.py compare before.json after.json --threshold 0.15
+
+Caches are off (MICROCACHE_TTL_SECONDS=0) so repeated calls measure the
+handler rather than a cache hit. Compare results from the same machine only.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+BENCH_ENV = {
+    'AUTH_POOL_WORKERS': '0',
+    'MICROCACHE_TTL_SECONDS': '0',
+    'SLOW_QUERY_LOG': '',
+    'INVALIDATION_LOG': '',
+    'JOBS_WORKERS': '0',
+}
+
+
+def stats(samples):
+    ordered = sorted(samples)
+    return {
+        'rounds': len(ordered),
+        'min_ms': ordered[0],
+        'median_ms': statistics.median(ordered),
+        'mean_ms': statistics.fmean(ordered),
+        'p95_ms': ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        'stddev_ms': statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+    }
+
+
+def timed(call, rounds, warmup, setup=None, min_round_seconds=0.001):
+    """Milliseconds per call.
+
+    setup() runs untimed before each call and its result is passed in. Calls
+    without setup are repeated within a round until it lasts min_round_seconds,
+    so sub-microsecond timer noise doesn't swamp fast cases.
+    """
+    iterations = 1
+    if setup is None:
+        started = time.perf_counter()
+        call()
+        iterations = max(1, int(min_round_seconds / max(time.perf_counter() - started, 1e-9)))
+
+    samples = []
+    for i in range(warmup + rounds):
+        if setup is None:
+            started = time.perf_counter()
+            for _ in range(iterations):
+                call()
+        else:
+            argument = setup()
+            started = time.perf_counter()
+            call(argument)
+        elapsed = (time.perf_counter() - started) * 1000 / iterations
+        if i >= warmup:
+            samples.append(elapsed)
+    return samples
+
+
+def request_cases(client, user, peer, boss_id, auth_header):
+    """(name, call, setup) per route; writes are arranged so every round starts from the same state"""
+    from harness import register_and_login
+
+    headers = auth_header(user['token'])
+    peer_headers = auth_header(peer['token'])
+    counter = iter(range(10 ** 9))
+
+    def get(path, request_headers=headers):
+        return lambda: client.get(path, headers=request_headers)
+
+    def expect(response, status=200):
+        assert response.status_code == status, (response.status_code, response.get_data(as_text=True)[:200])
+        return response
+
+    def no_journey():
+        client.post('/api/journeys/end', headers=headers)
+
+    def on_journey():
+        no_journey()
+        expect(client.post('/api/journeys/1/start', headers=headers))
+
+    def not_friends():
+        client.delete('/api/friends/remove', json={'user_id': peer['id']}, headers=headers)
+        for friend_request in client.get('/api/friends', headers=headers).get_json()['friend_requests']:
+            if friend_request['sender']['id'] == peer['id']:
+                expect(client.post('/api/friends/respond', json={
+                    'request_id': friend_request['id'], 'action': 'decline'}, headers=headers))
+
+    def requested():
+        not_friends()
+        expect(client.post('/api/friends/send-request', json={'username': user['username']}, headers=peer_headers),
+               201)
+        friend_requests = client.get('/api/friends', headers=headers).get_json()['friend_requests']
+        return next(r['id'] for r in friend_requests if r['sender']['id'] == peer['id'])
+
+    def friends():
+        expect(client.post('/api/friends/respond', json={'request_id': requested(), 'action': 'accept'},
+                           headers=headers))
+
+    register_and_login(client, 'benchregistered')
+    return [
+        ('GET /', get('/'), None),
+        ('POST /api/register', lambda: client.post('/api/register', json={
+            'username': f'benchuser{next(counter)}', 'password': 'password123'}), None),
+        ('POST /api/login', lambda: client.post('/api/login', json={
+            'username': 'benchregistered', 'password': 'password123'}), None),
+        ('GET /api/user/profile', get('/api/user/profile'), None),
+        ('POST /api/steps/sync', lambda: client.post('/api/steps/sync', json={'steps_count': 100}, headers=headers),
+         None),
+        ('GET /api/steps/history', get('/api/steps/history'), None),
+        ('GET /api/user/weekly-steps', get('/api/user/weekly-steps'), None),
+        ('GET /api/steps/series?resolution=week', get('/api/steps/series?resolution=week'), None),
+        ('GET /api/steps/series?resolution=month', get('/api/steps/series?resolution=month&from=2000-01-01'), None),
+        ('GET /api/user/level', get('/api/user/level'), None),
+        ('GET /api/journeys', get('/api/journeys'), None),
+        ('POST /api/journeys/<id>/start', lambda _: client.post('/api/journeys/1/start', headers=headers),
+         no_journey),
+        ('POST /api/journeys/end', lambda _: client.post('/api/journeys/end', headers=headers), on_journey),
+        ('GET /api/leaderboard', get('/api/leaderboard?timeframe=week'), None),
+        ('GET /api/leaderboard?friends_only', get('/api/leaderboard?timeframe=week&friends_only=true'), None),
+        ('GET /api/dashboard', get('/api/dashboard'), None),
+        ('GET /api/bosses', get('/api/bosses'), None),
+        ('POST /api/bosses/<id>/attack', lambda: client.post(f'/api/bosses/{boss_id}/attack',
+                                                             json={'steps_to_use': 1}, headers=headers), None),
+        ('GET /api/friends', get('/api/friends'), None),
+        ('POST /api/friends/send-request', lambda _: client.post(
+            '/api/friends/send-request', json={'username': user['username']}, headers=peer_headers), not_friends),
+        ('POST /api/friends/respond', lambda request_id: client.post(
+            '/api/friends/respond', json={'request_id': request_id, 'action': 'accept'}, headers=headers), requested),
+        ('DELETE /api/friends/remove', lambda _: client.delete(
+            '/api/friends/remove', json={'user_id': peer['id']}, headers=headers), friends),
+        ('GET /api/users/search', get('/api/users/search?q=runner12'), None),
+    ]
+
+
+def model_cases(app_module, user_id, boss_id):
+    from models import db, User, UserLevel, Journey, BossManager
+    from sharding import shard_for_user
+
+    user = db.session.get(User, user_id)
+    level = UserLevel.query.filter_by(user_id=user_id).first()
+    journey = Journey.query.filter_by(user_id=user_id).order_by(Journey.id.desc()).first() or \
+        Journey.query.filter_by(is_template=True).first()
+
+    def fresh_level():
+        return UserLevel(user_id=user_id, current_level=level.current_level, current_exp=level.current_exp,
+                         total_exp=level.total_exp, attack_power=level.attack_power)
+
+    def get_streak():
+        with shard_for_user(user_id):
+            user.get_streak()
+
+    def attack_boss():
+        with shard_for_user(user_id):
+            BossManager.attack_boss(user, boss_id, 1)
+
+    return [
+        ('User.get_streak', get_streak, None),
+        ('UserLevel.add_exp', lambda fresh: fresh.add_exp(2500), fresh_level),
+        ('BossManager.attack_boss', attack_boss, None),
+        ('Journey.to_dict', journey.to_dict, None),
+    ]
+
+
+def measure(users, years, seed, rounds, warmup):
+    """Generate a population of `users` and time every case; runs in its own process"""
+    os.environ.update(BENCH_ENV)
+    from harness import load_app, auth_header
+    from synthetic_data import Population, USERNAME, PASSWORD
+    from sharding import shard_router
+
+    app_module, db_path = load_app()
+    app = app_module.app
+    db = app_module.db
+    client = app.test_client()
+    with app.app_context():
+        Population(db, shard_router, users, int(years * 365), seed).generate(progress=lambda message: None)
+        db.session.execute(db.text('ANALYZE'))
+        # The best-connected user has the most friends, leaderboard rivals and history
+        user_id = db.session.execute(db.text(
+            'SELECT user_id FROM (SELECT sender_id AS user_id FROM friendships UNION ALL '
+            'SELECT receiver_id FROM friendships) GROUP BY user_id ORDER BY COUNT(*) DESC, user_id LIMIT 1'
+        )).scalar()
+        peer_id = db.session.execute(db.text(
+            'SELECT MIN(id) FROM users WHERE id != :user_id AND id NOT IN ('
+            'SELECT sender_id FROM friendships WHERE receiver_id = :user_id UNION '
+            'SELECT receiver_id FROM friendships WHERE sender_id = :user_id)'
+        ), {'user_id': user_id}).scalar()
+        boss_id = db.session.execute(db.text('SELECT MAX(id) FROM bosses')).scalar()
+
+    def login(user_id):
+        username = USERNAME.format(user_id)
+        token = client.post('/api/login', json={'username': username, 'password': PASSWORD}).get_json()['token']
+        return {'id': user_id, 'username': username, 'token': token}
+
+    def checked(name, call):
+        def run(*args):
+            response = call(*args)
+            assert response.status_code < 400, f'{name}: HTTP {response.status_code} {response.get_data(as_text=True)}'
+        return run
+
+    results = []
+    for name, call, setup in request_cases(client, login(user_id), login(peer_id), boss_id, auth_header):
+        results.append({'name': name, 'size': users, **stats(timed(checked(name, call), rounds, warmup, setup))})
+    with app.app_context():
+        for name, call, setup in model_cases(app_module, user_id, boss_id):
+            results.append({'name': name, 'size': users, **stats(timed(call, rounds, warmup, setup))})
+    os.remove(db_path)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    benchmarks = []
+    for size in args.sizes:
+        print(f'Seeding {size} users and timing...', flush=True)
+        child = subprocess.run([
+            sys.executable, os.path.abspath(__file__), 'measure', '--users', str(size), '--years', str(args.years),
+            '--seed', str(args.seed), '--rounds', str(args.rounds), '--warmup', str(args.warmup),
+        ], capture_output=True, text=True)
+        if child.returncode != 0:
+            sys.exit(f'Measuring {size} users failed:\n{child.stderr}')
+        benchmarks.extend(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'commit': _git_commit(),
+            'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'processor': platform.processor() or platform.machine()},
+            'options': {'years': args.years, 'seed': args.seed, 'rounds': args.rounds, 'warmup': args.warmup},
+            'benchmarks': benchmarks,
+        }, f, indent=2)
+    for result in benchmarks:
+        print(f'{result["name"]:<40} {result["size"]:>7} users  median={result["median_ms"]:8.3f}ms  '
+              f'p95={result["p95_ms"]:8.3f}ms')
+    print(f'Saved {len(benchmarks)} results to {args.output}')
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    before = {(result['name'], result['size']): result for result in baseline['benchmarks']}
+
+    regressions = []
+    print(f'{"case":<40} {"size":>7} {"before ms":>10} {"after ms":>10} {"change":>8}')
+    for result in current['benchmarks']:
+        key = (result['name'], result['size'])
+        if key not in before:
+            print(f'{result["name"]:<40} {result["size"]:>7} {"-":>10} {result["median_ms"]:10.3f}      new')
+            continue
+        old, new = before[key]['median_ms'], result['median_ms']
+        change = (new - old) / old if old else 0.0
+        flag = ''
+        if change > args.threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        elif change < -args.threshold:
+            flag = '  faster'
+        print(f'{result["name"]:<40} {result["size"]:>7} {old:10.3f} {new:10.3f} {change:+8.1%}{flag}')
+
+    if regressions:
+        print(f'{len(regressions)} case(s) slower than the baseline by more than {args.threshold:.0%}')
+        sys.exit(1)
+    print(f'No regressions beyond {args.threshold:.0%}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='seed each size, time every case and save the results')
+    run_parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                            default=[1000, 10000], help='population sizes, comma separated')
+    run_parser.add_argument('--output', default='benchmark.json')
+    measure_parser = commands.add_parser('measure', help='time one size and print JSON (used by run)')
+    measure_parser.add_argument('--users', type=int, required=True)
+    for sub in (run_parser, measure_parser):
+        sub.add_argument('--years', type=float, default=1)
+        sub.add_argument('--seed', type=int, default=1)
+        sub.add_argument('--rounds', type=int, default=50)
+        sub.add_argument('--warmup', type=int, default=5)
+
+    compare_parser = commands.add_parser('compare', help='flag cases slower than a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.15,
+                                help='allowed slowdown of the median, as a fraction')
+    args = parser.parse_args()
+
+    if args.command == 'measure':
+        print(json.dumps(measure(args.users, args.years, args.seed, args.rounds, args.warmup)))
+    elif args.command == 'run':
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
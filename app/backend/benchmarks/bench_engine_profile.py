@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Mixed read/write concurrency benchmark for the database engine profile.
+
+Builds two SQLite databases with the same data: one on a plain engine
+(rollback journal, SQLAlchemy defaults) and one with the production engine
+profile (WAL, synchronous=NORMAL, mmap, busy timeout, statement cache). Reader
+threads run per-user history and leaderboard aggregates while writer threads
+sync steps, and the script prints throughput, latency and lock errors.
+
+    python benchmarks/bench_engine_profile.py --readers 8 --writers 2 --duration 5
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine, text
+
+from harness import summarize
+from config import ProductionConfig
+from engine_profile import build_engine_options, install_sqlite_pragmas
+from models import db
+
+USERS = 500
+DAYS = 90
+
+READ_QUERIES = [
+    ('SELECT date, steps_count FROM step_logs WHERE user_id = :uid ORDER BY date DESC LIMIT 30', True),
+    ('SELECT user_id, SUM(steps_count) FROM step_logs WHERE date >= :since GROUP BY user_id', False),
+]
+WRITE_QUERY = 'UPDATE step_logs SET steps_count = steps_count + 10 WHERE user_id = :uid AND date = :today'
+
+
+def seed(engine):
+    db.metadata.create_all(engine)
+    today = date.today()
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO users (id, username, password_hash, total_steps_life, created_at) "
+            "VALUES (:id, :name, 'x', 0, CURRENT_TIMESTAMP)"
+        ), [{'id': i, 'name': f'user{i}'} for i in range(1, USERS + 1)])
+        connection.execute(text(
+            "INSERT INTO step_logs (user_id, steps_count, date, timestamp) "
+            "VALUES (:uid, :steps, :day, CURRENT_TIMESTAMP)"
+        ), [
+            {'uid': uid, 'steps': random.randint(0, 15000), 'day': today - timedelta(days=d)}
+            for uid in range(1, USERS + 1) for d in range(DAYS)
+        ])
+
+
+def make_engine(profile):
+    fd, path = tempfile.mkstemp(suffix='.db', prefix='stepup-engine-')
+    os.close(fd)
+    os.remove(path)
+    uri = f'sqlite:///{path}'
+    if profile == 'tuned':
+        config = {k: getattr(ProductionConfig, k) for k in dir(ProductionConfig) if k.isupper()}
+        config['SQLALCHEMY_DATABASE_URI'] = uri
+        config.pop('SQLALCHEMY_ENGINE_OPTIONS', None)
+        engine = create_engine(uri, **build_engine_options(config))
+        install_sqlite_pragmas(engine, config)
+    else:
+        engine = create_engine(uri)
+    seed(engine)
+    return engine, path
+
+
+def run(engine, args):
+    stop = threading.Event()
+    lock = threading.Lock()
+    read_latencies, write_latencies = [], []
+    errors = {'read': 0, 'write': 0}
+    today = date.today()
+    since = today - timedelta(days=7)
+
+    def reader():
+        while not stop.is_set():
+            sql, per_user = random.choice(READ_QUERIES)
+            params = {'uid': random.randint(1, USERS)} if per_user else {'since': since}
+            start = time.perf_counter()
+            try:
+                with engine.connect() as connection:
+                    connection.execute(text(sql), params).all()
+                elapsed = (time.perf_counter() - start) * 1000
+                with lock:
+                    read_latencies.append(elapsed)
+            except Exception:
+                with lock:
+                    errors['read'] += 1
+
+    def writer():
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                with engine.begin() as connection:
+                    connection.execute(text(WRITE_QUERY), {'uid': random.randint(1, USERS), 'today': today})
+                elapsed = (time.perf_counter() - start) * 1000
+                with lock:
+                    write_latencies.append(elapsed)
+            except Exception:
+                with lock:
+                    errors['write'] += 1
+            time.sleep(args.write_interval)
+
+    threads = [threading.Thread(target=reader) for _ in range(args.readers)]
+    threads += [threading.Thread(target=writer) for _ in range(args.writers)]
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    summarize('reads', read_latencies)
+    summarize('writes', write_latencies)
+    print(f'throughput: {len(read_latencies) / args.duration:.0f} reads/s, '
+          f'{len(write_latencies) / args.duration:.0f} writes/s; '
+          f'errors: {errors["read"]} read, {errors["write"]} write')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--write-interval', type=float, default=0.0)
+    args = parser.parse_args()
+
+    for profile in ('default', 'tuned'):
+        engine, path = make_engine(profile)
+        print(f'\n== {profile} engine ==')
+        run(engine, args)
+        engine.dispose()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
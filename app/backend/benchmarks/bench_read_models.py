@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Serialization benchmark for the list endpoints.
+
+Seeds a population of users with a year of step history, friendships and
+bosses, then builds each response two ways: the ORM + to_dict() + stdlib JSON
+path the views used before, and the column-projected read models with the
+fast JSON provider. Prints per-call time and allocated bytes (tracemalloc)
+for both and the ratio.
+
+    python benchmarks/bench_read_models.py --users 2000 --repeat 20
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import text
+
+from harness import load_app
+
+import read_models
+from fast_json import FastJSONProvider
+
+
+def seed(db, users, days):
+    today = date.today()
+    now = datetime.utcnow()
+    with db.engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO users (id, username, password_hash, avatar_url, total_steps_life, created_at, last_active) "
+            "VALUES (:id, :name, 'x', '', :total, :now, :now)"
+        ), [{'id': i, 'name': f'user{i}', 'total': i * 137 % 900000 + 1, 'now': now} for i in range(1, users + 1)])
+        connection.execute(text(
+            "INSERT INTO user_levels (user_id, current_level, current_exp, total_exp, attack_power) "
+            "VALUES (:id, :level, 0, 0, 1)"
+        ), [{'id': i, 'level': i % 40 + 1} for i in range(1, users + 1, 2)])
+        connection.execute(text(
+            "INSERT INTO step_logs (user_id, steps_count, distance_miles, date, timestamp, source) "
+            "VALUES (1, :steps, :miles, :day, :now, 'healthkit')"
+        ), [{'steps': 4000 + d, 'miles': 2.0 + d / 1000, 'day': today - timedelta(days=d), 'now': now}
+            for d in range(days)])
+        connection.execute(text(
+            "INSERT INTO friendships (sender_id, receiver_id, status, sent_at, accepted_at) "
+            "VALUES (1, :other, :status, :now, :now)"
+        ), [{'other': i, 'status': 'accepted' if i % 4 else 'pending', 'now': now}
+            for i in range(2, min(users, 400) + 1)])
+        connection.execute(text(
+            "INSERT INTO friendships (sender_id, receiver_id, status, sent_at) VALUES (:other, 1, 'pending', :now)"
+        ), [{'other': i, 'now': now} for i in range(401, min(users, 500) + 1)])
+        connection.execute(text(
+            "INSERT INTO bosses (name, description, max_health, current_health, exp_reward, boss_type, "
+            "difficulty, is_active, spawned_at, respawn_hours) "
+            "VALUES (:name, 'A boss', 10000, 5000, 100, :type, 'Normal', 1, :now, 24)"
+        ), [{'name': f'Boss {i}', 'type': 'Global' if i % 2 else 'Daily', 'now': now} for i in range(50)])
+
+
+def legacy_builders(models):
+    User, StepLog, Journey, UserLevel, Friendship, BossManager = (
+        models.User, models.StepLog, models.Journey, models.UserLevel, models.Friendship, models.BossManager
+    )
+    db = models.db
+
+    def journeys():
+        return {'journeys': [j.to_dict() for j in Journey.query.filter_by(is_template=True, is_active=True).all()]}
+
+    def history():
+        logs = StepLog.query.filter_by(user_id=1).order_by(StepLog.date.desc()).limit(365).all()
+        return {'step_history': [log.to_dict() for log in logs], 'total_days': len(logs)}
+
+    def bosses():
+        return {'bosses': [boss.to_dict() for boss in BossManager.get_available_bosses(user_id=1)]}
+
+    def leaderboard():
+        data = []
+        for user in User.query.filter(User.total_steps_life > 0).all():
+            level = UserLevel.query.filter_by(user_id=user.id).first()
+            data.append({
+                'rank': 0, 'user_id': user.id, 'username': user.username,
+                'display_name': user.display_name or user.username, 'avatar_url': user.avatar_url,
+                'steps': user.total_steps_life, 'miles': round(user.total_steps_life / 2000, 2),
+                'level': level.current_level if level else 1, 'is_current_user': user.id == 1, 'is_friend': False,
+            })
+        data.sort(key=lambda x: x['steps'], reverse=True)
+        for i, entry in enumerate(data[:50]):
+            entry['rank'] = i + 1
+        return {'total_entries': len(data), 'leaderboard': data[:50]}
+
+    def friends():
+        result = []
+        for friendship in db.session.query(Friendship).filter(
+            db.or_(db.and_(Friendship.sender_id == 1, Friendship.status == 'accepted'),
+                   db.and_(Friendship.receiver_id == 1, Friendship.status == 'accepted'))
+        ):
+            other = friendship.receiver if friendship.sender_id == 1 else friendship.sender
+            result.append({
+                'id': other.id, 'username': other.username, 'display_name': other.display_name or other.username,
+                'avatar_url': other.avatar_url, 'total_steps': other.total_steps_life,
+                'last_active': other.last_active.isoformat() if other.last_active else None,
+                'friendship_date': friendship.accepted_at.isoformat() if friendship.accepted_at else None,
+            })
+        return {'friends': result}
+
+    return {'journeys': journeys, 'history': history, 'bosses': bosses,
+            'leaderboard': leaderboard, 'friends': friends}
+
+
+def lean_builders():
+    def leaderboard():
+        ranked, total = read_models.all_time_totals(limit=50)
+        entries, _ = read_models.leaderboard_entries(ranked, 1, None, 50)
+        return {'total_entries': total, 'leaderboard': entries}
+
+    return {
+        'journeys': lambda: {'journeys': read_models.journey_templates()},
+        'history': lambda: {'step_history': read_models.step_history(1, 365)},
+        'bosses': lambda: {'bosses': read_models.available_bosses()},
+        'leaderboard': leaderboard,
+        'friends': lambda: {'friends': read_models.friends(1)},
+    }
+
+
+def measure(db, build, encode, repeat):
+    db.session.remove()
+    encode(build())  # warm up
+    db.session.remove()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        encode(build())
+        db.session.remove()
+    elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+
+    tracemalloc.start()
+    encode(build())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.session.remove()
+    return elapsed_ms, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app_module, _ = load_app()
+    app = app_module.app
+    import models
+
+    with app.app_context():
+        seed(models.db, args.users, args.days)
+        fast = FastJSONProvider(app)
+        legacy = legacy_builders(models)
+        lean = lean_builders()
+        print(f'{"endpoint":<12} {"legacy ms":>10} {"lean ms":>9} {"speedup":>8} '
+              f'{"legacy KiB":>11} {"lean KiB":>9} {"alloc ratio":>12}')
+        for name in legacy:
+            with app.test_request_context():
+                old_ms, old_peak = measure(models.db, legacy[name], json.dumps, args.repeat)
+                new_ms, new_peak = measure(models.db, lean[name], fast.dumps, args.repeat)
+            print(f'{name:<12} {old_ms:10.2f} {new_ms:9.2f} {old_ms / new_ms:7.1f}x '
+                  f'{old_peak / 1024:11.0f} {new_peak / 1024:9.0f} {old_peak / max(new_peak, 1):11.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Cold start benchmark: time from process launch to the first served response.
+
+Each run starts a fresh interpreter that imports the app, runs the startup
+schema step and serves GET /api/journeys through the test client. The
+`legacy` mode runs create_all plus the template count query on every boot,
+the way init_db used to, for comparison.
+
+    python benchmarks/bench_startup.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from harness import BACKEND_DIR, load_app
+
+CHILD = r'''
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {backend!r})
+import app as app_module
+t_import = time.perf_counter()
+if {mode!r} == 'legacy':
+    from models import Journey
+    with app_module.app.app_context():
+        app_module.db.create_all()
+        Journey.query.filter_by(is_template=True).count()
+else:
+    app_module.init_db()
+t_init = time.perf_counter()
+response = app_module.app.test_client().get('/api/journeys')
+t_first = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({{'import': t_import - t0, 'init': t_init - t_import, 'first_request': t_first - t_init}}))
+'''
+
+
+def run_once(mode, env):
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD.format(backend=BACKEND_DIR, mode=mode)],
+        env=env, capture_output=True, text=True, check=True
+    ).stdout
+    total = time.perf_counter() - start
+    phases = json.loads(output.strip().splitlines()[-1])
+    phases['total'] = total
+    return phases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    _, db_path = load_app()
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{db_path}', FLASK_ENV='production')
+
+    for mode in ('legacy', 'migrations'):
+        results = [run_once(mode, env) for _ in range(args.runs)]
+        print(f'\n== {mode} ({args.runs} runs, medians) ==')
+        for phase in ('import', 'init', 'first_request', 'total'):
+            value = statistics.median(r[phase] for r in results) * 1000
+            print(f'{phase:<16} {value:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
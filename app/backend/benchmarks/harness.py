@@ -0,0 +1,54 @@
+"""
+Shared setup for the backend benchmark scripts.
+
+Run the scripts from app/backend, e.g. `python benchmarks/bench_auth_pool.py`.
+"""
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+def load_app(db_path=None, env='production'):
+    """Import the Flask app against a scratch SQLite file and migrate it"""
+    if db_path is None:
+        fd, db_path = tempfile.mkstemp(suffix='.db', prefix='stepup-bench-')
+        os.close(fd)
+        os.remove(db_path)
+    os.environ.setdefault('SECRET_KEY', 'bench-secret')
+    os.environ['FLASK_ENV'] = env
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ['SCHEMA_CHECK_ON_STARTUP'] = 'false'  # migrated below
+
+    import app as app_module
+    from migrations import upgrade
+    with app_module.app.app_context():
+        upgrade(app_module.db.engine)
+    return app_module, db_path
+
+
+def register_and_login(client, username, password='password123'):
+    client.post('/api/register', json={'username': username, 'password': password})
+    response = client.post('/api/login', json={'username': username, 'password': password})
+    return response.get_json()['token']
+
+
+def auth_header(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(label, latencies_ms):
+    print(f'{label:<28} n={len(latencies_ms):<6} '
+          f'p50={percentile(latencies_ms, 50):7.2f}ms '
+          f'p95={percentile(latencies_ms, 95):7.2f}ms '
+          f'p99={percentile(latencies_ms, 99):7.2f}ms')
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+Load and soak test against a running backend, replaying the mobile client's
+request patterns (components/ and contexts/AuthContext.tsx).
+
+Each virtual user logs in once (tokens are reused across sessions) and then
+plays sessions picked by --mix weights:
+
+- dashboard: profile and weekly chart on open, then a few step syncs, each
+  followed by a profile refresh like syncSteps does
+- bosses: boss list and profile, then a burst of attacks. Every attack is
+  followed by two profile fetches and a boss reload, as in BossBattle
+- leaderboard: the week board, then switches between timeframes and the
+  global/friends views with limit=50
+- friends: the friend list, then search-as-you-type: one request per
+  keystroke from the second character on, as Friends.handleSearch has no
+  debounce. Sometimes it sends a friend request to a result
+
+Sessions arrive as a Poisson process at --rate per second, with at most
+--concurrency in flight. Late arrivals are counted, since they mean the
+server (or this client) can't keep up. With --rate 0, --concurrency users
+loop back to back (closed model). Think times between steps are scaled by
+--think-scale; 0 gives a stress test.
+
+Every request asks for Server-Timing (SERVER_TIMING_ALLOW_REQUEST), so the
+report can split each route's latency from its time in the database. Lock
+waits (SQLite busy_timeout, row locks elsewhere) are part of that db time,
+and "database is locked" failures are counted on their own. With
+--server-pid, the workers' resident memory is sampled every report interval
+so that growth over a multi-hour soak shows up.
+
+    python benchmarks/synthetic_data.py --db /tmp/load.db --users 5000 --until 2026-01-31
+    DATABASE_URL=sqlite:////tmp/load.db gunicorn -w 4 -b 127.0.0.1:5001 app:app &
+    python benchmarks/load_test.py --url http://127.0.0.1:5001 --users 1-5000 --rate 20 --duration 600 \\
+        --server-pid $(pgrep -d, -f 'gunicorn') --output load.json
+"""
+import argparse
+import http.client
+import json
+import math
+import queue
+import random
+import threading
+import time
+from urllib.parse import urlsplit, quote
+
+DEFAULT_MIX = 'dashboard=40,bosses=20,leaderboard=20,friends=20'
+
+
+class Histogram:
+    """Log-bucketed latencies (about 2% resolution), so hours of samples take constant memory"""
+    RATIO = 1.02
+    MIN_MS = 0.1
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+
+    def add(self, ms):
+        bucket = max(0, int(math.log(max(ms, self.MIN_MS) / self.MIN_MS, self.RATIO)))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+
+    def percentile(self, pct):
+        if not self.total:
+            return 0.0
+        wanted, seen = pct / 100 * self.total, 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= wanted:
+                return self.MIN_MS * self.RATIO ** (bucket + 1)
+        return 0.0
+
+
+class RouteStats:
+    __slots__ = ('latency', 'db', 'requests', 'client_errors', 'errors', 'locked')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.db = Histogram()
+        self.requests = self.client_errors = self.errors = self.locked = 0
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = {}
+        self.window = {}
+        self.sessions = 0
+        self.late = 0
+
+    def record(self, route, ms, status, db_ms, locked):
+        with self.lock:
+            for routes in (self.total, self.window):
+                stats = routes.get(route)
+                if stats is None:
+                    stats = routes[route] = RouteStats()
+                stats.requests += 1
+                stats.latency.add(ms)
+                if db_ms is not None:
+                    stats.db.add(db_ms)
+                if status is None or status >= 500:
+                    stats.errors += 1
+                elif status >= 400:
+                    stats.client_errors += 1
+                stats.locked += locked
+
+    def take_window(self):
+        with self.lock:
+            window, self.window = self.window, {}
+        return window
+
+
+def server_timing_db(header):
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if name == 'db' and params.startswith('dur='):
+            return float(params[4:])
+    return None
+
+
+class Client:
+    """One virtual user's keep-alive connection"""
+
+    def __init__(self, url, recorder, timeout):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.recorder = recorder
+        self.timeout = timeout
+        self.connection = None
+        self.token = None
+        self.expired = False
+
+    def request(self, method, path, route=None, body=None):
+        headers = {'X-Server-Timing': '1', 'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        started = time.perf_counter()
+        status, data, db_ms = None, None, None
+        try:
+            if self.connection is None:
+                self.connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+            self.connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                                    headers=headers)
+            response = self.connection.getresponse()
+            raw = response.read()
+            status = response.status
+            db_ms = server_timing_db(response.getheader('Server-Timing'))
+            if response.getheader('Content-Type', '').startswith('application/json'):
+                data = json.loads(raw)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            raw = str(e).encode()
+            self.close()
+        ms = (time.perf_counter() - started) * 1000
+        self.expired = self.expired or (status == 401 and self.token is not None)
+        locked = status is not None and status >= 500 and b'locked' in raw
+        self.recorder.record(route or path, ms, status, db_ms, locked)
+        return status, data
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class Sessions:
+    """The client's screens; each method is one session"""
+
+    def __init__(self, args, tokens, tokens_lock):
+        self.args = args
+        self.tokens = tokens
+        self.tokens_lock = tokens_lock
+
+    def think(self, low, high):
+        if self.args.think_scale:
+            time.sleep(random.uniform(low, high) * self.args.think_scale)
+
+    def sign_in(self, client, username):
+        with self.tokens_lock:
+            client.token = self.tokens.get(username)
+        if client.token:
+            return True
+        status, data = client.request('POST', '/api/login', body={
+            'username': username, 'password': self.args.password
+        })
+        if status != 200:
+            return False
+        client.token = data['token']
+        with self.tokens_lock:
+            self.tokens[username] = client.token
+        return True
+
+    def profile(self, client):
+        status, data = client.request('GET', '/api/user/profile')
+        return data if status == 200 else {}
+
+    def dashboard(self, client):
+        self.profile(client)
+        client.request('GET', '/api/user/weekly-steps')
+        for _ in range(random.randint(1, 3)):
+            self.think(5, 30)
+            client.request('POST', '/api/steps/sync', body={
+                'steps_count': random.randint(200, 3000), 'source': 'manual'
+            })
+            self.profile(client)
+
+    def bosses(self, client):
+        status, data = client.request('GET', '/api/bosses')
+        profile = self.profile(client)
+        bosses = (data or {}).get('bosses') or []
+        if not bosses:
+            return
+        boss_id = random.choice(bosses)['id']
+        available = profile.get('today_steps') or 0
+        for _ in range(random.randint(1, 5)):
+            if available <= 0:
+                break
+            self.think(1, 3)
+            steps = min(available, random.randint(100, 2000))
+            status, _ = client.request('POST', f'/api/bosses/{boss_id}/attack', '/api/bosses/<id>/attack',
+                                       body={'steps_to_use': steps})
+            available = self.profile(client).get('today_steps') or 0
+            self.profile(client)
+            client.request('GET', '/api/bosses')
+            if status != 200:
+                break
+
+    def leaderboard(self, client):
+        timeframe, friends_only = 'week', 'false'
+        for _ in range(random.randint(1, 5)):
+            client.request('GET', f'/api/leaderboard?timeframe={timeframe}&friends_only={friends_only}&limit=50',
+                           f'/api/leaderboard?friends_only={friends_only}')
+            self.think(2, 8)
+            if random.random() < 0.5:
+                timeframe = random.choice(('day', 'week', 'month', 'all'))
+            else:
+                friends_only = 'true' if friends_only == 'false' else 'false'
+
+    def friends(self, client):
+        client.request('GET', '/api/friends')
+        self.think(2, 6)
+        target = self.args.user_prefix + str(random.randint(self.args.first_user, self.args.last_user))
+        results = []
+        for length in range(2, len(target) + 1):
+            _, data = client.request('GET', f'/api/users/search?q={quote(target[:length])}', '/api/users/search')
+            results = (data or {}).get('users') or results
+            self.think(0.1, 0.3)
+        strangers = [user for user in results if user.get('friendship_status') == 'none']
+        if strangers and random.random() < 0.2:
+            self.think(1, 3)
+            client.request('POST', '/api/friends/send-request', body={
+                'username': random.choice(strangers)['username']
+            })
+            client.request('GET', '/api/friends')
+
+    def play(self, client, scenario):
+        username = self.args.user_prefix + str(random.randint(self.args.first_user, self.args.last_user))
+        if self.sign_in(client, username):
+            getattr(self, scenario)(client)
+        if client.expired:
+            with self.tokens_lock:
+                self.tokens.pop(username, None)
+        client.token, client.expired = None, False
+
+
+def read_rss_kib(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+        except (OSError, StopIteration, ValueError):
+            pass
+    return total
+
+
+def route_table(routes, seconds):
+    lines = [f'{"route":<46} {"req":>8} {"req/s":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+             f'{"db p95":>7} {"5xx%":>6} {"4xx%":>6} {"locked":>6}']
+    for route, stats in sorted(routes.items()):
+        lines.append(
+            f'{route:<46} {stats.requests:>8} {stats.requests / seconds:7.1f} {stats.latency.percentile(50):8.1f} '
+            f'{stats.latency.percentile(95):8.1f} {stats.latency.percentile(99):8.1f} {stats.db.percentile(95):7.1f} '
+            f'{100 * stats.errors / stats.requests:6.2f} {100 * stats.client_errors / stats.requests:6.2f} '
+            f'{stats.locked:>6}'
+        )
+    return '\n'.join(lines)
+
+
+def route_summary(stats, seconds):
+    return {
+        'requests': stats.requests,
+        'throughput_rps': stats.requests / seconds,
+        'p50_ms': stats.latency.percentile(50),
+        'p95_ms': stats.latency.percentile(95),
+        'p99_ms': stats.latency.percentile(99),
+        'db_p50_ms': stats.db.percentile(50),
+        'db_p95_ms': stats.db.percentile(95),
+        'error_rate': stats.errors / stats.requests,
+        'client_error_rate': stats.client_errors / stats.requests,
+        'locked': stats.locked,
+    }
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('dashboard', 'bosses', 'leaderboard', 'friends'):
+            raise argparse.ArgumentTypeError(f'unknown scenario {name!r}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5001')
+    parser.add_argument('--users', default='1-1000', help='id range of the accounts to sign in as, e.g. 1-5000')
+    parser.add_argument('--user-prefix', default='runner', help='username = prefix + id (synthetic_data.py users)')
+    parser.add_argument('--password', default='password123')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'default {DEFAULT_MIX}')
+    parser.add_argument('--rate', type=float, default=10, help='session arrivals per second; 0 = closed loop')
+    parser.add_argument('--concurrency', type=int, default=50, help='most sessions in flight')
+    parser.add_argument('--duration', type=float, default=300, help='seconds; hours for a soak run')
+    parser.add_argument('--think-scale', type=float, default=1.0, help='multiplier for think times (0 = none)')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--report-interval', type=float, default=30)
+    parser.add_argument('--server-pid', default='', help='comma separated server PIDs to sample memory of')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output', help='write the summary as JSON here')
+    args = parser.parse_args()
+    args.first_user, _, last = args.users.partition('-')
+    args.first_user, args.last_user = int(args.first_user), int(last or args.first_user)
+    pids = [int(pid) for pid in args.server_pid.split(',') if pid]
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    recorder = Recorder()
+    sessions = Sessions(args, {}, threading.Lock())
+    scenarios, weights = list(args.mix), list(args.mix.values())
+    arrivals = queue.Queue()
+    stop = threading.Event()
+
+    def worker():
+        client = Client(args.url, recorder, args.timeout)
+        while not stop.is_set():
+            if args.rate:
+                try:
+                    arrivals.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+            sessions.play(client, random.choices(scenarios, weights)[0])
+            with recorder.lock:
+                recorder.sessions += 1
+        client.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+
+    started = time.monotonic()
+    next_arrival = next_report = started
+    window_started = started
+    rss_start = rss_max = read_rss_kib(pids)
+    timeline = []
+    while time.monotonic() - started < args.duration:
+        now = time.monotonic()
+        if args.rate and now >= next_arrival:
+            if arrivals.qsize() >= args.concurrency:
+                recorder.late += 1  # every virtual user is busy and a backlog is already waiting
+            else:
+                arrivals.put(now)
+            next_arrival += random.expovariate(args.rate)
+            continue
+        if now >= next_report + args.report_interval:
+            next_report = now
+            window, seconds = recorder.take_window(), now - window_started
+            window_started = now
+            rss = read_rss_kib(pids)
+            rss_max = max(rss_max, rss)
+            requests = sum(stats.requests for stats in window.values())
+            merged = Histogram()
+            for stats in window.values():
+                for bucket, count in stats.latency.counts.items():
+                    merged.counts[bucket] = merged.counts.get(bucket, 0) + count
+                merged.total += stats.latency.total
+            errors = sum(stats.errors for stats in window.values())
+            point = {
+                'elapsed_s': round(now - started), 'throughput_rps': requests / seconds,
+                'p95_ms': merged.percentile(95), 'errors': errors, 'late_sessions': recorder.late,
+                'rss_kib': rss or None,
+            }
+            timeline.append(point)
+            print(f'[{point["elapsed_s"]:>6}s] {point["throughput_rps"]:7.1f} req/s  p95={point["p95_ms"]:7.1f}ms  '
+                  f'5xx={errors}  late={recorder.late}' + (f'  rss={rss / 1024:.0f}MiB' if pids else ''), flush=True)
+        time.sleep(min(0.05, max(0.0, next_arrival - now)) if args.rate else 0.05)
+
+    stop.set()
+    for thread in threads:
+        thread.join(args.timeout)
+    elapsed = time.monotonic() - started
+    rss_end = read_rss_kib(pids)
+
+    print(f'\n{recorder.sessions} sessions in {elapsed:.0f}s, {recorder.late} arrivals found every user busy')
+    print(route_table(recorder.total, elapsed))
+    if pids:
+        print(f'server RSS: {rss_start / 1024:.0f} MiB at start, {rss_end / 1024:.0f} MiB at end '
+              f'(max {max(rss_max, rss_end) / 1024:.0f} MiB, {(rss_end - rss_start) / 1024:+.0f} MiB)')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'options': {key: value for key, value in vars(args).items() if key != 'password'},
+                'elapsed_s': elapsed,
+                'sessions': recorder.sessions,
+                'late_sessions': recorder.late,
+                'routes': {route: route_summary(stats, elapsed) for route, stats in recorder.total.items()},
+                'rss_kib': {'start': rss_start, 'end': rss_end, 'max': max(rss_max, rss_end)} if pids else None,
+                'timeline': timeline,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Synthetic data generator for benchmarks and load tests.
+
+Generates a population that looks like real usage rather than uniform filler,
+reproducibly from --seed:
+
+- users join over the whole window (early adopters have the longest history)
+  and a share of them stop using the app at some point
+- each user has their own activity level; daily steps vary with the weekday,
+  the season and day-to-day noise (log-normal)
+- activity follows a two-state Markov chain per user, so there are long
+  streaks, short lapses and a few users who never miss a day
+- friendships form by preferential attachment, which gives the power-law
+  degree distribution of real social graphs (a few users with hundreds of
+  friends, most with a handful), with some requests left pending
+- personal journeys are started from the templates, advanced by the steps
+  walked and finished or abandoned along the way
+- a daily boss per day in the window, with the attacks made on it
+- totals, levels and experience that match the generated history
+
+Rows are generated in plain Python from one random.Random per user and
+written with executemany in batches, on the shards when STEP_SHARD_URLS is
+set. About 50,000 users over two years give 10M step rows, in three to four
+minutes on SQLite. The window ends today unless --until pins it, which makes
+two runs with the same seed identical. Rows older than
+RETENTION_STEP_LOG_MONTHS stay daily; run retention.py afterwards to compact
+them the way production does.
+
+Every user's password is `password123`, so load tests can log in as
+runner<id>.
+
+    python benchmarks/synthetic_data.py --db /tmp/stepup-synthetic.db --users 50000 --years 2 --seed 7
+"""
+import argparse
+import math
+import os
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import bindparam, select, update
+
+from harness import load_app
+
+USERNAME = 'runner{}'
+PASSWORD = 'password123'
+BATCH_SIZE = 20000
+
+WEEKDAY_FACTORS = (1.0, 1.02, 1.0, 0.98, 0.95, 0.88, 0.8)  # Monday first
+SOURCES = (('healthkit', 0.7), ('google_fit', 0.25), ('manual', 0.05))
+# users <-> journeys reference each other, so metadata.sorted_tables can't order them
+TABLE_ORDER = ('bosses', 'users', 'user_levels', 'journeys', 'step_logs', 'boss_attacks', 'friendships')
+
+
+def _binder(table, column, dialect):
+    """Converts a Python value the way SQLAlchemy would before handing it to the driver"""
+    process = table.c[column].type.dialect_impl(dialect).bind_processor(dialect)
+    return process or (lambda value: value)
+
+
+class BulkWriter:
+    """Buffers rows per (engine, table) and writes them with executemany, parents before children"""
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.buffers = {}
+        self.counts = {}
+
+    def add(self, engine, table, columns, row):
+        self.buffers.setdefault((engine, table, columns), []).append(row)
+
+    def pending(self):
+        return sum(len(buffer) for buffer in self.buffers.values())
+
+    def flush(self):
+        ordered = sorted(self.buffers.items(), key=lambda item: TABLE_ORDER.index(item[0][1].name))
+        for (engine, table, columns), buffer in ordered:
+            for start in range(0, len(buffer), self.batch_size):
+                self._write(engine, table, columns, buffer[start:start + self.batch_size])
+        self.buffers = {}
+
+    def _write(self, engine, table, columns, rows):
+        compiled = table.insert().compile(dialect=engine.dialect, column_keys=list(columns))
+        if engine.dialect.positional:
+            order = [columns.index(name) for name in compiled.positiontup]
+            if order != list(range(len(columns))):
+                rows = [tuple(row[i] for i in order) for row in rows]
+        else:
+            rows = [dict(zip(columns, row)) for row in rows]
+        with engine.begin() as connection:
+            connection.exec_driver_sql(str(compiled), rows)
+        self.counts[table.name] = self.counts.get(table.name, 0) + len(rows)
+
+
+class Population:
+    def __init__(self, db, shard_router, users, days, seed, until=None):
+        self.db = db
+        self.shard_router = shard_router
+        self.users = users
+        self.days = days
+        self.seed = seed
+        self.until = until or date.today()
+        self.first_day = self.until - timedelta(days=days - 1)
+        self.writer = BulkWriter()
+        self.dialect = db.engine.dialect
+
+        day_dates = [self.first_day + timedelta(days=i) for i in range(days)]
+        self.day_factors = [
+            WEEKDAY_FACTORS[d.weekday()] * (1 + 0.15 * math.sin(2 * math.pi * (d.timetuple().tm_yday - 100) / 365))
+            for d in day_dates
+        ]
+        tables = db.metadata.tables
+        self.day_values = [_binder(tables['step_logs'], 'date', self.dialect)(d) for d in day_dates]
+        to_datetime = _binder(tables['step_logs'], 'timestamp', self.dialect)
+        self.day_times = [to_datetime(datetime.combine(d, datetime.min.time()) + timedelta(hours=21)) for d in day_dates]
+        self.datetime = to_datetime
+
+    def engine_for(self, user_id):
+        if self.shard_router.enabled:
+            return self.shard_router.engine_for_user(user_id)
+        return self.db.engine
+
+    def _next_id(self, table):
+        with self.db.engine.connect() as connection:
+            return (connection.exec_driver_sql(f'SELECT MAX(id) FROM {table}').scalar() or 0) + 1
+
+    def generate(self, progress=print):
+        from werkzeug.security import generate_password_hash
+
+        tables = self.db.metadata.tables
+        self.password_hash = generate_password_hash(PASSWORD)
+        self.first_user_id = self._next_id('users')
+        self.next_journey_id = self._next_id('journeys')
+        journeys = tables['journeys']
+        with self.db.engine.connect() as connection:
+            self.templates = connection.execute(select(
+                journeys.c.id, journeys.c.start_city, journeys.c.end_city, journeys.c.description,
+                journeys.c.total_distance_miles, journeys.c.difficulty
+            ).where(journeys.c.is_template.is_(True)).order_by(journeys.c.id)).all()
+        self.boss_ids, self.boss_health = self._bosses(tables['bosses'])
+        self.boss_damage = [0] * self.days
+        self.join_days = []
+        self.current_journeys = []
+
+        started = time.perf_counter()
+        for offset in range(self.users):
+            self._user(tables, self.first_user_id + offset)
+            if self.writer.pending() >= 10 * BATCH_SIZE:
+                self.writer.flush()
+            if (offset + 1) % 5000 == 0:
+                progress(f'{offset + 1} users, {self.writer.counts.get("step_logs", 0)} step rows '
+                         f'({time.perf_counter() - started:.0f}s)')
+        self.writer.flush()
+
+        self._friendships(tables['friendships'])
+        self.writer.flush()
+        self._finish(tables)
+        return self.writer.counts
+
+    def _bosses(self, table):
+        from models import DAILY_BOSS_TEMPLATES
+
+        rng = random.Random(f'{self.seed}:bosses')
+        first_id = self._next_id('bosses')
+        columns = ('id', 'name', 'description', 'max_health', 'current_health', 'exp_reward', 'coin_reward',
+                   'difficulty', 'boss_type', 'is_active', 'spawned_at', 'respawn_hours', 'updated_at')
+        # Scaled so a day's boss takes a good share of the day's attacks before it falls
+        scale = max(1, self.users // 40)
+        ids, health = [], []
+        for day in range(self.days):
+            template = rng.choice(DAILY_BOSS_TEMPLATES)
+            spawned_at = self.datetime(datetime.combine(self.first_day + timedelta(days=day), datetime.min.time()))
+            max_health = template['health'] * scale
+            self.writer.add(self.db.engine, table, columns, (
+                first_id + day, template['name'], template['description'], max_health, max_health,
+                template['exp_reward'], 0, 'Daily', 'Daily', True, spawned_at, 24, spawned_at
+            ))
+            ids.append(first_id + day)
+            health.append(max_health)
+        self.writer.flush()
+        return ids, health
+
+    def _user(self, tables, user_id):
+        rng = random.Random(f'{self.seed}:user:{user_id}')
+        engine = self.engine_for(user_id)
+
+        # Early adopters are rarer than recent signups
+        join_day = int(self.days * (1 - rng.random() ** 1.5))
+        last_day = self.days - 1
+        if rng.random() < 0.25:
+            last_day = rng.randint(join_day, last_day)  # churned
+        self.join_days.append(join_day)
+
+        base_steps = rng.lognormvariate(math.log(6500), 0.45)
+        if rng.random() < 0.03:
+            keep_going, come_back = 0.999, 0.9  # never misses a day
+        else:
+            keep_going, come_back = rng.betavariate(9, 1.2), rng.betavariate(2, 3)
+        journey_rate = 0.0 if rng.random() < 0.3 else rng.uniform(0.02, 0.2)
+        attack_rate = 0.0 if rng.random() < 0.4 else rng.uniform(0.05, 0.5)
+        source = rng.choices([name for name, _ in SOURCES], [weight for _, weight in SOURCES])[0]
+
+        step_table, attack_table, journey_table = tables['step_logs'], tables['boss_attacks'], tables['journeys']
+        step_columns = ('user_id', 'steps_count', 'distance_miles', 'date', 'timestamp', 'source')
+        attack_columns = ('user_id', 'boss_id', 'steps_used', 'damage_dealt', 'exp_gained', 'attacked_at')
+        journey_columns = ('id', 'user_id', 'template_id', 'start_city', 'end_city', 'description',
+                           'total_distance_miles', 'personal_progress_miles', 'status', 'difficulty', 'is_active',
+                           'is_template', 'started_at', 'updated_at', 'finished_at')
+
+        total_steps = total_exp = 0
+        last_active = join_day
+        journey = None  # [id, template, progress, started day]
+        active = True
+        for day in range(join_day, last_day + 1):
+            active = rng.random() < (keep_going if active else come_back)
+            if not active:
+                continue
+            steps = max(1, int(base_steps * self.day_factors[day] * rng.lognormvariate(0, 0.35)))
+            total_steps += steps
+            total_exp += steps // 100
+            last_active = day
+            self.writer.add(engine, step_table, step_columns, (
+                user_id, steps, steps / 2000, self.day_values[day], self.day_times[day], source
+            ))
+
+            if attack_rate and rng.random() < attack_rate:
+                steps_used = int(steps * rng.uniform(0.1, 0.6))
+                self.boss_damage[day] += steps_used
+                self.writer.add(engine, attack_table, attack_columns, (
+                    user_id, self.boss_ids[day], steps_used, steps_used, 0, self.day_times[day]
+                ))
+
+            if journey is None:
+                if self.templates and journey_rate and rng.random() < journey_rate:
+                    journey = [self.next_journey_id, rng.choice(self.templates), 0.0, day]
+                    self.next_journey_id += 1
+            else:
+                journey[2] += steps / 2000
+                template = journey[1]
+                finished = journey[2] >= template.total_distance_miles
+                if finished or rng.random() < 0.002:
+                    if finished:
+                        total_exp += 500
+                    self.writer.add(self.db.engine, journey_table, journey_columns, self._journey_row(
+                        user_id, journey, day, finished
+                    ))
+                    journey = None
+
+        if journey is not None:
+            self.writer.add(self.db.engine, journey_table, journey_columns, self._journey_row(
+                user_id, journey, last_active, False
+            ))
+            self.current_journeys.append((journey[0], user_id))
+
+        level = 1
+        while total_exp >= _exp_for_level(level + 1):
+            level += 1
+        joined_at = self.datetime(datetime.combine(self.first_day + timedelta(days=join_day), datetime.min.time())
+                                  + timedelta(seconds=rng.randrange(86400)))
+        self.writer.add(self.db.engine, tables['users'], (
+            'id', 'username', 'password_hash', 'avatar_url', 'display_name', 'total_steps_life',
+            'created_at', 'updated_at', 'last_active'
+        ), (
+            user_id, USERNAME.format(user_id), self.password_hash, '',
+            f'Runner {user_id}' if rng.random() < 0.6 else None, total_steps,
+            joined_at, self.day_times[last_active], self.day_times[last_active]
+        ))
+        self.writer.add(self.db.engine, tables['user_levels'], (
+            'user_id', 'current_level', 'current_exp', 'total_exp', 'attack_power', 'created_at', 'last_levelup'
+        ), (
+            user_id, level, total_exp - _exp_for_level(level), total_exp, 1, joined_at, self.day_times[last_active]
+        ))
+
+    def _journey_row(self, user_id, journey, last_day, finished):
+        # Like the app, ending a journey early leaves it active but no longer the user's current one
+        journey_id, template, progress, started_day = journey
+        return (
+            journey_id, user_id, template.id, template.start_city, template.end_city, template.description,
+            template.total_distance_miles, min(progress, template.total_distance_miles), 'In Progress',
+            template.difficulty, not finished, False, self.day_times[started_day], self.day_times[last_day],
+            self.day_times[last_day] if finished else None,
+        )
+
+    def _friendships(self, table):
+        """Preferential attachment: each user befriends 1-8 earlier users, picked in proportion to their degree"""
+        rng = random.Random(f'{self.seed}:friendships')
+        columns = ('sender_id', 'receiver_id', 'status', 'sent_at', 'accepted_at', 'updated_at')
+        endpoints = []  # each user appears once per friendship they're in
+        for offset in range(self.users):
+            user_id = self.first_user_id + offset
+            wanted = min(offset, int(rng.paretovariate(1.2)), 8)
+            friends = set()
+            while len(friends) < wanted:
+                friends.add(rng.choice(endpoints) if endpoints and rng.random() < 0.9
+                            else self.first_user_id + rng.randrange(offset))
+            for friend_id in friends:
+                day = max(self.join_days[offset], self.join_days[friend_id - self.first_user_id])
+                day = rng.randint(day, self.days - 1)
+                sent_at = self.datetime(datetime.combine(self.first_day + timedelta(days=day), datetime.min.time())
+                                        + timedelta(seconds=rng.randrange(86400)))
+                sender, receiver = (user_id, friend_id) if rng.random() < 0.5 else (friend_id, user_id)
+                accepted = rng.random() < 0.85
+                self.writer.add(self.db.engine, table, columns, (
+                    sender, receiver, 'accepted' if accepted else 'pending', sent_at, sent_at if accepted else None,
+                    sent_at
+                ))
+                endpoints.extend((user_id, friend_id))
+
+    def _finish(self, tables):
+        """Boss health from the attacks, users' current journeys and, on PostgreSQL, the id sequences"""
+        bosses, users = tables['bosses'], tables['users']
+        with self.db.engine.begin() as connection:
+            rows = []
+            for day, boss_id in enumerate(self.boss_ids):
+                health = self.boss_health[day] - self.boss_damage[day]
+                if day == self.days - 1:
+                    # Today's boss is still being fought
+                    health = max(health, self.boss_health[day] // 10)
+                defeated_at = datetime.combine(self.first_day + timedelta(days=day), datetime.min.time()) + \
+                    timedelta(hours=22) if health < 0 else None
+                rows.append({'boss_id': boss_id, 'health': health, 'active': day == self.days - 1,
+                             'defeated_at': defeated_at})
+            connection.execute(update(bosses).where(bosses.c.id == bindparam('boss_id')).values(
+                current_health=bindparam('health'), is_active=bindparam('active'),
+                defeated_at=bindparam('defeated_at')
+            ), rows)
+            if self.current_journeys:
+                connection.execute(update(users).where(users.c.id == bindparam('user_id')).values(
+                    current_journey_id=bindparam('journey_id')
+                ), [{'journey_id': journey_id, 'user_id': user_id} for journey_id, user_id in self.current_journeys])
+            if self.dialect.name == 'postgresql':
+                for name in ('users', 'journeys', 'bosses'):
+                    connection.exec_driver_sql(
+                        f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), (SELECT MAX(id) FROM {name}))"
+                    )
+
+
+def _exp_for_level(level):
+    from models import UserLevel
+    return UserLevel.calculate_exp_for_level(level)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='SQLite file to create or add to (default: a new temporary file)')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--years', type=float, default=2)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--until', type=date.fromisoformat, help='last day of history (default: today)')
+    args = parser.parse_args()
+
+    app_module, db_path = load_app(os.path.abspath(args.db) if args.db else None)
+    from sharding import shard_router
+
+    started = time.perf_counter()
+    with app_module.app.app_context():
+        if shard_router.enabled:
+            shard_router.create_all()
+        population = Population(app_module.db, shard_router, args.users, int(args.years * 365), args.seed, args.until)
+        counts = population.generate()
+        app_module.db.session.execute(app_module.db.text('ANALYZE'))
+    elapsed = time.perf_counter() - started
+    for name, count in sorted(counts.items()):
+        print(f'{name:<16} {count:>12,}')
+    print(f'{sum(counts.values()):,} rows in {elapsed:.0f}s -> {db_path}')
+
+
+if __name__ == '__main__':
+    main()
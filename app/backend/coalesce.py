@@ -0,0 +1,214 @@
+"""
+Request coalescing for expensive reads that many users share.
+
+`micro_cache.get(key, compute)` returns the cached value while it is fresh
+(MICROCACHE_TTL_SECONDS). For MICROCACHE_STALE_SECONDS after that it keeps
+serving the old value and refreshes it once in the background
+(stale-while-revalidate). On a miss, concurrent callers with the same key wait
+for a single in-flight computation and share its result (singleflight), so a
+burst of identical requests costs one round of queries per worker.
+
+Keys must only contain parameters shared between users (timeframe, journey
+id); anything user-specific is applied to a copy of the shared result. Values
+are shared between threads and must not be mutated.
+
+`get_async` is the same for the native ASGI handlers: waiters await one
+asyncio future per key, and both paths share the cached values.
+
+`invalidate(topic)` drops entries whose key starts with `topic`; the
+invalidation bus (invalidation.py) calls it when any worker commits a write
+that changes them. A computation that was already running when an
+invalidation arrived still answers its waiters but isn't cached.
+"""
+import asyncio
+import threading
+import time
+from datetime import datetime
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run at most one computation per key at a time; concurrent callers share its result"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, False
+
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.value, True
+
+    def in_flight(self, key):
+        return key in self._calls
+
+
+class MicroCache:
+    def __init__(self):
+        self.app = None
+        self.ttl = 0
+        self.stale = 0
+        self.max_entries = 1024
+        self.flight = SingleFlight()
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._async_calls = {}
+        self._generation = 0
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'coalesced': 0}
+
+    def init_app(self, app):
+        self.app = app
+        self.ttl = app.config.get('MICROCACHE_TTL_SECONDS', 30)
+        self.stale = app.config.get('MICROCACHE_STALE_SECONDS', 5)
+        self.max_entries = app.config.get('MICROCACHE_MAX_ENTRIES', 1024)
+        app.extensions['micro_cache'] = self
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _lookup(self, key):
+        """(entry, is_fresh) or (None, False) when missing or past the stale window"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, False
+        value, computed_at, fresh_until, stale_until = entry
+        now = time.monotonic()
+        if now < fresh_until:
+            return entry, True
+        if now < stale_until:
+            return entry, False
+        return None, False
+
+    def _store(self, key, value, computed_at, generation):
+        if self.ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if generation != self._generation:
+                return  # invalidated while computing
+            self._entries.pop(key, None)
+            self._entries[key] = (value, computed_at, now + self.ttl, now + self.ttl + self.stale)
+            if len(self._entries) > self.max_entries:
+                self._entries = {k: e for k, e in self._entries.items() if e[3] > now}
+                while len(self._entries) > self.max_entries:
+                    self._entries.pop(next(iter(self._entries)))
+
+    def _compute(self, key, compute):
+        generation, computed_at = self._generation, datetime.utcnow()
+        value = compute()
+        self._store(key, value, computed_at, generation)
+        return value, computed_at
+
+    def _refresh_in_background(self, key, compute):
+        if self.flight.in_flight(key):
+            return
+
+        def refresh():
+            try:
+                with self.app.app_context():
+                    self.flight.do(key, lambda: self._compute(key, compute))
+            except Exception as e:
+                self.app.logger.warning(f'Background refresh of {key!r} failed: {e}')
+
+        threading.Thread(target=refresh, daemon=True, name='microcache-refresh').start()
+
+    def get(self, key, compute):
+        """(value, computed_at) for `key`; computed_at is when the shared result was read (UTC)"""
+        entry, fresh = self._lookup(key)
+        if entry is not None:
+            if fresh:
+                self._count('hits')
+            else:
+                self._count('stale_hits')
+                self._refresh_in_background(key, compute)
+            return entry[0], entry[1]
+
+        result, leader = self.flight.do(key, lambda: self._compute(key, compute))
+        self._count('misses' if leader else 'coalesced')
+        return result
+
+    async def get_async(self, key, compute):
+        """Same as get() for coroutine functions; runs on the current event loop"""
+        entry, fresh = self._lookup(key)
+        if entry is not None:
+            if fresh:
+                self._count('hits')
+            else:
+                self._count('stale_hits')
+                if key not in self._async_calls:
+                    asyncio.ensure_future(self._refresh_async(key, compute))
+            return entry[0], entry[1]
+
+        if key in self._async_calls:
+            self._count('coalesced')
+            return await asyncio.shield(self._async_calls[key])
+        self._count('misses')
+        return await self._compute_async(key, compute)
+
+    async def _refresh_async(self, key, compute):
+        try:
+            await self._compute_async(key, compute)
+        except Exception as e:
+            self.app.logger.warning(f'Background refresh of {key!r} failed: {e}')
+
+    async def _compute_async(self, key, compute):
+        future = asyncio.get_running_loop().create_future()
+        self._async_calls[key] = future
+        try:
+            generation, computed_at = self._generation, datetime.utcnow()
+            value = await compute()
+            self._store(key, value, computed_at, generation)
+            future.set_result((value, computed_at))
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            del self._async_calls[key]
+        return value, computed_at
+
+    def invalidate(self, topic, key=None):
+        """Drop entries for `topic`, or only those whose second key part is `key` (compared as a string)"""
+        with self._lock:
+            self._generation += 1
+            self._entries = {
+                k: e for k, e in self._entries.items()
+                if not (k[0] == topic and (key is None or str(k[1]) == key))
+            }
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries = {}
+
+
+micro_cache = MicroCache()
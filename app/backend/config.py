@@ -8,6 +8,43 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_RECORD_QUERIES = True
 
+    # Engine profile (see engine_profile.py)
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 30
+    DB_POOL_RECYCLE = 1800
+    DB_POOL_PRE_PING = True
+    DB_STATEMENT_CACHE_SIZE = 500
+
+    # Applied to every new SQLite connection; None leaves SQLite's default
+    SQLITE_JOURNAL_MODE = 'WAL'
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+    SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE = -20000  # negative = KiB
+    SQLITE_BUSY_TIMEOUT_MS = 5000
+    SQLITE_TEMP_STORE = 'MEMORY'
+
+    # Read replica bind for @use_replica views; unset = everything uses the primary
+    REPLICA_DATABASE_URL = os.environ.get('REPLICA_DATABASE_URL')
+    REPLICA_READ_YOUR_WRITES_SECONDS = 5
+
+    # step_logs/step ledger/boss_attacks shards, routed by user_id (see sharding.py); empty = not sharded
+    STEP_SHARD_URLS = [url for url in os.environ.get('STEP_SHARD_URLS', '').split(',') if url]
+
+    # Retention/compaction job (retention.py)
+    RETENTION_STEP_LOG_MONTHS = 13  # keep at least a year of daily rows for /api/steps/history
+    RETENTION_BOSS_ATTACK_DAYS = 30
+    RETENTION_JOURNEY_DAYS = 90
+    RETENTION_TOMBSTONE_DAYS = 30  # also how long a delta sync cursor stays valid
+    RETENTION_JOB_DAYS = 7  # finished jobs; their idempotency keys expire with them
+    RETENTION_CHUNK_SIZE = 5000
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+
+    # Apply pending migrations on startup; production workers only check the version
+    AUTO_MIGRATE = True
+    # Run that check when app.py is imported, so every gunicorn/uvicorn worker does it (off for migrations.py itself)
+    SCHEMA_CHECK_ON_STARTUP = os.environ.get('SCHEMA_CHECK_ON_STARTUP', 'true').lower() == 'true'
+
     JWT_SECRET_KEY = SECRET_KEY
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(days=1)
 
@@ -19,6 +56,84 @@ class Config:
     STEPS_PER_MILE = 2000
     RATE_LIMIT = 100
 
+    # Password hashing runs in a process pool (0 = hash inline on the request thread)
+    AUTH_POOL_WORKERS = int(os.environ.get('AUTH_POOL_WORKERS', 2))
+    AUTH_POOL_MAX_PENDING = int(os.environ.get('AUTH_POOL_MAX_PENDING', 32))
+    AUTH_POOL_TIMEOUT = 5
+
+    # ASGI serving mode (asgi.py); the async URL is derived from the sync one when unset
+    ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL')
+    ASYNC_POOL_SIZE = 20
+    ASYNC_MAX_OVERFLOW = 10
+
+    # `since` cursors re-read this many seconds before their timestamp (delta_sync.py)
+    SYNC_CURSOR_OVERLAP_SECONDS = 5
+
+    # Shared leaderboard/boss results per worker (coalesce.py); a TTL of 0 keeps only request coalescing.
+    # Writes through the app invalidate them on every worker, so longer TTLs don't serve stale data.
+    MICROCACHE_TTL_SECONDS = float(os.environ.get('MICROCACHE_TTL_SECONDS', 30))
+    MICROCACHE_STALE_SECONDS = float(os.environ.get('MICROCACHE_STALE_SECONDS', 5))
+    MICROCACHE_MAX_ENTRIES = 1024
+
+    # Cross-worker cache invalidation log (invalidation.py), relative to the instance folder; None = this worker only
+    INVALIDATION_LOG = os.environ.get('INVALIDATION_LOG', 'invalidations.db')
+    INVALIDATION_POLL_SECONDS = 0.2
+    INVALIDATION_RETENTION_SECONDS = 3600
+    # Topics whose invalidations are merged and sent at most once per window per key; every step sync changes
+    # the leaderboard, so it may lag writes by this much
+    INVALIDATION_DEBOUNCE_SECONDS = {'leaderboard': 5}
+
+    # Threads for the independent parts of /api/dashboard (0 = build them one after another)
+    DASHBOARD_WORKERS = int(os.environ.get('DASHBOARD_WORKERS', 4))
+
+    # Background jobs (jobs.py): worker threads per app worker (0 = run `python jobs.py work` separately);
+    # failed jobs retry with exponential backoff, claimed jobs run again after the visibility timeout
+    JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', 2))
+    JOBS_EAGER = os.environ.get('JOBS_EAGER', 'false').lower() == 'true'
+    JOBS_POLL_SECONDS = 1.0
+    JOBS_VISIBILITY_TIMEOUT_SECONDS = 60
+    JOBS_MAX_ATTEMPTS = 5
+    JOBS_RETRY_BACKOFF_SECONDS = 5
+    JOBS_RETRY_MAX_BACKOFF_SECONDS = 3600
+
+    # Per-route metrics on /metrics (metrics.py); workers share counters through files in METRICS_DIR,
+    # relative to the instance folder (None = this worker only). Set METRICS_TOKEN to require a bearer token.
+    METRICS_DIR = os.environ.get('METRICS_DIR', 'metrics')
+    METRICS_FLUSH_SECONDS = 5
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    # Gauges that query the database (job queue depth and lag) are reused for this long across scrapes
+    METRICS_GAUGE_MAX_AGE_SECONDS = 15
+
+    # Server-Timing headers (server_timing.py): on every response, a sampled share, or when the client
+    # sends X-Server-Timing: 1 (off in production, where it would show any client the phase breakdown)
+    SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', 'false').lower() == 'true'
+    SERVER_TIMING_SAMPLE_RATE = float(os.environ.get('SERVER_TIMING_SAMPLE_RATE', 0))
+    SERVER_TIMING_ALLOW_REQUEST = True
+
+    # Request profiling (profiling.py): requests with a signed X-Profile header (needs PROFILING_SECRET) or a
+    # sampled share run under cProfile and tracemalloc; results go to PROFILING_DIR in the instance folder
+    PROFILING_DIR = os.environ.get('PROFILING_DIR', 'profiles')
+    PROFILING_SECRET = os.environ.get('PROFILING_SECRET')
+    PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+    PROFILING_MAX_FILES = 200
+    PROFILING_TRACEMALLOC_FRAMES = 10
+
+    # Slow-query log (slow_queries.py): statements over the threshold are logged with their EXPLAIN plan
+    # to a rotating JSON-lines file in the instance folder; None = off, 0 = log everything
+    SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', 'slow_queries.log')
+    SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 200))
+    SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+    SLOW_QUERY_LOG_BACKUPS = 5
+    SLOW_QUERY_EXPLAIN = True
+    SLOW_QUERY_EXPLAIN_TTL_SECONDS = 300
+
+    # Response compression (payload.py); smaller bodies aren't worth the CPU
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4
+    COMPRESS_MIMETYPES = ('application/json',)
+
     MAX_CONTENT_LENGTH = 16*1024*1024
     UPLOAD_FOLDER = 'static/avatars'
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
@@ -27,6 +142,7 @@ class DevelopmentConfig(Config):
     DEBUG = True
     TESTING = False
     SQLALCHEMY_ECHO = True
+    SERVER_TIMING_ENABLED = True
     CORS_ORIGINS = ['http://localhost:3000', 'http://localhost:8081']
 
 class ProductionConfig(Config):
@@ -37,12 +153,33 @@ class ProductionConfig(Config):
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
     LOG_LEVEL = 'INFO'
+    SQLALCHEMY_RECORD_QUERIES = False
+
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    DB_POOL_TIMEOUT = 10
+    DB_STATEMENT_CACHE_SIZE = 1200
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 1024 * 1024 * 1024))
+    SERVER_TIMING_ALLOW_REQUEST = os.environ.get('SERVER_TIMING_ALLOW_REQUEST', 'false').lower() == 'true'
+    AUTO_MIGRATE = os.environ.get('AUTO_MIGRATE', 'false').lower() == 'true'
 
 class TestingConfig(Config):
     DEBUG = True
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     WTF_CSRF_ENABLED = False
+    AUTH_POOL_WORKERS = 0
+    DASHBOARD_WORKERS = 0  # the in-memory database is a single shared connection
+    MICROCACHE_TTL_SECONDS = 0
+    INVALIDATION_LOG = None
+    JOBS_WORKERS = 0
+    JOBS_EAGER = True
+    SCHEMA_CHECK_ON_STARTUP = False  # conftest.py migrates each test module's database
+    METRICS_DIR = None
+    SLOW_QUERY_LOG = None
+    PROFILING_DIR = None
+    SQLITE_JOURNAL_MODE = None
+    SQLITE_MMAP_SIZE = None
 
 config = {
     'development': DevelopmentConfig,
@@ -65,7 +202,16 @@ def load_config(app):
     if os.getenv('DATABASE_URL'):
         app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
 
-    print(f'Loaded {env} config')
+    if os.getenv('REPLICA_DATABASE_URL'):
+        app.config['REPLICA_DATABASE_URL'] = os.getenv('REPLICA_DATABASE_URL')
+
+    from replica import configure_binds
+    configure_binds(app.config, app.config.get('REPLICA_DATABASE_URL'))
+
+    from engine_profile import build_engine_options
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = build_engine_options(app.config)
+
+    app.logger.debug(f'Loaded {env} config')
     return app.config
 
 BADGE_MILESTONES = {
@@ -0,0 +1,250 @@
+"""
+Response builders shared by the single-purpose views and /api/dashboard.
+
+The dashboard loads the user, their UserLevel and the last week of StepLog
+rows once and builds the profile and weekly-steps parts from them, while the
+bosses and leaderboard parts, which only read shared tables, run on a small
+thread pool (DASHBOARD_WORKERS, 0 = sequential). Each pooled part runs in a
+copy of the request context with its own session, and carries over the user
+id and replica flag that session routing reads from `g` and the request's
+metrics (metrics.py).
+"""
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from flask import g, copy_current_request_context, current_app
+from sqlalchemy import select
+
+from models import db, StepLog, UserLevel
+from config import BADGE_MILESTONES
+from payload import select_fields, wants
+from coalesce import micro_cache
+from replica import primary_reads
+from sharding import step_totals
+import read_models
+
+DASHBOARD_PARTS = ('profile', 'weekly_steps', 'bosses', 'leaderboard')
+
+_executor_lock = threading.Lock()
+
+
+def get_or_create_level(user_id):
+    """The user's UserLevel, read from the primary so a lagging replica can't cause a duplicate insert"""
+    with primary_reads():
+        user_level = UserLevel.query.filter_by(user_id=user_id).first()
+        if not user_level:
+            user_level = UserLevel(user_id=user_id)
+            db.session.add(user_level)
+            db.session.commit()
+    return user_level
+
+
+def recent_steps(user_id, today, days=7):
+    """{date: steps_count} for the `days` days ending today"""
+    rows = db.session.execute(
+        select(StepLog.date, StepLog.steps_count)
+        .where(StepLog.user_id == user_id, StepLog.date > today - timedelta(days=days), StepLog.date <= today)
+    ).all()
+    return dict(rows)
+
+
+def streak_from_recent(user, recent, today, days=7):
+    """Streak from the days recent_steps loaded; only walks further back when all of them were active"""
+    streak = 0
+    while streak < days and recent.get(today - timedelta(days=streak), 0) > 0:
+        streak += 1
+    if streak == days:
+        return user.get_streak(today_active=True)
+    return streak
+
+
+def journey_summary(journey):
+    return {
+        'id': journey.id,
+        'start_city': journey.start_city,
+        'end_city': journey.end_city,
+        'total_distance_miles': journey.total_distance_miles,
+        'personal_progress_miles': journey.personal_progress_miles,
+        'progress_percentage': round((journey.personal_progress_miles / journey.total_distance_miles) * 100, 2),
+        'is_complete': journey.finished_at is not None
+    }
+
+
+def profile_payload(user, lifetime_steps, user_level, today_steps, streak, fields=None):
+    """`lifetime_steps` and `today_steps` come from step_ledger.current_steps, which includes unfolded steps"""
+    badges = []
+    for milestone, badge_info in BADGE_MILESTONES.items():
+        if lifetime_steps >= milestone:
+            badges.append(badge_info)
+
+    journey_info = None
+    if user.current_journey_id and wants(fields, 'current_journey'):
+        journey_info = journey_summary(user.current_journey)
+
+    return select_fields({
+        "username": user.username,
+        "display_name": user.display_name or user.username,
+        "total_steps_life": lifetime_steps,
+        "today_steps": today_steps,
+        "streak": streak,
+        "total_miles": round(lifetime_steps / 2000, 2),
+        "level": user_level.current_level if user_level else None,
+        "current_exp": user_level.current_exp if user_level else None,
+        "exp_to_next_level": user_level.exp_to_next_level() if user_level else None,
+        "badges": badges,
+        "current_journey": journey_info
+    }, fields)
+
+
+def weekly_payload(recent, today):
+    """Last 7 days including today, missing days filled with 0"""
+    start_date = today - timedelta(days=6)
+    return [
+        {'date': (start_date + timedelta(days=i)).isoformat(), 'steps': recent.get(start_date + timedelta(days=i), 0)}
+        for i in range(7)
+    ]
+
+
+def sync_payload(steps_added, steps_today, lifetime_steps, user_level, journey=None, progress_job_id=None):
+    """
+    Step totals right after a sync, read from the ledger (step_ledger.py). EXP, level and journey progress are
+    applied by the steps.progress job, so they are their last known values, from before this sync, while
+    `progress_pending` is set; clients refresh the profile for the new ones.
+    """
+    response = {
+        'message': 'Steps synced successfully',
+        'steps_added': steps_added,
+        'total_steps_today': steps_today + steps_added,
+        'total_steps_life': lifetime_steps + max(steps_added, 0),
+        'level': user_level.current_level,
+        'current_exp': user_level.current_exp,
+        'exp_to_next_level': user_level.exp_to_next_level(),
+        'level_ups': 0,
+        'progress_pending': progress_job_id is not None,
+        'progress_job_id': progress_job_id,
+    }
+    if journey is not None:
+        response['journey_progress'] = {
+            'journey_name': f'{journey.start_city} to {journey.end_city}',
+            'progress_miles': round(journey.personal_progress_miles, 2),
+            'total_miles': journey.total_distance_miles,
+            'progress_percentage': round((journey.personal_progress_miles / journey.total_distance_miles) * 100, 2),
+            'miles_added': round(max(steps_added, 0) / 2000, 2),
+            'is_completed': journey.finished_at is not None
+        }
+    return response
+
+
+def leaderboard_payload(user_id, timeframe='all', limit=10, friends_only=False, fields=None):
+    friend_user_ids = set()
+    if friends_only:
+        friend_user_ids = read_models.friend_ids(user_id)
+        # Always include current user in friends leaderboard
+        friend_user_ids.add(user_id)
+
+    today = date.today()
+    friend_filter = friend_user_ids if friends_only and friend_user_ids else None
+    total_entries = None
+    if timeframe == 'day':
+        step_logs = step_totals(today, today, user_ids=friend_filter)
+    elif timeframe == 'week':
+        step_logs = step_totals(today - timedelta(days=7), user_ids=friend_filter)
+    elif timeframe == 'month':
+        step_logs = step_totals(today.replace(day=1), user_ids=friend_filter)
+    else:
+        # All time leaderboard, ranked and limited in SQL
+        step_logs, total_entries = read_models.all_time_totals(friend_filter, limit)
+
+    entries, ranked_entries = read_models.leaderboard_entries(
+        step_logs, user_id, friend_user_ids if friends_only else None, limit, fields
+    )
+    return {
+        'timeframe': timeframe,
+        'friends_only': friends_only,
+        'total_entries': ranked_entries if total_entries is None else total_entries,
+        'leaderboard': entries
+    }
+
+
+def leaderboard_cache_key(timeframe, limit, fields):
+    return ('leaderboard', timeframe, limit, tuple(sorted(fields)) if fields is not None else None)
+
+
+def shared_fields_for(fields):
+    """Shared boards always keep user_id so personalize_leaderboard can find the current user"""
+    return None if fields is None else set(fields) | {'user_id'}
+
+
+def shared_leaderboard(timeframe='all', limit=10, fields=None):
+    """The global (not friends-only) board, computed once per worker for everyone (see coalesce.py)"""
+    return micro_cache.get(leaderboard_cache_key(timeframe, limit, fields),
+                           lambda: leaderboard_payload(None, timeframe, limit, False, fields))
+
+
+def personalize_leaderboard(shared, user_id, fields=None):
+    """Copy of a shared board with is_current_user set for `user_id`"""
+    entries = []
+    for entry in shared['leaderboard']:
+        if entry['user_id'] == user_id and 'is_current_user' in entry:
+            entry = dict(entry, is_current_user=True)
+        if fields is not None and 'user_id' not in fields:
+            entry = {key: value for key, value in entry.items() if key != 'user_id'}
+        entries.append(entry)
+    return dict(shared, leaderboard=entries)
+
+
+def leaderboard_for(user_id, timeframe='all', limit=10, friends_only=False, fields=None):
+    if friends_only:
+        return leaderboard_payload(user_id, timeframe, limit, friends_only, fields)
+    shared, _ = shared_leaderboard(timeframe, limit, shared_fields_for(fields))
+    return personalize_leaderboard(shared, user_id, fields)
+
+
+def shared_bosses(journey_id):
+    """(bosses, computed_at) for a journey (or the global/daily set), shared like the leaderboard"""
+    return micro_cache.get(('bosses', journey_id or 0), lambda: read_models.available_bosses(journey_id=journey_id))
+
+
+def _get_executor(app, workers):
+    """The app's pool, created on first use so it's sized by that app's DASHBOARD_WORKERS"""
+    with _executor_lock:
+        executor = app.extensions.get('dashboard_executor')
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dashboard')
+            app.extensions['dashboard_executor'] = executor
+        return executor
+
+
+def submit_parts(parts):
+    """Start {name: callable} on the pool, each in a copy of the request context.
+
+    Returns {name: future}, or None when DASHBOARD_WORKERS is 0 and the parts should run inline.
+    """
+    workers = current_app.config.get('DASHBOARD_WORKERS', 0)
+    if workers <= 0 or not parts:
+        return None
+
+    carried = {key: g.get(key) for key in ('user_id', 'use_replica')}
+
+    def in_request_context(build):
+        @copy_current_request_context
+        def run():
+            for key, value in carried.items():
+                setattr(g, key, value)
+            return build()
+        return run
+
+    executor = _get_executor(current_app._get_current_object(), workers)
+    # Each part also gets a copy of the contextvars so its queries count toward the request's metrics
+    return {
+        name: executor.submit(contextvars.copy_context().run, in_request_context(build))
+        for name, build in parts.items()
+    }
+
+
+def collect_parts(parts, futures):
+    if futures is None:
+        return {name: build() for name, build in parts.items()}
+    return {name: future.result() for name, future in futures.items()}
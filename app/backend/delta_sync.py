@@ -0,0 +1,83 @@
+"""
+`?since=<cursor>` delta sync for friends, bosses and step history.
+
+Every full or delta response carries a `next_cursor`. Passing it back returns
+only rows changed since then plus the ids the client should drop:
+
+- step history: StepLog rows whose `timestamp` moved (set on every update)
+- bosses: bosses whose `updated_at` moved; the ones no longer available
+  (defeated or deactivated) come back in `removed`
+- friends: friendships or friends' profiles that changed, accepted requests
+  in `removed_requests`, and deleted friendships from SyncTombstone rows
+  written by the flush hook below
+
+Cursors are opaque to clients. Each query starts SYNC_CURSOR_OVERLAP_SECONDS
+before the cursor so rows committed by slower concurrent transactions aren't
+missed; clients upsert by id, so repeats are harmless. A cursor older than
+RETENTION_TOMBSTONE_DAYS (tombstones are purged by retention.py), or issued
+for another journey on /api/bosses, gets a full response with `full: true`.
+"""
+import base64
+import json
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event
+
+from models import Friendship, SyncTombstone
+from replica import RoutingSession
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(issued_at, **scope):
+    """`issued_at` is a naive UTC datetime, like the stored timestamps"""
+    payload = dict(scope, t=int((issued_at - EPOCH).total_seconds() * 1000))
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        issued_at = EPOCH + timedelta(milliseconds=payload.pop('t'))
+    except (ValueError, KeyError, TypeError, AttributeError, OverflowError):
+        raise InvalidCursor('Invalid since cursor')
+    return issued_at, payload
+
+
+def changes_since(cursor, **scope):
+    """The timestamp to query changes from, or None when the client needs a full response.
+
+    Raises InvalidCursor for malformed cursors.
+    """
+    if not cursor:
+        return None
+    issued_at, cursor_scope = decode_cursor(cursor)
+    if cursor_scope != scope:
+        return None
+    config = current_app.config
+    if issued_at < datetime.utcnow() - timedelta(days=config.get('RETENTION_TOMBSTONE_DAYS', 30)):
+        return None
+    return issued_at - timedelta(seconds=config.get('SYNC_CURSOR_OVERLAP_SECONDS', 5))
+
+
+def next_cursor(issued_at=None, **scope):
+    """Cursor for the next sync; pass `issued_at` when the response was read earlier (e.g. from a cache)"""
+    return encode_cursor(issued_at or datetime.utcnow(), **scope)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _tombstone_deleted_friendships(session, flush_context, instances):
+    for obj in list(session.deleted):
+        if not isinstance(obj, Friendship):
+            continue
+        if obj.status == 'accepted':
+            session.add(SyncTombstone(user_id=obj.sender_id, entity='friend', entity_id=obj.receiver_id))
+            session.add(SyncTombstone(user_id=obj.receiver_id, entity='friend', entity_id=obj.sender_id))
+        else:
+            session.add(SyncTombstone(user_id=obj.receiver_id, entity='friend_request', entity_id=obj.id))
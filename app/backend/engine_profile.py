@@ -0,0 +1,72 @@
+"""
+Per-environment database engine tuning.
+
+`build_engine_options` turns the DB_* settings from config.py into
+SQLALCHEMY_ENGINE_OPTIONS (pool sizing, pre-ping, recycle, compiled statement
+cache), and `install_sqlite_pragmas` sets WAL, synchronous, mmap and busy
+timeout on every new SQLite connection so readers no longer block behind
+writers.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+
+def build_engine_options(config):
+    uri = config.get('SQLALCHEMY_DATABASE_URI')
+    url = make_url(uri) if uri else None
+    options = {
+        'query_cache_size': config.get('DB_STATEMENT_CACHE_SIZE', 500),
+    }
+
+    if url is not None and url.get_backend_name() == 'sqlite':
+        options['connect_args'] = {
+            'timeout': config.get('SQLITE_BUSY_TIMEOUT_MS', 5000) / 1000,
+            'cached_statements': config.get('DB_STATEMENT_CACHE_SIZE', 500),
+        }
+        if url.database in (None, '', ':memory:'):
+            # In-memory databases use a single static connection, pool options don't apply
+            return dict(options, **config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+    options.update({
+        'pool_size': config.get('DB_POOL_SIZE', 5),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+    })
+    options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    return options
+
+
+def sqlite_pragmas(config):
+    pragmas = {
+        'journal_mode': config.get('SQLITE_JOURNAL_MODE'),
+        'synchronous': config.get('SQLITE_SYNCHRONOUS'),
+        'mmap_size': config.get('SQLITE_MMAP_SIZE'),
+        'cache_size': config.get('SQLITE_CACHE_SIZE'),
+        'busy_timeout': config.get('SQLITE_BUSY_TIMEOUT_MS'),
+        'temp_store': config.get('SQLITE_TEMP_STORE'),
+    }
+    return {name: value for name, value in pragmas.items() if value is not None}
+
+
+def install_sqlite_pragmas(engine, config):
+    """Run the configured PRAGMAs on each new DBAPI connection of a SQLite engine"""
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = sqlite_pragmas(config)
+    if not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def init_app(app, db):
+    with app.app_context():
+        for engine in db.engines.values():
+            install_sqlite_pragmas(engine, app.config)
@@ -0,0 +1,302 @@
+"""
+Cross-worker cache invalidation.
+
+Every gunicorn/uvicorn worker has its own in-process caches (coalesce.py), so
+a write handled by one worker has to reach the others. When a session commits
+changes that `messages_for` maps to cached data, the matching (topic, key)
+messages are applied to this worker's caches right away. They are also
+appended to a shared SQLite log (INVALIDATION_LOG), where the AUTOINCREMENT
+`seq` column is the sequence number. Topics nobody subscribed to are dropped
+before either step, so a write that changes nothing cached costs nothing.
+
+Keys are as narrow as the cache keys allow: a step log only invalidates the
+leaderboard timeframes its date falls in, a lifetime total only the all-time
+board, a boss only the boss lists it appears in. Topics listed in
+INVALIDATION_DEBOUNCE_SECONDS are sent at most once per window per key: the
+first message goes out right away, later ones within the window are merged
+and sent when it ends (on the next publish or poll). Leaderboards therefore
+lag writes by up to that window, instead of every step sync emptying them on
+every worker and taking the log's write lock.
+
+Before handling a request, each worker reads the log entries past the last
+sequence number it applied. It does this at most once every
+INVALIDATION_POLL_SECONDS. The ASGI server (asgi.py) polls from a background
+task on a thread instead, so its event loop never waits on the log. The position only moves forward after the handlers
+have run. Delivery is therefore at-least-once, and handlers must be
+idempotent (dropping cache entries is). If the log was trimmed past a worker's
+position, the worker clears every subscribed topic. This happens when it sat
+idle for longer than INVALIDATION_RETENTION_SECONDS. With the bus in place,
+cache TTLs only bound staleness for writes made outside the app.
+
+Keys are strings, or None for "everything in the topic".
+"""
+import asyncio
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import User, StepLog, UserLevel, Boss
+
+LEADERBOARD_PROFILE_ATTRS = ('username', 'display_name', 'avatar_url')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS invalidations ('
+    ' seq INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, key TEXT, origin TEXT, created_at REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS invalidation_state (id INTEGER PRIMARY KEY CHECK (id = 1), trimmed_through INTEGER)',
+    'INSERT OR IGNORE INTO invalidation_state (id, trimmed_through) VALUES (1, 0)',
+)
+
+
+def _changed(obj, *names):
+    attrs = inspect(obj).attrs
+    return any(attrs[name].history.has_changes() for name in names)
+
+
+def leaderboard_timeframes(day, today=None):
+    """Timeframes of dashboard.leaderboard_payload whose date range includes `day`"""
+    today = today or date.today()
+    timeframes = []
+    if day == today:
+        timeframes.append('day')
+    if day >= today - timedelta(days=7):
+        timeframes.append('week')
+    if day >= today.replace(day=1):
+        timeframes.append('month')
+    return timeframes
+
+
+def messages_for(obj, deleted=False):
+    """(topic, key) pairs a committed change to `obj` invalidates"""
+    if isinstance(obj, StepLog):
+        return [('leaderboard', timeframe) for timeframe in leaderboard_timeframes(obj.date)]
+    if isinstance(obj, UserLevel):
+        # Boards show the level, not EXP, and a missing row counts as level 1
+        if inspect(obj).pending:
+            return [('leaderboard', None)] if (obj.current_level or 1) > 1 else []
+        if deleted or _changed(obj, 'current_level'):
+            return [('leaderboard', None)]
+        return []
+    if isinstance(obj, User):
+        if inspect(obj).pending:
+            # Users without steps aren't on any board
+            return [('leaderboard', 'all')] if obj.total_steps_life else []
+        if deleted or _changed(obj, *LEADERBOARD_PROFILE_ATTRS):
+            return [('leaderboard', None)]
+        if _changed(obj, 'total_steps_life'):
+            return [('leaderboard', 'all')]
+        return []
+    if isinstance(obj, Boss):
+        # Cached per journey id, 0 being the global/daily list (read_models._boss_scope)
+        if deleted or obj.boss_type == 'Global' or _changed(obj, 'journey_id', 'boss_type'):
+            return [('bosses', None)]
+        return [('bosses', str(obj.journey_id or 0))]
+    return []
+
+
+class InvalidationBus:
+    def __init__(self):
+        self.app = None
+        self.path = None
+        self.poll_interval = 0.2
+        self.retention = 3600
+        self.trim_every = 500
+        self.debounce = {}
+        self.last_seq = None
+        self._handlers = {}
+        self._sent_at = {}
+        self._deferred = set()
+        self._debounce_lock = threading.Lock()
+        self._last_poll = 0
+        self._poll_lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {'published': 0, 'debounced': 0, 'received': 0, 'resets': 0, 'errors': 0}
+
+    def init_app(self, app):
+        self.app = app
+        self.path = app.config.get('INVALIDATION_LOG')
+        if self.path and not os.path.isabs(self.path):
+            os.makedirs(app.instance_path, exist_ok=True)
+            self.path = os.path.join(app.instance_path, self.path)
+        self.poll_interval = app.config.get('INVALIDATION_POLL_SECONDS', 0.2)
+        self.retention = app.config.get('INVALIDATION_RETENTION_SECONDS', 3600)
+        self.debounce = dict(app.config.get('INVALIDATION_DEBOUNCE_SECONDS') or {})
+        app.extensions['invalidation_bus'] = self
+
+        @app.before_request
+        def poll_invalidations():
+            self.poll()
+
+    @property
+    def origin(self):
+        # Per process, so forked workers don't skip each other's messages
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def subscribe(self, topic, handler):
+        """Call handler(topic, key) for every message on `topic`, local or from another worker"""
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def _dispatch(self, topic, key):
+        for handler in self._handlers.get(topic, ()):
+            handler(topic, key)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _due(self, messages):
+        """Messages to send now: undebounced ones, ones outside their window, and deferred ones whose window ended"""
+        now = time.monotonic()
+        due = set()
+        with self._debounce_lock:
+            for message in set(messages) | self._deferred:
+                window = self.debounce.get(message[0])
+                if window and now - self._sent_at.get(message, float('-inf')) < window:
+                    if message not in self._deferred:
+                        self._deferred.add(message)
+                        self.stats['debounced'] += 1
+                    continue
+                due.add(message)
+                self._deferred.discard(message)
+                if window:
+                    self._sent_at[message] = now
+            if len(self._sent_at) > 1024:
+                horizon = now - max(self.debounce.values(), default=0)
+                self._sent_at = {message: at for message, at in self._sent_at.items() if at >= horizon}
+        # A key of None covers the topic's other keys
+        whole_topics = {topic for topic, key in due if key is None}
+        return {(topic, key) for topic, key in due if key is None or topic not in whole_topics}
+
+    def publish(self, messages):
+        """Apply `messages` here, then append them to the log for the other workers"""
+        messages = self._due(message for message in messages if message[0] in self._handlers)
+        messages = sorted(messages, key=lambda message: (message[0], message[1] or ''))
+        for topic, key in messages:
+            self._dispatch(topic, key)
+        if not self.path or not messages:
+            return
+        try:
+            conn = self._connection()
+            now = time.time()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.executemany(
+                    'INSERT INTO invalidations (topic, key, origin, created_at) VALUES (?, ?, ?, ?)',
+                    [(topic, key, self.origin, now) for topic, key in messages]
+                )
+                seq = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+                if seq // self.trim_every != (seq - len(messages)) // self.trim_every:
+                    self._trim(conn, now - self.retention)
+            self.stats['published'] += len(messages)
+        except sqlite3.Error as e:
+            self.stats['errors'] += 1
+            self.app.logger.warning(f'Failed to publish cache invalidations {messages!r}: {e}')
+
+    def _trim(self, conn, cutoff):
+        trimmed_through = conn.execute(
+            'SELECT MAX(seq) FROM invalidations WHERE created_at < ?', (cutoff,)
+        ).fetchone()[0]
+        if trimmed_through is not None:
+            conn.execute('DELETE FROM invalidations WHERE seq <= ?', (trimmed_through,))
+            conn.execute('UPDATE invalidation_state SET trimmed_through = MAX(trimmed_through, ?)', (trimmed_through,))
+
+    def poll(self, force=False):
+        """Apply messages other workers published since the last poll; returns how many were applied"""
+        if self._deferred:
+            self.publish(())
+        if not self.path:
+            return 0
+        now = time.monotonic()
+        if not force and now - self._last_poll < self.poll_interval:
+            return 0
+        if not self._poll_lock.acquire(blocking=False):
+            return 0  # another thread of this worker is polling
+        try:
+            self._last_poll = now
+            return self._apply_pending(self._connection())
+        except sqlite3.Error as e:
+            self.stats['errors'] += 1
+            self.app.logger.warning(f'Failed to read cache invalidations: {e}')
+            return 0
+        finally:
+            self._poll_lock.release()
+
+    def _apply_pending(self, conn):
+        if self.last_seq is None:
+            # Caches start empty, so a new worker only needs messages from now on
+            self.last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM invalidations').fetchone()[0]
+            return 0
+
+        trimmed_through = conn.execute('SELECT trimmed_through FROM invalidation_state').fetchone()[0]
+        if trimmed_through > self.last_seq:
+            for topic in list(self._handlers):
+                self._dispatch(topic, None)
+            self.last_seq = trimmed_through
+            self.stats['resets'] += 1
+
+        applied = 0
+        origin = self.origin
+        rows = conn.execute(
+            'SELECT seq, topic, key, origin FROM invalidations WHERE seq > ? ORDER BY seq', (self.last_seq,)
+        ).fetchall()
+        for seq, topic, key, message_origin in rows:
+            if message_origin != origin:
+                try:
+                    self._dispatch(topic, key)
+                except Exception as e:
+                    # Leave last_seq here so the next poll retries this message
+                    self.stats['errors'] += 1
+                    self.app.logger.warning(f'Cache invalidation {topic}:{key} failed: {e}')
+                    break
+                applied += 1
+            self.last_seq = seq
+        self.stats['received'] += applied
+        return applied
+
+
+invalidation_bus = InvalidationBus()
+
+
+# Registered on Session so the async engine's sessions (asgi.py) publish too
+def invalidate_on_commit(session, *messages):
+    """Publish (topic, key) `messages` when `session` commits, for writes made with Core statements"""
+    session.info.setdefault('invalidations', set()).update(messages)
+
+
+@event.listens_for(Session, 'before_flush')
+def _collect_invalidations(session, flush_context, instances):
+    messages = session.info.setdefault('invalidations', set())
+    for obj in list(session.new) + list(session.dirty):
+        messages.update(messages_for(obj))
+    for obj in list(session.deleted):
+        messages.update(messages_for(obj, deleted=True))
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_invalidations(session):
+    messages = session.info.pop('invalidations', None)
+    if not messages:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        invalidation_bus.publish(messages)
+    else:
+        # An AsyncSession committing on the event loop (asgi.py): the log write is file I/O, so do it on a thread
+        loop.run_in_executor(None, invalidation_bus.publish, messages)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_invalidations(session):
+    session.info.pop('invalidations', None)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Durable background jobs, stored in the main database.
+
+Side effects a response doesn't have to wait for (EXP, journey progress and
+completion bonuses after a step sync) are inserted into the `jobs` table in
+the same transaction as the write that causes them. A job therefore exists
+exactly when that write committed, and no broker is needed: SQLite and
+Postgres both work.
+
+Workers claim a runnable job with a conditional UPDATE on its status and
+locked_until, so any number of threads and processes can share the table.
+A claimed job that isn't finished within JOBS_VISIBILITY_TIMEOUT_SECONDS
+becomes runnable again, which covers workers that died or hung. A handler
+gets a session of its own, and the job is marked done in the same commit as
+the handler's writes, so database side effects apply once even when a job
+runs twice; handlers with effects outside the database must be idempotent
+themselves. Failed jobs are retried with exponential backoff until
+max_attempts, then stay `failed` until `python jobs.py retry`.
+
+An idempotency key makes enqueueing a no-op when a job with the same key
+already exists, finished or not (until retention.py purges it).
+
+Each app worker runs JOBS_WORKERS threads, started on its first request.
+Workers can also run on their own, with the app's workers set to 0:
+
+    python jobs.py work --threads 4
+    python jobs.py status
+    python jobs.py retry [--kind journey.completed]
+
+With JOBS_EAGER, `notify()` runs ready jobs right away on the calling
+thread. Tests and benchmarks use it to get the inline results.
+"""
+import json
+import os
+import random
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, update, func, or_, and_
+from sqlalchemy.dialects import sqlite, postgresql, mysql
+from sqlalchemy.orm import Session
+
+from models import db, Job
+
+jobs = Job.__table__
+
+INSERTS = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert,
+    'mysql': mysql.insert,
+}
+
+
+def job_insert(dialect, kind, payload, idempotency_key=None, delay=0, max_attempts=5):
+    """INSERT statement for a new job, ignored if `idempotency_key` is taken; run it in the caller's transaction"""
+    now = datetime.utcnow()
+    statement = INSERTS.get(dialect.name, insert)(jobs).values(
+        kind=kind, payload=json.dumps(payload), idempotency_key=idempotency_key, status='pending', attempts=0,
+        max_attempts=max_attempts, run_at=now + timedelta(seconds=delay), created_at=now,
+    )
+    if idempotency_key is None:
+        return statement
+    if dialect.name == 'mysql':
+        return statement.prefix_with('IGNORE')
+    return statement.on_conflict_do_nothing(index_elements=['idempotency_key'])
+
+
+def inserted_id(result):
+    """Id of the job a job_insert result added, None when it was ignored"""
+    return result.inserted_primary_key[0] if result.rowcount else None
+
+
+def runnable(now):
+    """Pending jobs that are due, and claimed jobs whose visibility timeout ran out"""
+    return or_(
+        and_(jobs.c.status == 'pending', jobs.c.run_at <= now),
+        and_(jobs.c.status == 'running', jobs.c.locked_until < now),
+    )
+
+
+class JobQueue:
+    def __init__(self):
+        self.app = None
+        self.workers = 0
+        self.eager = False
+        self.poll_interval = 1.0
+        self.visibility_timeout = 60
+        self.max_attempts = 5
+        self.backoff = 5
+        self.max_backoff = 3600
+        self.claim_batch = 10
+        self._handlers = {}
+        self._threads = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self.stats = {'done': 0, 'retried': 0, 'failed': 0, 'lost': 0}
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get('JOBS_WORKERS', 0)
+        self.eager = app.config.get('JOBS_EAGER', False)
+        self.poll_interval = app.config.get('JOBS_POLL_SECONDS', 1.0)
+        self.visibility_timeout = app.config.get('JOBS_VISIBILITY_TIMEOUT_SECONDS', 60)
+        self.max_attempts = app.config.get('JOBS_MAX_ATTEMPTS', 5)
+        self.backoff = app.config.get('JOBS_RETRY_BACKOFF_SECONDS', 5)
+        self.max_backoff = app.config.get('JOBS_RETRY_MAX_BACKOFF_SECONDS', 3600)
+        app.extensions['job_queue'] = self
+
+        @app.before_request
+        def start_job_workers():
+            self.ensure_started()
+
+    def handler(self, kind):
+        """Register `fn(session, payload)` as the handler of jobs of `kind`"""
+        def register(fn):
+            self._handlers[kind] = fn
+            return fn
+        return register
+
+    def enqueue(self, session, kind, payload, idempotency_key=None, delay=0, max_attempts=None):
+        """Add a job to `session`'s transaction; it becomes visible to workers when that commits. Returns its id,
+        or None when `idempotency_key` was taken"""
+        return inserted_id(session.execute(job_insert(
+            session.get_bind(clause=jobs).dialect, kind, payload, idempotency_key, delay,
+            max_attempts or self.max_attempts
+        )))
+
+    def notify(self):
+        """Call after committing enqueued jobs: runs them now in eager mode, else wakes this process's workers"""
+        if self.eager:
+            self.run_pending()
+        else:
+            self._wakeup.set()
+
+    @property
+    def worker_id(self):
+        return f'{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}'
+
+    def claim(self, job_id=None):
+        """Lock the next runnable job (or job `job_id`, if runnable) for this thread; returns its row or None"""
+        now = datetime.utcnow()
+        if job_id is not None:
+            candidates = [job_id]
+        else:
+            with db.engine.connect() as connection:
+                # Two queries rather than one with runnable(), so each is a range read of ix_jobs_status_run_at
+                candidates = connection.execute(
+                    select(jobs.c.id).where(jobs.c.status == 'running', jobs.c.locked_until < now)
+                    .limit(self.claim_batch)
+                ).scalars().all()
+                candidates += connection.execute(
+                    select(jobs.c.id).where(jobs.c.status == 'pending', jobs.c.run_at <= now)
+                    .order_by(jobs.c.run_at).limit(self.claim_batch)
+                ).scalars().all()
+            random.shuffle(candidates)  # so concurrent workers don't all race for the same row
+        for job_id in candidates:
+            with db.engine.begin() as connection:
+                claimed = connection.execute(
+                    update(jobs).where(jobs.c.id == job_id, runnable(now)).values(
+                        status='running', attempts=jobs.c.attempts + 1, locked_by=self.worker_id,
+                        locked_until=now + timedelta(seconds=self.visibility_timeout),
+                    )
+                ).rowcount == 1
+                if claimed:
+                    return connection.execute(select(jobs).where(jobs.c.id == job_id)).one()
+        return None
+
+    def _owned(self, job):
+        """Still ours: nobody reclaimed it after the visibility timeout"""
+        return and_(jobs.c.id == job.id, jobs.c.locked_by == job.locked_by, jobs.c.attempts == job.attempts)
+
+    def run_one(self, job_id=None):
+        """Claim and run one job (`job_id` if given); returns False when nothing was runnable"""
+        with self.app.app_context():
+            job = self.claim(job_id)
+            if job is None:
+                return False
+            with Session(db.engine) as session:
+                try:
+                    handler = self._handlers.get(job.kind)
+                    if handler is None:
+                        raise LookupError(f'No handler registered for job kind {job.kind!r}')
+                    handler(session, json.loads(job.payload))
+                    finished = session.execute(update(jobs).where(self._owned(job)).values(
+                        status='done', finished_at=datetime.utcnow(), locked_until=None, last_error=None
+                    )).rowcount == 1
+                    if not finished:
+                        session.rollback()
+                        self.stats['lost'] += 1
+                        self.app.logger.warning(f'Job {job.id} ({job.kind}) was reclaimed while running')
+                        return True
+                    session.commit()
+                    self.stats['done'] += 1
+                except Exception:
+                    session.rollback()
+                    self._retry_or_fail(job, traceback.format_exc(limit=5))
+            return True
+
+    def _retry_or_fail(self, job, error):
+        final = job.attempts >= job.max_attempts
+        delay = min(self.backoff * 2 ** (job.attempts - 1), self.max_backoff) * random.uniform(0.5, 1.0)
+        with db.engine.begin() as connection:
+            connection.execute(update(jobs).where(self._owned(job)).values(
+                status='failed' if final else 'pending', locked_until=None, last_error=error[-4000:],
+                run_at=datetime.utcnow() + timedelta(seconds=delay),
+                finished_at=datetime.utcnow() if final else None,
+            ))
+        self.stats['failed' if final else 'retried'] += 1
+        self.app.logger.warning(f'Job {job.id} ({job.kind}) attempt {job.attempts} failed: {error.splitlines()[-1]}')
+
+    def run_now(self, job_id):
+        """Run a committed job on this thread, for writes a response should include; workers retry it on failure"""
+        try:
+            self.run_one(job_id)
+        except Exception as e:
+            self.app.logger.warning(f'Job {job_id} left to the workers: {e}')
+
+    def run_pending(self, limit=100):
+        """Run runnable jobs on this thread until there are none (or `limit`); returns how many ran"""
+        ran = 0
+        while ran < limit and self.run_one():
+            ran += 1
+        return ran
+
+    def ensure_started(self):
+        """Start the JOBS_WORKERS threads once per process (forked app workers don't inherit threads)"""
+        if self._pid == os.getpid() or not self.workers or self.eager:
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.start(self.workers)
+
+    def start(self, threads):
+        self._pid = os.getpid()
+        self._stopping.clear()
+        self._threads = [
+            threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True) for i in range(threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                ran = self.run_one()
+            except Exception as e:
+                # Database unavailable or the like; the job itself is retried after its visibility timeout
+                self.app.logger.warning(f'Job worker error: {e}')
+                ran = False
+            if not ran:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def depth(self):
+        """{status: jobs} for the statuses that still need attention"""
+        with db.engine.connect() as connection:
+            rows = connection.execute(
+                select(jobs.c.status, func.count()).where(jobs.c.status.in_(['pending', 'running', 'failed']))
+                .group_by(jobs.c.status)
+            ).all()
+        return {'pending': 0, 'running': 0, 'failed': 0, **dict(rows)}
+
+    def lag(self):
+        """{kind: seconds the oldest due pending job has been waiting}"""
+        now = datetime.utcnow()
+        with db.engine.connect() as connection:
+            rows = connection.execute(
+                select(jobs.c.kind, func.min(jobs.c.run_at))
+                .where(jobs.c.status == 'pending', jobs.c.run_at <= now)
+                .group_by(jobs.c.kind)
+            ).all()
+        return {kind: max((now - oldest).total_seconds(), 0.0) for kind, oldest in rows}
+
+    def retry_failed(self, kind=None):
+        statement = update(jobs).where(jobs.c.status == 'failed').values(
+            status='pending', attempts=0, run_at=datetime.utcnow(), finished_at=None
+        )
+        if kind:
+            statement = statement.where(jobs.c.kind == kind)
+        with db.engine.begin() as connection:
+            return connection.execute(statement).rowcount
+
+
+job_queue = JobQueue()
+
+
+if __name__ == '__main__':
+    import argparse
+    import signal
+    import time
+    from app import app
+    from jobs import job_queue  # the instance app.py configured and registered handlers on, not this module's copy
+    from metrics import metrics
+
+    parser = argparse.ArgumentParser(description='Background job worker')
+    commands = parser.add_subparsers(dest='command', required=True)
+    work_parser = commands.add_parser('work', help='run jobs until interrupted')
+    work_parser.add_argument('--threads', type=int, default=4)
+    commands.add_parser('status', help='print queue depth and lag')
+    retry_parser = commands.add_parser('retry', help='make failed jobs runnable again')
+    retry_parser.add_argument('--kind', help='only jobs of this kind')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.command == 'status':
+            for status, count in job_queue.depth().items():
+                print(f'{status:<10} {count}')
+            for kind, seconds in sorted(job_queue.lag().items()):
+                print(f'lag {kind}: {seconds:.1f}s')
+        elif args.command == 'retry':
+            print(f'{job_queue.retry_failed(args.kind)} job(s) requeued')
+        else:
+            signal.signal(signal.SIGTERM, lambda *_: job_queue.stop(0))
+            job_queue.start(args.threads)
+            print(f'Running {args.threads} job worker thread(s)')
+            try:
+                while any(thread.is_alive() for thread in job_queue._threads):
+                    time.sleep(metrics.flush_interval)
+                    if metrics.directory:
+                        metrics.flush()  # so /metrics on the app includes this process's job counters
+            except KeyboardInterrupt:
+                job_queue.stop()
@@ -0,0 +1,336 @@
+"""
+Per-route request metrics, exposed on /metrics in the Prometheus text format.
+
+A WSGI middleware records, per method and route rule, these values for every
+request; StepUpASGI records the same for its native handlers:
+
+- a latency histogram
+- request counts by status code, and 5xx counts
+- response bytes
+- the number and total time of the DB queries the request ran, and the rows
+  they returned or changed
+
+Query counts and times come from engine cursor events, so they cover every
+engine, including shards, the replica and the async engine. SELECT rows are
+counted as the result fetches them from the DBAPI cursor, so nothing is
+buffered and a `.first()` counts the one row it read; streamed and yield_per
+results aren't counted. DML rows come from the cursor's rowcount. Everything
+accumulates in plain dicts under a lock.
+
+Each worker writes its counters to METRICS_DIR/<pid>.json, at most every
+METRICS_FLUSH_SECONDS, and /metrics sums every file there so any worker
+answers for all of them. Like prometheus_client's multiprocess directory,
+METRICS_DIR should be emptied on deploy. Counters of workers that exited stay
+in the totals. Gauges (`add_gauge`) describe shared state such as the job
+queue, so the worker answering the scrape reads them itself instead, at most
+once every METRICS_GAUGE_MAX_AGE_SECONDS.
+"""
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.cursor import CursorFetchStrategy
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+ROUTE_METRICS = (
+    # (name, type, help, field)
+    ('stepup_http_request_errors_total', 'counter', 'Requests that ended with a 5xx status', 'errors'),
+    ('stepup_http_response_bytes_total', 'counter', 'Response body bytes sent, after compression', 'response_bytes'),
+    ('stepup_db_queries_total', 'counter', 'Database statements executed while handling requests', 'queries'),
+    ('stepup_db_query_duration_seconds_total', 'counter', 'Time spent in database statements', 'query_seconds'),
+    ('stepup_db_rows_total', 'counter', 'Rows returned by session queries or changed by DML', 'rows'),
+)
+
+_current = contextvars.ContextVar('stepup_request_metrics', default=None)
+
+
+class RequestStats:
+    __slots__ = ('queries', 'query_seconds', 'rows', 'started', 'phases')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.rows = 0
+        self.started = time.perf_counter()
+        self.phases = {}  # name -> (seconds, query seconds within), see server_timing.py
+
+
+def current_stats():
+    """RequestStats of the request being handled, or None outside one"""
+    return _current.get()
+
+
+class Metrics:
+    def __init__(self):
+        self.app = None
+        self.directory = None
+        self.flush_interval = 5
+        self.buckets = DEFAULT_BUCKETS
+        self.token = None
+        self._routes = {}
+        self._sources = []
+        self._gauges = []
+        self._gauge_max_age = 15
+        self._gauge_values = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.directory = app.config.get('METRICS_DIR')
+        if self.directory and not os.path.isabs(self.directory):
+            self.directory = os.path.join(app.instance_path, self.directory)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        self.flush_interval = app.config.get('METRICS_FLUSH_SECONDS', 5)
+        self.buckets = tuple(app.config.get('METRICS_LATENCY_BUCKETS', DEFAULT_BUCKETS))
+        self.token = app.config.get('METRICS_TOKEN')
+        self._gauge_max_age = app.config.get('METRICS_GAUGE_MAX_AGE_SECONDS', 15)
+        app.extensions['metrics'] = self
+
+        app.wsgi_app = self.middleware(app.wsgi_app)
+
+        # Runs for every request (routing happens before before_request, and 404s have no rule)
+        @app.before_request
+        def remember_route():
+            request.environ['stepup.route'] = request.url_rule.rule if request.url_rule else None
+
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view, methods=['GET'])
+
+    def add_source(self, name, help, label, counters):
+        """Also export `counters()` ({label value: count}) as counter `name`, summed across workers"""
+        self._sources.append((name, help, label, counters))
+
+    def add_gauge(self, name, help, label, read):
+        """Also export `read()` ({label value: value}) as gauge `name`, read when /metrics is scraped"""
+        self._gauges.append((name, help, label, read))
+
+    def read_gauge(self, name, read):
+        """`read()`, or its last value if that is younger than METRICS_GAUGE_MAX_AGE_SECONDS"""
+        cached = self._gauge_values.get(name)
+        if cached is not None and time.monotonic() - cached[0] < self._gauge_max_age:
+            return cached[1]
+        values = read()
+        self._gauge_values[name] = (time.monotonic(), values)
+        return values
+
+    @contextmanager
+    def track(self):
+        """Collect query stats for the code inside the block (one request)"""
+        stats = RequestStats()
+        token = _current.set(stats)
+        try:
+            yield stats
+        finally:
+            _current.reset(token)
+
+    def middleware(self, wsgi_app):
+        def record_request(environ, start_response):
+            captured = {}
+
+            def capture(status, headers, exc_info=None):
+                captured['status'] = int(status.split(' ', 1)[0])
+                captured['length'] = next((int(v) for k, v in headers if k.lower() == 'content-length'), 0)
+                return start_response(status, headers, exc_info)
+
+            with self.track() as stats:
+                try:
+                    return wsgi_app(environ, capture)
+                finally:
+                    self.record(environ['REQUEST_METHOD'], environ.get('stepup.route') or 'unmatched',
+                                captured.get('status', 500), time.perf_counter() - stats.started,
+                                captured.get('length', 0), stats)
+        return record_request
+
+    def record(self, method, route, status, seconds, response_bytes, stats, flush=True):
+        """Count one request; `flush=False` leaves writing METRICS_DIR to the caller (asgi.py does it on a thread)"""
+        key = f'{method} {route}'
+        with self._lock:
+            counters = self._routes.get(key)
+            if counters is None:
+                counters = self._routes[key] = {
+                    'statuses': {}, 'buckets': [0] * (len(self.buckets) + 1), 'count': 0, 'seconds': 0.0,
+                    'errors': 0, 'response_bytes': 0, 'queries': 0, 'query_seconds': 0.0, 'rows': 0,
+                }
+            counters['statuses'][str(status)] = counters['statuses'].get(str(status), 0) + 1
+            counters['buckets'][bisect_left(self.buckets, seconds)] += 1
+            counters['count'] += 1
+            counters['seconds'] += seconds
+            counters['errors'] += status >= 500
+            counters['response_bytes'] += response_bytes
+            counters['queries'] += stats.queries
+            counters['query_seconds'] += stats.query_seconds
+            counters['rows'] += stats.rows
+        if flush and self.directory and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            routes = json.loads(json.dumps(self._routes))
+        sources = {name: {str(k): v for k, v in counters().items()} for name, _, _, counters in self._sources}
+        return {'buckets': list(self.buckets), 'routes': routes, 'sources': sources}
+
+    def flush(self):
+        """Write this worker's counters to METRICS_DIR"""
+        self._last_flush = time.monotonic()
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.app.logger.warning(f'Failed to write metrics to {path}: {e}')
+
+    def collect(self):
+        """Counters summed over every worker's file (or only this worker without METRICS_DIR)"""
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        total = {'buckets': list(self.buckets), 'routes': {}, 'sources': {}}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    worker = json.load(f)
+            except (OSError, ValueError):
+                continue  # being replaced or truncated; picked up on the next scrape
+            if worker.get('buckets') != total['buckets']:
+                continue  # written with other METRICS_LATENCY_BUCKETS, before a deploy
+            _merge(total['routes'], worker['routes'])
+            _merge(total['sources'], worker['sources'])
+        return total
+
+    def render(self, data):
+        lines = []
+
+        def family(name, kind, help):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        routes = sorted((key.split(' ', 1), counters) for key, counters in data['routes'].items())
+
+        family('stepup_http_requests_total', 'counter', 'Requests handled, by route and status code')
+        for (method, route), counters in routes:
+            for status, count in sorted(counters['statuses'].items()):
+                lines.append(f'stepup_http_requests_total{_labels(method=method, route=route, status=status)} {count}')
+
+        family('stepup_http_request_duration_seconds', 'histogram', 'Request latency')
+        for (method, route), counters in routes:
+            cumulative = 0
+            for bound, count in zip(list(data['buckets']) + ['+Inf'], counters['buckets']):
+                cumulative += count
+                labels = _labels(method=method, route=route, le=bound)
+                lines.append(f'stepup_http_request_duration_seconds_bucket{labels} {cumulative}')
+            labels = _labels(method=method, route=route)
+            lines.append(f'stepup_http_request_duration_seconds_sum{labels} {counters["seconds"]}')
+            lines.append(f'stepup_http_request_duration_seconds_count{labels} {counters["count"]}')
+
+        for name, kind, help, field in ROUTE_METRICS:
+            family(name, kind, help)
+            for (method, route), counters in routes:
+                lines.append(f'{name}{_labels(method=method, route=route)} {counters[field]}')
+
+        for name, help, label, _ in self._sources:
+            family(name, 'counter', help)
+            for key, value in sorted(data['sources'].get(name, {}).items()):
+                lines.append(f'{name}{_labels(**{label: key})} {value}')
+
+        for name, help, label, read in self._gauges:
+            try:
+                values = self.read_gauge(name, read)
+            except Exception as e:
+                self.app.logger.warning(f'Failed to read gauge {name}: {e}')
+                continue
+            family(name, 'gauge', help)
+            for key, value in sorted(values.items()):
+                lines.append(f'{name}{_labels(**{label: key})} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        if self.token and request.headers.get('Authorization') != f'Bearer {self.token}':
+            return Response('Unauthorized\n', 401, mimetype='text/plain')
+        return Response(self.render(self.collect()), mimetype='text/plain; version=0.0.4')
+
+    def reset(self):
+        with self._lock:
+            self._routes = {}
+
+
+def _merge(total, worker):
+    for key, value in worker.items():
+        if isinstance(value, dict):
+            _merge(total.setdefault(key, {}), value)
+        elif isinstance(value, list):
+            current = total.setdefault(key, [0] * len(value))
+            for i, item in enumerate(value):
+                current[i] += item
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+def _labels(**labels):
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        context._metrics_started = time.perf_counter()
+
+
+class _CountingFetch(CursorFetchStrategy):
+    """The default fetch strategy, adding the rows it fetches to a request's stats"""
+    __slots__ = ('stats',)
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def fetchone(self, result, dbapi_cursor, hard_close=False):
+        row = super().fetchone(result, dbapi_cursor, hard_close)
+        if row is not None:
+            self.stats.rows += 1
+        return row
+
+    def fetchmany(self, result, dbapi_cursor, size=None):
+        rows = super().fetchmany(result, dbapi_cursor, size)
+        self.stats.rows += len(rows)
+        return rows
+
+    def fetchall(self, result, dbapi_cursor):
+        rows = super().fetchall(result, dbapi_cursor)
+        self.stats.rows += len(rows)
+        return rows
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None or not hasattr(context, '_metrics_started'):
+        return
+    stats.queries += 1
+    stats.query_seconds += time.perf_counter() - context._metrics_started
+    if context.isinsert or context.isupdate or context.isdelete:
+        if cursor.rowcount > 0:
+            stats.rows += cursor.rowcount
+    elif (cursor.description is not None and type(context.cursor_fetch_strategy) is CursorFetchStrategy
+          and not context.execution_options.get('stream_results')
+          and not context.execution_options.get('yield_per')):
+        # The result is built after this event, with the context's fetch strategy
+        context.cursor_fetch_strategy = _CountingFetch(stats)
+
+
+metrics = Metrics()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations.
+
+Each migration runs once, in order, inside its own transaction and bumps the
+version stored in the schema_version table. Workers only compare that version
+on startup (a single indexed read) instead of running create_all and the
+template seeding on every boot.
+
+    python migrations.py            # upgrade the configured database
+    python migrations.py --status   # show current and latest version
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    select, text, inspect, exc, MetaData, Table, Column, ForeignKey, UniqueConstraint, Index,
+    Integer, String, Text, Float, Boolean, Date, DateTime,
+)
+
+from models import db
+
+# The schema as it was before versioning, frozen here so version 1 means the same tables whatever the models look
+# like today. Later changes go into new migrations, never into this.
+base_schema = MetaData()
+
+Table(
+    'users', base_schema,
+    Column('id', Integer, primary_key=True),
+    Column('username', String(80), unique=True, nullable=False),
+    Column('email', String(120), unique=True, nullable=True),
+    Column('password_hash', String(128), nullable=False),
+    Column('avatar_url', String(200)),
+    Column('display_name', String(100), nullable=True),
+    Column('total_steps_life', Integer, nullable=False),
+    Column('current_journey_id', Integer, ForeignKey('journeys.id'), nullable=True),
+    Column('created_at', DateTime, nullable=False),
+    Column('updated_at', DateTime),
+    Column('last_active', DateTime),
+)
+
+Table(
+    'step_logs', base_schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False, index=True),
+    Column('steps_count', Integer, nullable=False),
+    Column('distance_miles', Float, nullable=True),
+    Column('date', Date, nullable=False, index=True),
+    Column('timestamp', DateTime, nullable=False),
+    Column('source', String(50)),
+    UniqueConstraint('user_id', 'date', name='unique_user_date'),
+)
+
+Table(
+    'journeys', base_schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=True),
+    Column('template_id', Integer, nullable=True),
+    Column('start_city', String(100), nullable=False),
+    Column('end_city', String(100), nullable=False),
+    Column('description', Text, nullable=True),
+    Column('total_distance_miles', Float, nullable=False),
+    Column('personal_progress_miles', Float, nullable=False),
+    Column('status', String(20)),
+    Column('difficulty', String(20)),
+    Column('is_active', Boolean),
+    Column('is_template', Boolean),
+    Column('started_at', DateTime, nullable=False),
+    Column('updated_at', DateTime),
+    Column('finished_at', DateTime, nullable=True),
+)
+
+Table(
+    'bosses', base_schema,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('description', Text, nullable=False),
+    Column('image_url', String(200), nullable=True),
+    Column('max_health', Integer, nullable=False),
+    Column('current_health', Integer, nullable=False),
+    Column('exp_reward', Integer, nullable=False),
+    Column('coin_reward', Integer),
+    Column('special_reward', String(100), nullable=True),
+    Column('difficulty', String(20)),
+    Column('boss_type', String(30)),
+    Column('journey_id', Integer, ForeignKey('journeys.id'), nullable=True),
+    Column('is_active', Boolean),
+    Column('spawned_at', DateTime),
+    Column('defeated_at', DateTime, nullable=True),
+    Column('respawn_hours', Integer),
+)
+
+Table(
+    'user_levels', base_schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False, unique=True),
+    Column('current_level', Integer),
+    Column('current_exp', Integer),
+    Column('total_exp', Integer),
+    Column('attack_power', Integer),
+    Column('created_at', DateTime),
+    Column('last_levelup', DateTime),
+)
+
+Table(
+    'boss_attacks', base_schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('boss_id', Integer, ForeignKey('bosses.id'), nullable=False),
+    Column('steps_used', Integer, nullable=False),
+    Column('damage_dealt', Integer, nullable=False),
+    Column('exp_gained', Integer),
+    Column('attacked_at', DateTime),
+)
+
+Table(
+    'friendships', base_schema,
+    Column('id', Integer, primary_key=True),
+    Column('sender_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('receiver_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('status', String(20)),
+    Column('sent_at', DateTime),
+    Column('accepted_at', DateTime, nullable=True),
+    UniqueConstraint('sender_id', 'receiver_id', name='unique_friendship'),
+)
+
+Table(
+    'achievements', base_schema,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False, unique=True),
+    Column('description', Text, nullable=False),
+    Column('category', String(50)),
+    Column('criteria_type', String(50), nullable=False),
+    Column('criteria_value', Integer, nullable=False),
+    Column('rarity', String(20)),
+    Column('points_value', Integer),
+    Column('is_secret', Boolean),
+)
+
+Table(
+    'user_achievements', base_schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('achievement_id', Integer, ForeignKey('achievements.id'), nullable=False),
+    Column('earned_at', DateTime),
+    Column('progress', Float),
+    UniqueConstraint('user_id', 'achievement_id', name='unique_user_achievement'),
+)
+
+
+def _create_base_schema(connection):
+    base_schema.create_all(connection)
+
+
+def _seed_journey_templates(connection):
+    from config import PRESET_JOURNEYS
+
+    existing = connection.execute(text('SELECT COUNT(*) FROM journeys WHERE is_template = :t'), {'t': True}).scalar()
+    if existing:
+        return
+    now = datetime.utcnow()
+    connection.execute(text(
+        'INSERT INTO journeys (user_id, start_city, end_city, description, total_distance_miles, '
+        'personal_progress_miles, status, difficulty, is_active, is_template, started_at, updated_at) '
+        'VALUES (NULL, :start_city, :end_city, :description, :total_distance_miles, '
+        '0.0, :status, :difficulty, :is_active, :is_template, :now, :now)'
+    ), [
+        dict(journey, status='In Progress', is_active=True, is_template=True, now=now)
+        for journey in PRESET_JOURNEYS
+    ])
+
+
+def _frozen(*base_tables):
+    """A MetaData for one migration's DDL that can point at (and index) base tables without creating them"""
+    metadata = MetaData()
+    for name in base_tables:
+        base_schema.tables[name].to_metadata(metadata)
+    return metadata
+
+
+def _index(metadata, table_name, name, *columns):
+    table = metadata.tables[table_name]
+    return Index(name, *(table.c[column] for column in columns))
+
+
+# Each later migration freezes its own DDL the same way; never edit these once released, add a migration instead.
+hot_path_schema = _frozen('users', 'journeys', 'bosses', 'boss_attacks', 'friendships')
+
+HOT_PATH_INDEXES = [
+    _index(hot_path_schema, 'friendships', 'ix_friendships_receiver_status', 'receiver_id', 'status'),
+    _index(hot_path_schema, 'friendships', 'ix_friendships_sender_status', 'sender_id', 'status'),
+    _index(hot_path_schema, 'bosses', 'ix_bosses_active_type', 'is_active', 'boss_type'),
+    _index(hot_path_schema, 'boss_attacks', 'ix_boss_attacks_boss_user', 'boss_id', 'user_id'),
+    _index(hot_path_schema, 'journeys', 'ix_journeys_template_active', 'is_template', 'is_active'),
+    _index(hot_path_schema, 'users', 'ix_users_total_steps_life', 'total_steps_life'),
+]
+
+
+def _add_hot_path_indexes(connection):
+    for index in HOT_PATH_INDEXES:
+        index.create(connection, checkfirst=True)
+    if connection.dialect.name == 'sqlite':
+        # Without statistics SQLite prefers ordered index scans for GROUP BY
+        connection.execute(text('ANALYZE'))
+
+
+step_log_monthly_schema = _frozen('users')
+
+Table(
+    'step_log_monthly', step_log_monthly_schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('month', Date, nullable=False),
+    Column('steps_count', Integer, nullable=False),
+    Column('distance_miles', Float, nullable=False),
+    Column('active_days', Integer, nullable=False),
+    Column('trailing_active_days', Integer, nullable=False),
+    Column('compacted_at', DateTime),
+    UniqueConstraint('user_id', 'month', name='unique_user_month'),
+)
+
+
+def _add_step_log_monthly(connection):
+    step_log_monthly_schema.tables['step_log_monthly'].create(connection, checkfirst=True)
+
+
+def _add_column(connection, column):
+    """ALTER TABLE ADD COLUMN for a frozen column, skipped if it already exists"""
+    table_name = column.table.name
+    if column.name in {c['name'] for c in inspect(connection).get_columns(table_name)}:
+        return
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}'))
+
+
+delta_sync_schema = _frozen('users', 'step_logs', 'bosses', 'friendships')
+delta_sync_schema.tables['friendships'].append_column(Column('updated_at', DateTime))
+delta_sync_schema.tables['bosses'].append_column(Column('updated_at', DateTime))
+
+Table(
+    'sync_tombstones', delta_sync_schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, nullable=False),
+    Column('entity', String(30), nullable=False),
+    Column('entity_id', Integer, nullable=False),
+    Column('deleted_at', DateTime, nullable=False),
+    Index('ix_sync_tombstones_user_deleted', 'user_id', 'deleted_at'),
+)
+
+DELTA_SYNC_INDEXES = [
+    _index(delta_sync_schema, 'step_logs', 'ix_step_logs_user_timestamp', 'user_id', 'timestamp'),
+    _index(delta_sync_schema, 'bosses', 'ix_bosses_updated_at', 'updated_at'),
+    _index(delta_sync_schema, 'friendships', 'ix_friendships_receiver_updated', 'receiver_id', 'updated_at'),
+]
+
+
+def _add_delta_sync(connection):
+    _add_column(connection, delta_sync_schema.tables['friendships'].c.updated_at)
+    _add_column(connection, delta_sync_schema.tables['bosses'].c.updated_at)
+    connection.execute(text('UPDATE friendships SET updated_at = COALESCE(accepted_at, sent_at) WHERE updated_at IS NULL'))
+    connection.execute(text('UPDATE bosses SET updated_at = COALESCE(defeated_at, spawned_at) WHERE updated_at IS NULL'))
+    delta_sync_schema.tables['sync_tombstones'].create(connection, checkfirst=True)
+    for index in DELTA_SYNC_INDEXES:
+        index.create(connection, checkfirst=True)
+
+
+jobs_schema = MetaData()
+
+Table(
+    'jobs', jobs_schema,
+    Column('id', Integer, primary_key=True),
+    Column('kind', String(100), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('idempotency_key', String(200), unique=True),
+    Column('status', String(20), nullable=False),
+    Column('attempts', Integer, nullable=False),
+    Column('max_attempts', Integer, nullable=False),
+    Column('run_at', DateTime, nullable=False),
+    Column('locked_until', DateTime),
+    Column('locked_by', String(100)),
+    Column('last_error', Text),
+    Column('created_at', DateTime, nullable=False),
+    Column('finished_at', DateTime),
+    Index('ix_jobs_status_run_at', 'status', 'run_at'),
+)
+
+
+def _add_jobs(connection):
+    jobs_schema.tables['jobs'].create(connection, checkfirst=True)
+
+
+step_ledger_schema = _frozen('users')
+
+Table(
+    'step_events', step_ledger_schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('date', Date, nullable=False),
+    Column('kind', String(20), nullable=False),
+    Column('steps_delta', Integer, nullable=False),
+    Column('lifetime_delta', Integer, nullable=False),
+    Column('source', String(50)),
+    Column('created_at', DateTime, nullable=False),
+    Index('ix_step_events_user_id', 'user_id', 'id'),
+)
+
+Table(
+    'step_snapshots', step_ledger_schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('event_id', Integer, nullable=False),
+    Column('event_count', Integer, nullable=False),
+    Column('lifetime_steps', Integer, nullable=False),
+    Column('opening_lifetime_steps', Integer, nullable=False),
+    Column('opening_date', Date, nullable=False),
+    Column('opening_day_steps', Integer, nullable=False),
+    Column('taken_at', DateTime, nullable=False),
+    UniqueConstraint('user_id', name='unique_step_snapshot_user'),
+)
+
+
+def _add_step_ledger(connection):
+    step_ledger_schema.tables['step_events'].create(connection, checkfirst=True)
+    step_ledger_schema.tables['step_snapshots'].create(connection, checkfirst=True)
+
+
+step_rollups_schema = _frozen('users')
+
+Table(
+    'step_rollups', step_rollups_schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('period', String(5), nullable=False),
+    Column('start', Date, nullable=False),
+    Column('steps_count', Integer, nullable=False),
+    Column('distance_miles', Float, nullable=False),
+    Column('active_days', Integer, nullable=False),
+    UniqueConstraint('user_id', 'period', 'start', name='unique_user_period_start'),
+)
+
+
+def backfill_step_rollups(connection, chunk_size=5000):
+    """Day, week and month rollups of the step_logs and step_log_monthly rows on `connection`, one user at a time"""
+    logs = base_schema.tables['step_logs']
+    monthly = step_log_monthly_schema.tables['step_log_monthly']
+    rollups = step_rollups_schema.tables['step_rollups']
+    user_ids = connection.execute(
+        select(logs.c.user_id).union(select(monthly.c.user_id)).order_by('user_id')
+    ).scalars().all()
+
+    for user_id in user_ids:
+        totals = {}
+        days = connection.execute(
+            select(logs.c.date, logs.c.steps_count, logs.c.distance_miles).where(logs.c.user_id == user_id)
+        ).all()
+        months = connection.execute(
+            select(monthly.c.month, monthly.c.steps_count, monthly.c.distance_miles, monthly.c.active_days)
+            .where(monthly.c.user_id == user_id)
+        ).all()
+        buckets = [
+            ((period, start), (steps, distance or 0.0, int(steps > 0)))
+            for day, steps, distance in days
+            for period, start in (('day', day), ('week', day - timedelta(days=day.weekday())),
+                                  ('month', day.replace(day=1)))
+        ] + [(('month', month), (steps, distance, active_days)) for month, steps, distance, active_days in months]
+        for key, change in buckets:
+            totals[key] = [total + delta for total, delta in zip(totals.get(key, (0, 0.0, 0)), change)]
+        rows = [
+            {'user_id': user_id, 'period': period, 'start': start, 'steps_count': steps, 'distance_miles': distance,
+             'active_days': active_days}
+            for (period, start), (steps, distance, active_days) in totals.items()
+        ]
+        for i in range(0, len(rows), chunk_size):
+            connection.execute(rollups.insert(), rows[i:i + chunk_size])
+
+
+def _add_step_rollups(connection):
+    if inspect(connection).has_table('step_rollups'):
+        return
+    step_rollups_schema.tables['step_rollups'].create(connection)
+    backfill_step_rollups(connection)
+
+
+# (version, description, function(connection)) -- append only, never renumber
+MIGRATIONS = [
+    (1, 'base schema', _create_base_schema),
+    (2, 'seed journey templates', _seed_journey_templates),
+    (3, 'hot path indexes', _add_hot_path_indexes),
+    (4, 'monthly step rollups', _add_step_log_monthly),
+    (5, 'delta sync columns, tombstones and indexes', _add_delta_sync),
+    (6, 'background jobs', _add_jobs),
+    (7, 'step event ledger and snapshots', _add_step_ledger),
+    (8, 'day, week and month step rollups', _add_step_rollups),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+
+def current_version(connection):
+    if not inspect(connection).has_table('schema_version'):
+        return 0
+    return connection.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+
+def check_schema(engine):
+    """Cheap startup check: returns the stored version, 0 if never migrated"""
+    with engine.connect() as connection:
+        try:
+            return connection.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+        except exc.DBAPIError:
+            # Only a missing schema_version table means "never migrated"; locked or broken databases raise
+            connection.rollback()
+            if inspect(connection).has_table('schema_version'):
+                raise
+            return 0
+
+
+def upgrade(engine, target=None, verbose=False):
+    target = LATEST_VERSION if target is None else target
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_version ('
+            'version INTEGER NOT NULL PRIMARY KEY, description VARCHAR(200), applied_at TIMESTAMP)'
+        ))
+        version = current_version(connection)
+
+    applied = []
+    for number, description, migrate in MIGRATIONS:
+        if number <= version or number > target:
+            continue
+        with engine.begin() as connection:
+            migrate(connection)
+            connection.execute(
+                text('INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :at)'),
+                {'v': number, 'd': description, 'at': datetime.utcnow()}
+            )
+        applied.append(number)
+        if verbose:
+            print(f'Applied migration {number}: {description}')
+    return applied
+
+
+def ensure_schema(engine, auto_migrate=True):
+    """Called on worker startup; only migrates when the stored version is behind"""
+    version = check_schema(engine)
+    if version >= LATEST_VERSION:
+        return []
+    if not auto_migrate:
+        raise SchemaOutOfDate(
+            f'Database schema is at version {version}, expected {LATEST_VERSION}. Run `python migrations.py`.'
+        )
+    try:
+        return upgrade(engine)
+    except Exception:
+        # Another worker may have raced us through the same migration
+        if check_schema(engine) >= LATEST_VERSION:
+            return []
+        raise
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+
+    os.environ['SCHEMA_CHECK_ON_STARTUP'] = 'false'  # importing app.py would otherwise check (or migrate) first
+    from app import app
+
+    with app.app_context():
+        if '--status' in sys.argv:
+            print(f'Current version: {check_schema(db.engine)}, latest: {LATEST_VERSION}')
+        else:
+            applied = upgrade(db.engine, verbose=True)
+            if not applied:
+                print(f'Already at version {LATEST_VERSION}')
@@ -1,9 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, date, timedelta
+from itertools import chain
 from sqlalchemy import UniqueConstraint
 from sqlalchemy.orm import relationship
+from replica import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -14,7 +16,7 @@ class User(db.Model):
 
     avatar_url = db.Column(db.String(200), default='')
     display_name = db.Column(db.String(100), nullable=True)
-    total_steps_life = db.Column(db.Integer, default=0, nullable=False)
+    total_steps_life = db.Column(db.Integer, default=0, nullable=False, index=True)
     current_journey_id = db.Column(db.Integer, db.ForeignKey('journeys.id'), nullable=True)
 
 
@@ -55,17 +57,60 @@ class User(db.Model):
         log = self.step_logs.filter_by(date=today).first()
         return log.steps_count if log else 0
 
-    def get_streak(self):
+    def get_streak(self, today_active=None):
+        """Consecutive active days up to today, in one query (two once the run reaches compacted months).
+
+        `today_active` replaces today's StepLog row, for steps the ledger hasn't folded into it yet (step_ledger.py).
+        """
         today = date.today()
-        streak = 0
-        while True:
-            log = self.step_logs.filter_by(date=today).first()
-            if log and log.steps_count > 0:
-                streak += 1
-                today = today - timedelta(days=1)
-            else:
-                break
-        return streak
+        last_day = today if today_active is None else today - timedelta(days=1)
+        result = db.session.execute(
+            db.select(StepLog.date)
+            .where(StepLog.user_id == self.id, StepLog.date <= last_day, StepLog.steps_count > 0)
+            .order_by(StepLog.date.desc())
+            .execution_options(yield_per=100)
+        ).scalars()
+        try:
+            streak, reached_oldest = daily_streak(today, chain([today], result) if today_active else result)
+        finally:
+            result.close()
+        if not reached_oldest:
+            return streak
+
+        # Older months are compacted into monthly rows that remember their active run up to month end
+        day = today - timedelta(days=streak)
+        months = db.session.execute(
+            db.select(StepLogMonthly.month, StepLogMonthly.trailing_active_days)
+            .where(StepLogMonthly.user_id == self.id, StepLogMonthly.month <= day.replace(day=1))
+            .order_by(StepLogMonthly.month.desc())
+        )
+        return streak + monthly_streak(day, months)
+
+
+def daily_streak(today, active_dates):
+    """(streak, reached_oldest) from active StepLog dates, newest first.
+
+    reached_oldest means the run only ended because the rows did, so it may go on in compacted months.
+    """
+    streak = 0
+    for log_date in active_dates:
+        if log_date != today - timedelta(days=streak):
+            return streak, False
+        streak += 1
+    return streak, True
+
+
+def monthly_streak(day, months):
+    """Active days ending at `day` from compacted (month, trailing_active_days) rows, newest first"""
+    streak = 0
+    for month, trailing_active_days in months:
+        if month != day.replace(day=1) or not trailing_active_days:
+            break
+        streak += min(trailing_active_days, day.day)
+        if trailing_active_days < day.day:
+            break
+        day = month - timedelta(days=1)
+    return streak
 
 class StepLog(db.Model):
     __tablename__ = 'step_logs'
@@ -77,10 +122,13 @@ class StepLog(db.Model):
     distance_miles = db.Column(db.Float, nullable=True)
 
     date = db.Column(db.Date, nullable=False, default = date.today, index=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
 
     source = db.Column(db.String(50), default='healthkit')
-    __table_args__ = (UniqueConstraint('user_id', 'date', name='unique_user_date'),)
+    __table_args__ = (
+        UniqueConstraint('user_id', 'date', name='unique_user_date'),
+        db.Index('ix_step_logs_user_timestamp', 'user_id', 'timestamp'),
+    )
 
     def __init__(self, user_id, steps_count, date=None, **kwargs):
         self.user_id = user_id
@@ -107,6 +155,80 @@ class StepLog(db.Model):
             'source': self.source
         }
 
+class StepEvent(db.Model):
+    """Append-only record of a change to a user's step counts (see step_ledger.py)"""
+    __tablename__ = 'step_events'
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # sync, set, attack
+    steps_delta = db.Column(db.Integer, nullable=False)  # change to the day's StepLog.steps_count
+    lifetime_delta = db.Column(db.Integer, nullable=False, default=0)  # change to User.total_steps_life
+    source = db.Column(db.String(50))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (db.Index('ix_step_events_user_id', 'user_id', 'id'),)
+
+class StepSnapshot(db.Model):
+    """A user's step events folded up to event_id, plus the totals from before the ledger (see step_ledger.py)"""
+    __tablename__ = 'step_snapshots'
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    event_id = db.Column(db.Integer, nullable=False, default=0)
+    event_count = db.Column(db.Integer, nullable=False, default=0)  # ids change when sharding.py moves a user
+    lifetime_steps = db.Column(db.Integer, nullable=False)
+    opening_lifetime_steps = db.Column(db.Integer, nullable=False)
+    opening_date = db.Column(db.Date, nullable=False)
+    opening_day_steps = db.Column(db.Integer, nullable=False, default=0)
+    taken_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (UniqueConstraint('user_id', name='unique_step_snapshot_user'),)
+
+class StepLogMonthly(db.Model):
+    """Monthly rollup of StepLog rows older than the retention window (see retention.py)"""
+    __tablename__ = 'step_log_monthly'
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    month = db.Column(db.Date, nullable=False)
+
+    steps_count = db.Column(db.Integer, nullable=False, default=0)
+    distance_miles = db.Column(db.Float, nullable=False, default=0.0)
+    active_days = db.Column(db.Integer, nullable=False, default=0)
+    trailing_active_days = db.Column(db.Integer, nullable=False, default=0)
+    compacted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint('user_id', 'month', name='unique_user_month'),)
+
+    def __repr__(self):
+        return f"StepLogMonthly {self.user_id}: {self.steps_count} steps in {self.month:%Y-%m}"
+
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'month': self.month.isoformat(),
+            'steps_count': self.steps_count,
+            'distance_miles': round(self.distance_miles, 2),
+            'active_days': self.active_days
+        }
+
+class StepRollup(db.Model):
+    """A user's steps per day, week (from Monday) or month, kept by the ledger fold (see step_series.py)"""
+    __tablename__ = 'step_rollups'
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    period = db.Column(db.String(5), nullable=False)  # day, week, month
+    start = db.Column(db.Date, nullable=False)
+
+    steps_count = db.Column(db.Integer, nullable=False, default=0)
+    distance_miles = db.Column(db.Float, nullable=False, default=0.0)
+    active_days = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (UniqueConstraint('user_id', 'period', 'start', name='unique_user_period_start'),)
+
 class Journey(db.Model):
     __tablename__ = 'journeys'
     id = db.Column(db.Integer, primary_key=True)
@@ -132,6 +254,8 @@ class Journey(db.Model):
     finished_at = db.Column(db.DateTime, nullable=True)
     user = db.relationship('User', foreign_keys=[user_id], backref='personal_journeys')
 
+    __table_args__ = (db.Index('ix_journeys_template_active', 'is_template', 'is_active'),)
+
     def __init__(self, start_city, end_city, total_distance_miles, **kwargs):
         self.start_city = start_city
         self.end_city = end_city
@@ -192,6 +316,12 @@ class Boss(db.Model):
     spawned_at = db.Column(db.DateTime, default=datetime.utcnow)
     defeated_at = db.Column(db.DateTime, nullable=True)
     respawn_hours = db.Column(db.Integer, default=24)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_bosses_active_type', 'is_active', 'boss_type'),
+        db.Index('ix_bosses_updated_at', 'updated_at'),
+    )
 
     def __repr__(self):
         return f'Boss {self.name}: {self.current_health}/{self.max_health} HP'
@@ -296,6 +426,8 @@ class BossAttack(db.Model):
     user = db.relationship('User', backref='boss_attacks')
     boss = db.relationship('Boss', backref='attacks')
 
+    __table_args__ = (db.Index('ix_boss_attacks_boss_user', 'boss_id', 'user_id'),)
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -311,7 +443,7 @@ class BossManager:
     @staticmethod
     def attack_boss(user, boss_id, steps_to_use):
         boss = Boss.query.get(boss_id)
-        if not boss or not boss.is_active or boss.is_defeated():
+        if not BossManager.can_attack(boss):
             return {'error': 'Boss not available for attack'}
 
         user_level = UserLevel.query.filter_by(user_id=user.id).first()
@@ -320,7 +452,20 @@ class BossManager:
             db.session.add(user_level)
             db.session.commit()
 
-        base_damage = steps_to_use
+        attack, outcome = BossManager.strike(user, boss, user_level, steps_to_use)
+        db.session.add(attack)
+        db.session.commit()
+        return BossManager.attack_result(outcome, boss, user, user_level)
+
+    # The steps below don't touch a session, so the async handlers in asgi.py share them
+
+    @staticmethod
+    def can_attack(boss):
+        return boss is not None and boss.is_active and not boss.is_defeated()
+
+    @staticmethod
+    def strike(user, boss, user_level, steps_to_use):
+        """Apply an attack to `boss` and `user_level`; returns the BossAttack to add and the outcome"""
         damage_multiplier = user_level.attack_power
         total_damage = steps_to_use * damage_multiplier
         boss_defeated = boss.take_damage(total_damage)
@@ -332,19 +477,24 @@ class BossManager:
             damage_dealt=total_damage,
             exp_gained=exp
         )
-        db.session.add(attack)
-        level_ups = user_level.add_exp(exp)
-        db.session.commit()
-        result = {
-            'success': True,
+        outcome = {
             'damage_dealt': total_damage,
             'exp_gained': exp,
             'boss_defeated': boss_defeated,
-            'level_ups': level_ups,
+            'level_ups': user_level.add_exp(exp)
+        }
+        return attack, outcome
+
+    @staticmethod
+    def attack_result(outcome, boss, user, user_level):
+        """Response for a committed attack, with the defeat rewards and respawn"""
+        result = {
+            'success': True,
+            **outcome,
             'user_level': user_level.to_dict(),
             'boss_status': boss.to_dict()
         }
-        if boss_defeated:
+        if outcome['boss_defeated']:
             result['boss_rewards'] = BossManager.handle_boss_defeat(boss, user)
             if boss.boss_type == 'Global' and boss.respawn_hours > 0:
                 BossManager.schedule_boss_respawn(boss)
@@ -407,15 +557,53 @@ class Friendship(db.Model):
 
     sent_at = db.Column(db.DateTime, default=datetime.utcnow)
     accepted_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_requests')
     receiver = db.relationship('User', foreign_keys=[receiver_id], backref='received_requests')
 
-    __table_args__ = (UniqueConstraint('sender_id', 'receiver_id', name='unique_friendship'),)
+    __table_args__ = (
+        UniqueConstraint('sender_id', 'receiver_id', name='unique_friendship'),
+        db.Index('ix_friendships_receiver_status', 'receiver_id', 'status'),
+        db.Index('ix_friendships_sender_status', 'sender_id', 'status'),
+        db.Index('ix_friendships_receiver_updated', 'receiver_id', 'updated_at'),
+    )
 
     def __repr__(self):
         return f'Friendship from {self.sender_id} to {self.receiver_id} ({self.status})'
 
+class SyncTombstone(db.Model):
+    """Records a row a user's client must drop on its next `since` sync (see delta_sync.py)"""
+    __tablename__ = 'sync_tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_id = db.Column(db.Integer, nullable=False)
+    entity = db.Column(db.String(30), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (db.Index('ix_sync_tombstones_user_deleted', 'user_id', 'deleted_at'),)
+
+class Job(db.Model):
+    """A background job; claimed, retried and finished by jobs.py"""
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+
+    kind = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    idempotency_key = db.Column(db.String(200), unique=True)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, running, done, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    max_attempts = db.Column(db.Integer, default=5, nullable=False)
+    run_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    locked_until = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(100))
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index('ix_jobs_status_run_at', 'status', 'run_at'),)
+
 class Achievement(db.Model):
     __tablename__ = 'achievements'
     id = db.Column(db.Integer, primary_key=True)
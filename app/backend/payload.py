@@ -0,0 +1,124 @@
+"""
+Smaller responses for mobile clients.
+
+Sparse fieldsets: `?fields=username,streak,badges.name` keeps only the named
+keys. Dotted names pick keys inside a nested object or list of objects. On
+list endpoints (leaderboard, friends) the names refer to the fields of each
+entry. Views pass the parsed selection down to their queries, so unrequested
+columns are never loaded or serialized. Unknown names are a 400.
+
+Compression: JSON responses larger than COMPRESS_MIN_SIZE are encoded with
+brotli (if the optional `brotli` package is installed) or gzip, whichever the
+client's Accept-Encoding prefers.
+"""
+import gzip
+
+from flask import request
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+PROFILE_FIELDS = {
+    'username': None, 'display_name': None, 'total_steps_life': None, 'today_steps': None, 'streak': None,
+    'total_miles': None, 'level': None, 'current_exp': None, 'exp_to_next_level': None,
+    'badges': ('name', 'description'),
+    'current_journey': ('id', 'start_city', 'end_city', 'total_distance_miles', 'personal_progress_miles',
+                        'progress_percentage', 'is_complete'),
+}
+LEADERBOARD_FIELDS = {
+    name: None for name in ('rank', 'user_id', 'username', 'display_name', 'avatar_url', 'steps', 'miles',
+                            'level', 'is_current_user', 'is_friend')
+}
+FRIEND_FIELDS = {
+    name: None for name in ('id', 'username', 'display_name', 'avatar_url', 'total_steps', 'last_active',
+                            'friendship_date')
+}
+
+
+def parse_fields(raw, allowed):
+    """{field: None (whole value) or set of sub-fields}, or None when no selection was made"""
+    if not raw:
+        return None
+    selected = {}
+    for item in raw.split(','):
+        name, _, sub = item.strip().partition('.')
+        if not name:
+            continue
+        if name not in allowed:
+            raise ValueError(f"Unknown field '{name}'")
+        if not sub:
+            selected[name] = None
+            continue
+        if not allowed[name] or sub not in allowed[name]:
+            raise ValueError(f"Unknown field '{name}.{sub}'")
+        if name not in selected:
+            selected[name] = set()
+        if selected[name] is not None:
+            selected[name].add(sub)
+    return selected or None
+
+
+def requested_fields(allowed):
+    return parse_fields(request.args.get('fields'), allowed)
+
+
+def wants(fields, *names):
+    return fields is None or any(name in fields for name in names)
+
+
+def _pick(value, keys):
+    if keys is None or value is None:
+        return value
+    if isinstance(value, list):
+        return [_pick(item, keys) for item in value]
+    return {key: item for key, item in value.items() if key in keys}
+
+
+def select_fields(data, fields):
+    if fields is None:
+        return data
+    return {key: _pick(value, fields[key]) for key, value in data.items() if key in fields}
+
+
+def select_entry_fields(entries, fields):
+    """Field selection for list endpoints, where the names refer to each entry's keys"""
+    return entries if fields is None else [_pick(entry, fields) for entry in entries]
+
+
+def choose_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
+    offers = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return parse_accept_header(accept_encoding).best_match(offers)
+
+
+def compress(body, encoding, config):
+    if encoding == 'br':
+        return brotli.compress(body, quality=config.get('COMPRESS_BROTLI_QUALITY', 4))
+    return gzip.compress(body, compresslevel=config.get('COMPRESS_GZIP_LEVEL', 6))
+
+
+def compress_response(response, config, accept_encoding):
+    if (response.direct_passthrough or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers or response.mimetype not in config.get(
+                'COMPRESS_MIMETYPES', ('application/json',))):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < config.get('COMPRESS_MIN_SIZE', 1024):
+        return response
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None:
+        return response
+    response.set_data(compress(body, encoding, config))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    @app.after_request
+    def compress_json(response):
+        return compress_response(response, app.config, request.headers.get('Accept-Encoding'))
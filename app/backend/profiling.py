@@ -0,0 +1,213 @@
+"""
+On-demand profiling of individual production requests.
+
+A request is profiled in either of two cases:
+
+- it carries an admin-signed `X-Profile` header (see `python profiling.py
+  token`), which needs PROFILING_SECRET to be set
+- it is picked by PROFILING_SAMPLE_RATE
+
+The handler then runs under cProfile and tracemalloc. The results go to
+PROFILING_DIR (in the instance folder), named by time, route and user id:
+
+- `<name>.pstats`: cProfile stats. Open it with snakeviz, or turn it into a
+  flame graph with flameprof or gprof2dot.
+- `<name>.json`: route, user, status, wall and CPU time, peak traced memory,
+  and the top allocation sites.
+
+The response's `X-Profile-Id` header names the files. Each worker profiles
+only one request at a time, because tracemalloc is process-wide. The oldest
+files are removed past PROFILING_MAX_FILES.
+
+Under ASGI, signed requests for the native routes are served by the Flask
+app, so they're profiled on a thread of their own rather than together with
+the other coroutines on the event loop. Sampling only covers requests Flask
+serves.
+
+    python profiling.py token --minutes 30          # value for the X-Profile header
+    python profiling.py show <name>.pstats [--limit 30]
+"""
+import cProfile
+import glob
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+from flask import g, request
+
+HEADER = 'X-Profile'
+
+
+def sign(secret, expires):
+    return hmac.new(secret.encode(), f'profile:{expires}'.encode(), hashlib.sha256).hexdigest()
+
+
+def make_token(secret, minutes=30):
+    expires = int(time.time() + minutes * 60)
+    return f'{expires}.{sign(secret, expires)}'
+
+
+def verify_token(secret, token):
+    if not secret or not token:
+        return False
+    expires, _, signature = token.partition('.')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, sign(secret, int(expires)))
+
+
+class RequestProfiler:
+    def __init__(self):
+        self.app = None
+        self.directory = None
+        self.secret = None
+        self.sample_rate = 0
+        self.max_files = 200
+        self.frames = 10
+        self._busy = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.directory = app.config.get('PROFILING_DIR')
+        if self.directory and not os.path.isabs(self.directory):
+            self.directory = os.path.join(app.instance_path, self.directory)
+        self.secret = app.config.get('PROFILING_SECRET')
+        self.sample_rate = app.config.get('PROFILING_SAMPLE_RATE', 0)
+        self.max_files = app.config.get('PROFILING_MAX_FILES', 200)
+        self.frames = app.config.get('PROFILING_TRACEMALLOC_FRAMES', 10)
+        app.extensions['request_profiler'] = self
+
+        @app.before_request
+        def start_profile():
+            trigger = self.trigger(request.headers.get(HEADER))
+            if trigger and self._busy.acquire(blocking=False):
+                g.profile = self.start(trigger)
+
+        @app.after_request
+        def stop_profile(response):
+            profile = g.pop('profile', None)
+            if profile is not None:
+                response.headers['X-Profile-Id'] = self.finish(profile, response.status_code)
+            return response
+
+        @app.teardown_request
+        def abandon_profile(exc):
+            # after_request doesn't run when the handler raised
+            profile = g.pop('profile', None)
+            if profile is not None:
+                self.finish(profile, 500)
+
+    def signed(self, token):
+        return bool(self.directory) and verify_token(self.secret, token)
+
+    def trigger(self, token):
+        """'header', 'sample' or None"""
+        if not self.directory:
+            return None
+        if token and verify_token(self.secret, token):
+            return 'header'
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return 'sample'
+        return None
+
+    def start(self, trigger):
+        was_tracing = tracemalloc.is_tracing()
+        if was_tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start(self.frames)
+        baseline = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        profile = {
+            'trigger': trigger, 'was_tracing': was_tracing, 'baseline': baseline, 'profiler': profiler,
+            'started': time.perf_counter(), 'cpu_started': time.thread_time(),
+            'memory_started': tracemalloc.get_traced_memory()[0],
+        }
+        profiler.enable()
+        return profile
+
+    def finish(self, profile, status):
+        try:
+            profile['profiler'].disable()
+            duration = time.perf_counter() - profile['started']
+            cpu = time.thread_time() - profile['cpu_started']
+            current, peak = tracemalloc.get_traced_memory()
+            allocations = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            )).compare_to(profile['baseline'], 'lineno')
+            if not profile['was_tracing']:
+                tracemalloc.stop()
+
+            route = request.url_rule.rule if request.url_rule else request.path
+            user_id = g.get('user_id')
+            name = '{}-{}-{}-u{}'.format(
+                datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), request.method.lower(),
+                re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root', user_id or 'anon'
+            )
+            os.makedirs(self.directory, exist_ok=True)
+            profile['profiler'].dump_stats(os.path.join(self.directory, name + '.pstats'))
+            with open(os.path.join(self.directory, name + '.json'), 'w') as f:
+                json.dump({
+                    'method': request.method,
+                    'route': route,
+                    'path': request.full_path.rstrip('?'),
+                    'user_id': user_id,
+                    'status': status,
+                    'trigger': profile['trigger'],
+                    'duration_ms': round(duration * 1000, 3),
+                    'cpu_ms': round(cpu * 1000, 3),
+                    'memory_peak_bytes': peak - profile['memory_started'],
+                    'memory_net_bytes': current - profile['memory_started'],
+                    'top_allocations': [
+                        {'where': str(stat.traceback[0]), 'size_bytes': stat.size_diff, 'count': stat.count_diff}
+                        for stat in allocations[:20] if stat.size_diff > 0
+                    ],
+                    'pstats': name + '.pstats',
+                }, f, indent=2)
+            self._prune()
+            return name
+        finally:
+            self._busy.release()
+
+    def _prune(self):
+        reports = sorted(glob.glob(os.path.join(self.directory, '*.json')))
+        for path in reports[:max(len(reports) - self.max_files, 0)]:
+            for stale in (path, path[:-len('.json')] + '.pstats'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+
+request_profiler = RequestProfiler()
+
+
+if __name__ == '__main__':
+    import argparse
+    import pstats
+
+    parser = argparse.ArgumentParser(description='Request profiling helpers')
+    commands = parser.add_subparsers(dest='command', required=True)
+    token_parser = commands.add_parser('token', help='print a signed X-Profile header value')
+    token_parser.add_argument('--minutes', type=float, default=30, help='how long the token stays valid')
+    show_parser = commands.add_parser('show', help='print the hottest functions of a .pstats file')
+    show_parser.add_argument('path')
+    show_parser.add_argument('--limit', type=int, default=30)
+    show_parser.add_argument('--sort', default='cumulative', help='pstats sort key (cumulative, tottime, ...)')
+    args = parser.parse_args()
+
+    if args.command == 'token':
+        from app import app
+        if not app.config.get('PROFILING_SECRET'):
+            parser.exit(1, 'PROFILING_SECRET is not set\n')
+        print(f'{HEADER}: {make_token(app.config["PROFILING_SECRET"], args.minutes)}')
+    else:
+        pstats.Stats(args.path).strip_dirs().sort_stats(args.sort).print_stats(args.limit)
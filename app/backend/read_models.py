@@ -0,0 +1,249 @@
+"""
+Column-projected queries for the list endpoints.
+
+These select only the columns a response needs and build the response dicts
+straight from the result tuples, skipping ORM identity-map bookkeeping and
+per-field to_dict() work. Dates and datetimes are left as-is for the JSON
+provider (fast_json.py) to encode. The output matches the matching to_dict()
+methods key for key.
+"""
+from sqlalchemy import select, func
+
+from models import db, User, StepLog, Journey, Boss, UserLevel, Friendship, SyncTombstone
+from payload import LEADERBOARD_FIELDS
+
+JOURNEY_COLUMNS = (
+    Journey.id, Journey.start_city, Journey.end_city, Journey.description, Journey.total_distance_miles,
+    Journey.personal_progress_miles, Journey.status, Journey.difficulty, Journey.is_active, Journey.started_at,
+)
+BOSS_COLUMNS = (
+    Boss.id, Boss.name, Boss.description, Boss.max_health, Boss.current_health, Boss.exp_reward,
+    Boss.difficulty, Boss.boss_type, Boss.journey_id, Boss.is_active, Boss.spawned_at, Boss.defeated_at,
+)
+STEP_LOG_COLUMNS = (
+    StepLog.id, StepLog.user_id, StepLog.steps_count, StepLog.distance_miles, StepLog.date,
+    StepLog.timestamp, StepLog.source,
+)
+FRIEND_COLUMNS = (
+    User.id, User.username, User.display_name, User.avatar_url, User.total_steps_life,
+)
+
+
+def journey_templates():
+    rows = db.session.execute(
+        select(*JOURNEY_COLUMNS).where(Journey.is_template == True, Journey.is_active == True)
+    ).all()
+    return [
+        {
+            'id': id, 'start_city': start_city, 'end_city': end_city, 'description': description,
+            'total_distance_miles': total, 'personal_progress_miles': progress, 'status': status,
+            'difficulty': difficulty, 'is_active': is_active, 'created_at': started_at,
+            'progress_percentage': round(progress / total * 100, 2) if total else 0,
+        }
+        for id, start_city, end_city, description, total, progress, status, difficulty, is_active, started_at
+        in rows
+    ]
+
+
+def _boss_scope(statement, journey_id):
+    if journey_id:
+        return statement.where((Boss.journey_id == journey_id) | (Boss.boss_type == 'Global'))
+    return statement.where(Boss.boss_type.in_(['Global', 'Daily']))
+
+
+def available_bosses(journey_id=None):
+    """Same filters as BossManager.get_available_bosses"""
+    statement = _boss_scope(select(*BOSS_COLUMNS).where(Boss.is_active == True, Boss.current_health > 0), journey_id)
+    return _boss_dicts(db.session.execute(statement))
+
+
+def changed_bosses(journey_id, since):
+    """(bosses still available, ids no longer available) among those updated since `since`"""
+    rows = db.session.execute(_boss_scope(select(*BOSS_COLUMNS).where(Boss.updated_at >= since), journey_id)).all()
+    available = [row for row in rows if row.is_active and row.current_health > 0]
+    removed = [row.id for row in rows if not (row.is_active and row.current_health > 0)]
+    return _boss_dicts(available), removed
+
+
+def _boss_dicts(rows):
+    return [
+        {
+            'id': id, 'name': name, 'description': description, 'max_health': max_health,
+            'current_health': current_health,
+            'health_percentage': current_health / max_health * 100 if max_health else 0,
+            'exp_reward': exp_reward, 'difficulty': difficulty, 'boss_type': boss_type, 'journey_id': journey_id,
+            'is_active': is_active, 'is_defeated': current_health < 0 or not is_active,
+            'spawned_at': spawned_at, 'defeated_at': defeated_at,
+        }
+        for id, name, description, max_health, current_health, exp_reward, difficulty, boss_type, journey_id,
+        is_active, spawned_at, defeated_at in rows
+    ]
+
+
+def step_history(user_id, days, since=None):
+    statement = select(*STEP_LOG_COLUMNS).where(StepLog.user_id == user_id)
+    if since is not None:
+        statement = statement.where(StepLog.timestamp >= since)
+    rows = db.session.execute(statement.order_by(StepLog.date.desc()).limit(days)).all()
+    return [
+        {
+            'id': id, 'user_id': log_user_id, 'steps_count': steps_count,
+            'distance_miles': round(distance, 2) if distance else 0, 'date': log_date,
+            'timestamp': timestamp, 'source': source,
+        }
+        for id, log_user_id, steps_count, distance, log_date, timestamp, source in rows
+    ]
+
+
+def all_time_totals(user_ids=None, limit=None):
+    """(user_id, total_steps_life) ranked in SQL, plus the number of users with any steps"""
+    criteria = [User.total_steps_life > 0]
+    if user_ids:
+        criteria.append(User.id.in_(user_ids))
+    ranked = db.session.execute(
+        select(User.id, User.total_steps_life).where(*criteria)
+        .order_by(User.total_steps_life.desc(), User.id).limit(limit)
+    ).all()
+    total = db.session.execute(select(func.count()).select_from(User).where(*criteria)).scalar()
+    return ranked, total
+
+
+def leaderboard_entries(totals, current_user_id, friend_ids=None, limit=10, fields=None):
+    """Rank (user_id, steps) pairs and load display fields for the top `limit` in one query.
+
+    `fields` (see payload.py) limits both the selected columns and the keys of each entry.
+    """
+    ranked = sorted(((uid, steps) for uid, steps in totals if steps > 0), key=lambda row: (-row[1], row[0]))
+    top = ranked[:limit]
+    wanted = fields if fields is not None else LEADERBOARD_FIELDS
+
+    columns = [User.id, User.username, User.display_name] if 'username' in wanted or 'display_name' in wanted \
+        else [User.id]
+    if 'avatar_url' in wanted:
+        columns.append(User.avatar_url)
+    statement = select(*columns).where(User.id.in_([uid for uid, _ in top]))
+    if 'level' in wanted:
+        statement = statement.add_columns(UserLevel.current_level).outerjoin(UserLevel, UserLevel.user_id == User.id)
+    profiles = {row.id: row._mapping for row in db.session.execute(statement)} if top else {}
+
+    entries = []
+    for uid, steps in top:
+        profile = profiles.get(uid)
+        if profile is None:
+            continue
+        entry = {
+            'rank': len(entries) + 1,
+            'user_id': uid,
+            'username': profile.get('username'),
+            'display_name': profile.get('display_name') or profile.get('username'),
+            'avatar_url': profile.get('avatar_url'),
+            'steps': steps,
+            'miles': round(steps / 2000, 2),
+            'level': profile.get('current_level') or 1,
+            'is_current_user': uid == current_user_id,
+            'is_friend': uid in friend_ids if friend_ids is not None else False,
+        }
+        entries.append(entry if fields is None else {key: entry[key] for key in entry if key in fields})
+    return entries, len(ranked)
+
+
+def friend_ids(user_id):
+    rows = db.session.execute(
+        select(Friendship.sender_id, Friendship.receiver_id).where(
+            db.or_(
+                db.and_(Friendship.sender_id == user_id, Friendship.status == 'accepted'),
+                db.and_(Friendship.receiver_id == user_id, Friendship.status == 'accepted'),
+            )
+        )
+    )
+    return {receiver_id if sender_id == user_id else sender_id for sender_id, receiver_id in rows}
+
+
+def _friend_columns(fields):
+    if fields is None:
+        return FRIEND_COLUMNS
+    columns = [User.id]
+    if 'username' in fields or 'display_name' in fields:
+        columns += [User.username, User.display_name]
+    if 'avatar_url' in fields:
+        columns.append(User.avatar_url)
+    if 'total_steps' in fields:
+        columns.append(User.total_steps_life)
+    return columns
+
+
+def _friend_dict(row, fields):
+    data = {
+        'id': row['id'],
+        'username': row.get('username'),
+        'display_name': row.get('display_name') or row.get('username'),
+        'avatar_url': row.get('avatar_url'),
+        'total_steps': row.get('total_steps_life'),
+    }
+    return data if fields is None else {key: value for key, value in data.items() if key in fields}
+
+
+def friends(user_id, fields=None, since=None):
+    """Accepted friends; with `since`, only those whose friendship or profile changed"""
+    columns = list(_friend_columns(fields))
+    if fields is None or 'last_active' in fields:
+        columns.append(User.last_active)
+    rows = []
+    for own_side, other_side in ((Friendship.sender_id, Friendship.receiver_id),
+                                 (Friendship.receiver_id, Friendship.sender_id)):
+        statement = (
+            select(Friendship.id.label('friendship_id'), Friendship.accepted_at, *columns)
+            .join(User, User.id == other_side)
+            .where(own_side == user_id, Friendship.status == 'accepted')
+        )
+        if since is not None:
+            statement = statement.where((Friendship.updated_at >= since) | (User.last_active >= since))
+        rows += db.session.execute(statement).all()
+    rows.sort(key=lambda row: row.friendship_id)
+
+    result = []
+    for row in rows:
+        row = row._mapping
+        friend = _friend_dict(row, fields)
+        if fields is None or 'last_active' in fields:
+            friend['last_active'] = row['last_active']
+        if fields is None or 'friendship_date' in fields:
+            friend['friendship_date'] = row['accepted_at']
+        result.append(friend)
+    return result
+
+
+def pending_requests(user_id, fields=None, since=None):
+    """Received requests; `fields` trims each sender the same way as friends()"""
+    statement = (
+        select(Friendship.id.label('request_id'), Friendship.sent_at, *_friend_columns(fields))
+        .join(User, User.id == Friendship.sender_id)
+        .where(Friendship.receiver_id == user_id, Friendship.status == 'pending')
+    )
+    if since is not None:
+        statement = statement.where(Friendship.updated_at >= since)
+    rows = db.session.execute(statement.order_by(Friendship.id))
+    return [
+        {'id': row.request_id, 'sender': _friend_dict(row._mapping, fields), 'sent_at': row.sent_at}
+        for row in rows
+    ]
+
+
+def accepted_request_ids(user_id, since):
+    """Requests this user received that were accepted since `since` (they moved to the friends list)"""
+    return db.session.execute(
+        select(Friendship.id).where(
+            Friendship.receiver_id == user_id, Friendship.updated_at >= since, Friendship.status == 'accepted'
+        )
+    ).scalars().all()
+
+
+def tombstones(user_id, since):
+    """{entity: [entity_id, ...]} deleted for this user since `since`"""
+    removed = {}
+    for entity, entity_id in db.session.execute(
+        select(SyncTombstone.entity, SyncTombstone.entity_id)
+        .where(SyncTombstone.user_id == user_id, SyncTombstone.deleted_at >= since)
+    ):
+        removed.setdefault(entity, []).append(entity_id)
+    return removed
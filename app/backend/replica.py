@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Read/write session routing for a read replica.
+
+When REPLICA_DATABASE_URL is set the replica is registered as the 'replica'
+bind. Views wrapped in @use_replica (and the token_required user lookup inside
+them) send their SELECTs to it; flushes, non-SELECT statements and anything
+after the session has written still go to the primary.
+
+A response to a request that wrote carries the time of the write, as the
+`stepup_last_write` cookie and the X-StepUp-Last-Write header. A client that
+sends either back keeps reading from the primary for
+REPLICA_READ_YOUR_WRITES_SECONDS so it sees its own updates, whichever worker
+or server its next request lands on. The marker is a wall-clock timestamp
+signed with SECRET_KEY for the user who wrote, so clients can't forge one to
+pin their reads to the primary, and app servers' clocks need to agree to well
+within that window.
+
+For local testing a second SQLite file stands in for the replica:
+
+    python replica.py --sync-every 2   # copy the primary into the replica file
+"""
+import hashlib
+import hmac
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, request, has_request_context, current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+from sharding import shard_router, sharded_table_for, current_shard_user
+
+REPLICA_BIND = 'replica'
+WRITE_COOKIE = 'stepup_last_write'
+WRITE_HEADER = 'X-StepUp-Last-Write'
+
+
+def sign(secret, user_id, wrote_at):
+    return hmac.new(secret.encode(), f'write:{user_id}:{wrote_at}'.encode(), hashlib.sha256).hexdigest()
+
+
+def make_marker(secret, user_id, wrote_at):
+    wrote_at = f'{wrote_at:.3f}'
+    return f'{wrote_at}:{sign(secret, user_id, wrote_at)}'
+
+
+def verify_marker(secret, user_id, marker):
+    """Unix time in a marker signed for `user_id`; 0 if it is missing, malformed or forged"""
+    if not secret or not user_id or not marker:
+        return 0.0
+    wrote_at, _, signature = marker.partition(':')
+    try:
+        value = float(wrote_at)
+    except ValueError:
+        return 0.0
+    if not hmac.compare_digest(signature, sign(secret, user_id, wrote_at)):
+        return 0.0
+    return value
+
+
+def last_write():
+    """Unix time of the signed-in user's last write, from the marker the client sent back; 0 without one"""
+    secret = current_app.config.get('SECRET_KEY')
+    user_id = g.get('user_id')
+    return max(verify_marker(secret, user_id, value)
+               for value in (request.cookies.get(WRITE_COOKIE), request.headers.get(WRITE_HEADER)))
+
+
+def _replica_allowed(session):
+    if not has_request_context() or not g.get('use_replica'):
+        return False
+    if session.info.get('wrote'):
+        return False
+    window = current_app.config.get('REPLICA_READ_YOUR_WRITES_SECONDS', 5)
+    return time.time() - last_write() >= window
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and shard_router.enabled and sharded_table_for(mapper, clause):
+            return shard_router.engine_for_user(current_shard_user())
+        if (bind is None and not self._flushing and getattr(clause, 'is_select', False)
+                and _replica_allowed(self)):
+            engine = self._db.engines.get(REPLICA_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_write(session, flush_context):
+    session.info['wrote'] = True
+    if has_request_context():
+        g.wrote_at = time.time()
+
+
+def use_replica(f):
+    """Route this view's reads to the replica bind when one is configured"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.use_replica = True
+        return f(*args, **kwargs)
+    return decorated
+
+
+@contextmanager
+def primary_reads():
+    """Read from the primary inside a replica view, e.g. for get-or-create lookups"""
+    previous = g.get('use_replica')
+    g.use_replica = False
+    try:
+        yield
+    finally:
+        g.use_replica = previous
+
+
+def init_app(app):
+    """Send the write marker back to clients when a replica is configured"""
+    if REPLICA_BIND not in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        return
+
+    @app.after_request
+    def send_write_marker(response):
+        wrote_at, user_id = g.get('wrote_at'), g.get('user_id')
+        if wrote_at and user_id:
+            window = app.config.get('REPLICA_READ_YOUR_WRITES_SECONDS', 5)
+            marker = make_marker(app.config['SECRET_KEY'], user_id, wrote_at)
+            response.set_cookie(WRITE_COOKIE, marker, max_age=window, httponly=True, samesite='Lax')
+            response.headers[WRITE_HEADER] = marker
+        return response
+
+
+def configure_binds(config, replica_url):
+    if replica_url:
+        binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+        binds[REPLICA_BIND] = replica_url
+        config['SQLALCHEMY_BINDS'] = binds
+
+
+def sync_sqlite_replica(primary_path, replica_path):
+    """Copy a SQLite primary into the stand-in replica file with the online backup API"""
+    import sqlite3
+
+    source = sqlite3.connect(primary_path)
+    target = sqlite3.connect(replica_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    from app import app
+    from models import db
+
+    parser = argparse.ArgumentParser(description='Refresh the local SQLite stand-in replica')
+    parser.add_argument('--sync-every', type=float, default=0, help='seconds between copies (0 = once)')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if REPLICA_BIND not in db.engines:
+            raise SystemExit('REPLICA_DATABASE_URL is not set')
+        primary = db.engines[None].url.database
+        replica_path = db.engines[REPLICA_BIND].url.database
+
+    while True:
+        sync_sqlite_replica(primary, replica_path)
+        print(f'Copied {primary} -> {replica_path}')
+        if not args.sync_every:
+            break
+        time.sleep(args.sync_every)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Retention and compaction job for old history rows.
+
+- StepLog rows older than RETENTION_STEP_LOG_MONTHS are rolled into one
+  StepLogMonthly row per user and month. User.total_steps_life is stored
+  separately, and each monthly row keeps its run of active days up to month
+  end so get_streak stays exact across compacted months. Their day and week
+  rollups go too; month rollups stay (see step_series.py).
+- BossAttack rows of bosses defeated more than RETENTION_BOSS_ATTACK_DAYS ago
+  are appended to gzip JSON-lines files under ARCHIVE_DIR/boss_attacks and
+  then deleted.
+- Finished personal journeys older than RETENTION_JOURNEY_DAYS that nothing
+  references any more go to ARCHIVE_DIR/journeys the same way.
+- Delta sync tombstones older than RETENTION_TOMBSTONE_DAYS are deleted;
+  cursors that old get a full response anyway (see delta_sync.py).
+- Finished background jobs older than RETENTION_JOB_DAYS are deleted, which
+  also frees their idempotency keys (see jobs.py).
+
+Everything runs in bounded chunks, each in its own transaction, so the job can
+be stopped and rerun at any point. Archive files are written before the rows
+are deleted; a rerun after a crash in between may append a record twice, so
+readers dedupe on `id`.
+
+    python retention.py                  # one pass
+    python retention.py --loop-hours 24  # keep running, one pass a day
+    python retention.py --vacuum         # VACUUM SQLite databases afterwards
+"""
+import gzip
+import json
+import os
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import select, func, delete, update, case, and_, or_
+
+from models import db, StepLog, StepLogMonthly, StepRollup, BossAttack, Boss, Journey, User, SyncTombstone, Job
+from sharding import shard_router
+
+
+def step_engines():
+    """Engines holding the per-user history tables"""
+    return shard_router.engines if shard_router.enabled else [db.engine]
+
+
+def months_ago(today, months):
+    month_index = today.year * 12 + (today.month - 1) - months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def next_month(month):
+    return (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def _trailing_active_days(connection, in_month, user_ids, month_end):
+    """Consecutive active days ending on the month's last day, per user (keeps streaks exact)"""
+    logs = StepLog.__table__
+    active = {}
+    for user_id, log_date in connection.execute(
+        select(logs.c.user_id, logs.c.date).where(in_month, logs.c.user_id.in_(user_ids), logs.c.steps_count > 0)
+    ):
+        if isinstance(log_date, str):
+            log_date = date.fromisoformat(log_date)
+        active.setdefault(user_id, set()).add(log_date)
+
+    trailing = {}
+    for user_id in user_ids:
+        days, day = 0, month_end - timedelta(days=1)
+        while day in active.get(user_id, ()):
+            days += 1
+            day -= timedelta(days=1)
+        trailing[user_id] = days
+    return trailing
+
+
+def compact_step_logs(engine, cutoff, chunk_size):
+    """Roll daily rows dated before `cutoff` (a month start) into monthly rows"""
+    logs = StepLog.__table__
+    monthly = StepLogMonthly.__table__
+    users_per_chunk = max(1, chunk_size // 31)
+    compacted = 0
+
+    with engine.connect() as connection:
+        oldest = connection.execute(select(func.min(logs.c.date)).where(logs.c.date < cutoff)).scalar()
+    if oldest is None:
+        return 0
+    if isinstance(oldest, str):
+        oldest = date.fromisoformat(oldest)
+
+    month = oldest.replace(day=1)
+    while month < cutoff:
+        month_end = next_month(month)
+        in_month = and_(logs.c.date >= month, logs.c.date < month_end)
+        last_user_id = 0
+        while True:
+            with engine.begin() as connection:
+                rows = connection.execute(
+                    select(
+                        logs.c.user_id,
+                        func.sum(logs.c.steps_count),
+                        func.sum(func.coalesce(logs.c.distance_miles, 0.0)),
+                        func.sum(case((logs.c.steps_count > 0, 1), else_=0)),
+                        func.count(),
+                    )
+                    .where(in_month, logs.c.user_id > last_user_id)
+                    .group_by(logs.c.user_id)
+                    .order_by(logs.c.user_id)
+                    .limit(users_per_chunk)
+                ).all()
+                if not rows:
+                    break
+
+                user_ids = [row[0] for row in rows]
+                trailing = _trailing_active_days(connection, in_month, user_ids, month_end)
+                existing = set(connection.execute(
+                    select(monthly.c.user_id).where(monthly.c.month == month, monthly.c.user_id.in_(user_ids))
+                ).scalars())
+                inserts = []
+                for user_id, steps, distance, active_days, _ in rows:
+                    if user_id in existing:
+                        connection.execute(
+                            update(monthly)
+                            .where(monthly.c.user_id == user_id, monthly.c.month == month)
+                            .values(steps_count=monthly.c.steps_count + steps,
+                                    distance_miles=monthly.c.distance_miles + distance,
+                                    active_days=monthly.c.active_days + active_days,
+                                    trailing_active_days=case(
+                                        (monthly.c.trailing_active_days > trailing[user_id],
+                                         monthly.c.trailing_active_days),
+                                        else_=trailing[user_id]),
+                                    compacted_at=datetime.utcnow())
+                        )
+                    else:
+                        inserts.append({'user_id': user_id, 'month': month, 'steps_count': steps,
+                                        'distance_miles': distance, 'active_days': active_days,
+                                        'trailing_active_days': trailing[user_id],
+                                        'compacted_at': datetime.utcnow()})
+                if inserts:
+                    connection.execute(monthly.insert(), inserts)
+                connection.execute(delete(logs).where(
+                    in_month, logs.c.user_id >= user_ids[0], logs.c.user_id <= user_ids[-1]
+                ))
+                compacted += sum(row[4] for row in rows)
+                last_user_id = user_ids[-1]
+        month = month_end
+    return compacted
+
+
+def prune_rollups(engine, cutoff, chunk_size):
+    """Drop day and week rollups that end before `cutoff`, whose daily rows compact_step_logs rolled up"""
+    rollups = StepRollup.__table__
+    stale = or_(
+        and_(rollups.c.period == 'day', rollups.c.start < cutoff),
+        and_(rollups.c.period == 'week', rollups.c.start <= cutoff - timedelta(days=7)),
+    )
+    pruned = 0
+    while True:
+        with engine.begin() as connection:
+            ids = connection.execute(select(rollups.c.id).where(stale).limit(chunk_size)).scalars().all()
+            if not ids:
+                break
+            connection.execute(delete(rollups).where(rollups.c.id.in_(ids)))
+            pruned += len(ids)
+    return pruned
+
+
+def _archive_path(app, *parts):
+    archive_dir = app.config.get('ARCHIVE_DIR', 'archive')
+    if not os.path.isabs(archive_dir):
+        archive_dir = os.path.join(app.instance_path, archive_dir)
+    path = os.path.join(archive_dir, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def _append_archive(path, rows):
+    with gzip.open(path, 'at', encoding='utf-8') as archive:
+        for row in rows:
+            archive.write(json.dumps(dict(row._mapping), default=str) + '\n')
+
+
+def archive_boss_attacks(app, engine, cutoff, chunk_size, shard_index=0):
+    attacks = BossAttack.__table__
+    bosses = Boss.__table__
+    with db.engine.connect() as connection:
+        boss_ids = connection.execute(
+            select(bosses.c.id).where(bosses.c.is_active == False, bosses.c.defeated_at < cutoff)
+        ).scalars().all()
+
+    archived = 0
+    for boss_id in boss_ids:
+        path = _archive_path(app, 'boss_attacks', f'boss_{boss_id}.{shard_index}.jsonl.gz')
+        while True:
+            with engine.begin() as connection:
+                rows = connection.execute(
+                    select(attacks).where(attacks.c.boss_id == boss_id).order_by(attacks.c.id).limit(chunk_size)
+                ).all()
+                if not rows:
+                    break
+                _append_archive(path, rows)
+                connection.execute(delete(attacks).where(attacks.c.id.in_([row.id for row in rows])))
+                archived += len(rows)
+    return archived
+
+
+def archive_journeys(app, cutoff, chunk_size):
+    journeys = Journey.__table__
+    referenced = select(User.__table__.c.current_journey_id).where(User.__table__.c.current_journey_id.isnot(None))
+    boss_journeys = select(Boss.__table__.c.journey_id).where(Boss.__table__.c.journey_id.isnot(None))
+
+    archived = 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(
+                select(journeys).where(
+                    journeys.c.is_template == False,
+                    journeys.c.finished_at < cutoff,
+                    journeys.c.id.notin_(referenced),
+                    journeys.c.id.notin_(boss_journeys),
+                ).order_by(journeys.c.id).limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+            _append_archive(_archive_path(app, 'journeys', f'{cutoff:%Y-%m-%d}.jsonl.gz'), rows)
+            connection.execute(delete(journeys).where(journeys.c.id.in_([row.id for row in rows])))
+            archived += len(rows)
+    return archived
+
+
+def purge_tombstones(cutoff, chunk_size):
+    tombstones = SyncTombstone.__table__
+    purged = 0
+    while True:
+        with db.engine.begin() as connection:
+            ids = connection.execute(
+                select(tombstones.c.id).where(tombstones.c.deleted_at < cutoff).limit(chunk_size)
+            ).scalars().all()
+            if not ids:
+                break
+            connection.execute(delete(tombstones).where(tombstones.c.id.in_(ids)))
+            purged += len(ids)
+    return purged
+
+
+def purge_jobs(cutoff, chunk_size):
+    jobs = Job.__table__
+    purged = 0
+    while True:
+        with db.engine.begin() as connection:
+            ids = connection.execute(
+                select(jobs.c.id).where(jobs.c.status == 'done', jobs.c.finished_at < cutoff).limit(chunk_size)
+            ).scalars().all()
+            if not ids:
+                break
+            connection.execute(delete(jobs).where(jobs.c.id.in_(ids)))
+            purged += len(ids)
+    return purged
+
+
+def run_retention(app, vacuum=False):
+    config = app.config
+    chunk_size = config.get('RETENTION_CHUNK_SIZE', 5000)
+    now = datetime.utcnow()
+    step_cutoff = months_ago(date.today(), config.get('RETENTION_STEP_LOG_MONTHS', 13))
+    attack_cutoff = now - timedelta(days=config.get('RETENTION_BOSS_ATTACK_DAYS', 30))
+    journey_cutoff = now - timedelta(days=config.get('RETENTION_JOURNEY_DAYS', 90))
+    tombstone_cutoff = now - timedelta(days=config.get('RETENTION_TOMBSTONE_DAYS', 30))
+    job_cutoff = now - timedelta(days=config.get('RETENTION_JOB_DAYS', 7))
+
+    stats = {'step_logs_compacted': 0, 'rollups_pruned': 0, 'boss_attacks_archived': 0, 'journeys_archived': 0,
+             'tombstones_purged': 0, 'jobs_purged': 0}
+    with app.app_context():
+        for index, engine in enumerate(step_engines()):
+            stats['step_logs_compacted'] += compact_step_logs(engine, step_cutoff, chunk_size)
+            stats['rollups_pruned'] += prune_rollups(engine, step_cutoff, chunk_size)
+            stats['boss_attacks_archived'] += archive_boss_attacks(app, engine, attack_cutoff, chunk_size, index)
+        stats['journeys_archived'] = archive_journeys(app, journey_cutoff, chunk_size)
+        stats['tombstones_purged'] = purge_tombstones(tombstone_cutoff, chunk_size)
+        stats['jobs_purged'] = purge_jobs(job_cutoff, chunk_size)
+
+        if vacuum:
+            for engine in set(step_engines()) | {db.engine}:
+                if engine.dialect.name == 'sqlite':
+                    with engine.connect() as connection:
+                        connection.exec_driver_sql('VACUUM')
+    return stats
+
+
+if __name__ == '__main__':
+    import argparse
+    from app import app
+
+    parser = argparse.ArgumentParser(description='Compact and archive old history rows')
+    parser.add_argument('--loop-hours', type=float, default=0, help='repeat every N hours (0 = run once)')
+    parser.add_argument('--vacuum', action='store_true', help='VACUUM SQLite databases after the pass')
+    args = parser.parse_args()
+
+    while True:
+        started = time.perf_counter()
+        stats = run_retention(app, vacuum=args.vacuum)
+        print(f'{datetime.utcnow():%Y-%m-%d %H:%M:%S} retention pass in {time.perf_counter() - started:.1f}s: {stats}')
+        if not args.loop_hours:
+            break
+        time.sleep(args.loop_hours * 3600)
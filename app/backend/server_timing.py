@@ -0,0 +1,82 @@
+"""
+Server-Timing response headers for tracing slow screens from the client.
+
+    Server-Timing: auth;dur=1.2, db;dur=4.0, app;dur=2.1, serialize;dur=0.6, total;dur=7.9
+
+- auth: token decode and user load in token_required, including its query
+- db: time in database statements outside auth
+- serialize: encoding the JSON body
+- app: the rest of the handler, i.e. total minus the phases above
+- total: from the start of the request until the header is added (before
+  compression)
+
+Durations are in milliseconds. They come from the per-request stats kept by
+metrics.py, so this only works for requests that go through its middleware
+(or StepUpASGI).
+
+Headers are sent on every response when SERVER_TIMING_ENABLED is on, on a
+random SERVER_TIMING_SAMPLE_RATE share of responses, or when the request
+sends `X-Server-Timing: 1` and SERVER_TIMING_ALLOW_REQUEST is on (not by
+default in production).
+"""
+import random
+import time
+from contextlib import contextmanager
+
+from flask import request
+
+from metrics import current_stats
+
+REQUEST_HEADER = 'X-Server-Timing'
+PHASE_ORDER = ('auth', 'db', 'app', 'serialize', 'total')
+
+
+@contextmanager
+def phase(name):
+    """Attribute the time spent in the block (and the queries it ran) to `name`"""
+    stats = current_stats()
+    if stats is None:
+        yield
+        return
+    started, query_seconds = time.perf_counter(), stats.query_seconds
+    try:
+        yield
+    finally:
+        wall, db = stats.phases.get(name, (0.0, 0.0))
+        stats.phases[name] = (wall + time.perf_counter() - started, db + stats.query_seconds - query_seconds)
+
+
+def timing_header(stats):
+    total = time.perf_counter() - stats.started
+    durations = {name: wall for name, (wall, _) in stats.phases.items()}
+    durations['db'] = stats.query_seconds - sum(db for _, db in stats.phases.values())
+    durations['app'] = max(total - sum(durations.values()), 0.0)
+    durations['total'] = total
+    names = [name for name in PHASE_ORDER if name in durations] + sorted(set(durations) - set(PHASE_ORDER))
+    return ', '.join(f'{name};dur={durations[name] * 1000:.1f}' for name in names)
+
+
+def wanted(config, requested):
+    if config.get('SERVER_TIMING_ENABLED'):
+        return True
+    if requested == '1' and config.get('SERVER_TIMING_ALLOW_REQUEST', False):
+        return True
+    rate = config.get('SERVER_TIMING_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+def add_header(headers, config, requested):
+    """Set Server-Timing on a headers mapping if this response should carry it"""
+    stats = current_stats()
+    if stats is None or not wanted(config, requested):
+        return
+    headers['Server-Timing'] = timing_header(stats)
+    headers['Timing-Allow-Origin'] = '*'
+
+
+def init_app(app):
+    # Registered after payload.init_app, so it runs before compression
+    @app.after_request
+    def add_server_timing(response):
+        add_header(response.headers, app.config, request.headers.get(REQUEST_HEADER))
+        return response
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+User-id sharding for step_logs and their rollups, the step ledger and boss_attacks.
+
+With STEP_SHARD_URLS set (comma separated), rows of the sharded tables live on
+the shard picked by a jump consistent hash of their user_id. RoutingSession
+sends ORM statements on those tables to the current user's shard (the user
+from token_required, or `with shard_for_user(uid):` outside a request), and
+cross-user aggregates such as the leaderboard fan out with `step_totals`.
+
+Local testing uses several SQLite files:
+
+    STEP_SHARD_URLS=sqlite:///shard0.db,sqlite:///shard1.db python sharding.py init
+    python sharding.py migrate --from primary    # move existing rows off the primary
+    python sharding.py migrate --from-count 2    # rebalance after adding shards
+    python sharding.py status
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import g, has_request_context
+from sqlalchemy import (
+    create_engine, select, func, delete, MetaData, Table, Column, Index, UniqueConstraint
+)
+from sqlalchemy.engine import make_url
+
+# step_events before step_snapshots: migrate_rows renumbers snapshots against the events already moved
+SHARDED_TABLES = ('step_logs', 'step_log_monthly', 'step_rollups', 'step_events', 'step_snapshots', 'boss_attacks')
+
+_shard_user = ContextVar('shard_user', default=None)
+
+
+class NoShardKey(RuntimeError):
+    pass
+
+
+def jump_hash(key, num_buckets):
+    """Jump consistent hash: growing from n to n+1 shards only moves 1/(n+1) of the users"""
+    b, j = -1, 0
+    key = key & 0xFFFFFFFFFFFFFFFF
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777866503 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+@contextmanager
+def shard_for_user(user_id):
+    token = _shard_user.set(user_id)
+    try:
+        yield
+    finally:
+        _shard_user.reset(token)
+
+
+def current_shard_user():
+    user_id = _shard_user.get()
+    if user_id is None and has_request_context():
+        user_id = g.get('user_id')
+    return user_id
+
+
+def shard_metadata():
+    """Copies of the sharded tables without foreign keys to tables that live on the primary"""
+    from models import db
+
+    metadata = MetaData()
+    for name in SHARDED_TABLES:
+        source = db.metadata.tables[name]
+        columns = [
+            Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable, index=c.index)
+            for c in source.columns
+        ]
+        constraints = [
+            UniqueConstraint(*[c.name for c in constraint.columns], name=constraint.name)
+            for constraint in source.constraints if isinstance(constraint, UniqueConstraint)
+        ]
+        table = Table(name, metadata, *columns, *constraints)
+        for index in source.indexes:
+            index_columns = list(index.columns)
+            if len(index_columns) == 1 and index_columns[0].index:
+                continue  # already created by the column's index=True
+            Index(index.name, *[table.c[c.name] for c in index_columns], unique=index.unique)
+    return metadata
+
+
+class ShardRouter:
+    def __init__(self):
+        self.engines = []
+
+    @property
+    def enabled(self):
+        return bool(self.engines)
+
+    def init_app(self, app):
+        from engine_profile import build_engine_options, install_sqlite_pragmas
+
+        self.engines = []
+        for url in app.config.get('STEP_SHARD_URLS') or []:
+            url = make_url(url)
+            if url.get_backend_name() == 'sqlite' and url.database and not os.path.isabs(url.database):
+                os.makedirs(app.instance_path, exist_ok=True)
+                url = url.set(database=os.path.join(app.instance_path, url.database))
+            config = dict(app.config, SQLALCHEMY_DATABASE_URI=str(url), SQLALCHEMY_ENGINE_OPTIONS={})
+            engine = create_engine(url, **build_engine_options(config))
+            install_sqlite_pragmas(engine, app.config)
+            self.engines.append(engine)
+        app.extensions['shard_router'] = self
+
+    def shard_index(self, user_id, count=None):
+        return jump_hash(int(user_id), count or len(self.engines))
+
+    def engine_for_user(self, user_id):
+        if user_id is None:
+            raise NoShardKey('Sharded tables need a user context (token_required or shard_for_user)')
+        return self.engines[self.shard_index(user_id)]
+
+    def fan_out(self, statement):
+        """Run a read on every shard in parallel and return all rows"""
+        def run(engine):
+            with engine.connect() as connection:
+                return connection.execute(statement).all()
+
+        with ThreadPoolExecutor(max_workers=len(self.engines)) as pool:
+            return [row for rows in pool.map(run, self.engines) for row in rows]
+
+    def create_all(self):
+        metadata = shard_metadata()
+        for engine in self.engines:
+            metadata.create_all(engine)
+            # create_all skips existing tables, so add indexes declared since they were created
+            for table in metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(engine, checkfirst=True)
+
+
+shard_router = ShardRouter()
+
+
+def sharded_table_for(mapper, clause):
+    """Name of the sharded table a statement targets, or None"""
+    if mapper is not None:
+        from sqlalchemy import inspect
+        name = inspect(mapper).local_table.name
+        if name in SHARDED_TABLES:
+            return name
+    if clause is not None:
+        for table in getattr(clause, 'get_final_froms', lambda: [])():
+            if getattr(table, 'name', None) in SHARDED_TABLES:
+                return table.name
+    return None
+
+
+def step_totals(start_date, end_date=None, user_ids=None):
+    """(user_id, total_steps) per user for a date range, fanned out across shards when enabled"""
+    from models import db, StepLog
+
+    table = StepLog.__table__
+    statement = select(table.c.user_id, func.sum(table.c.steps_count).label('total_steps'))
+    statement = statement.where(table.c.date >= start_date)
+    if end_date is not None:
+        statement = statement.where(table.c.date <= end_date)
+    if user_ids:
+        statement = statement.where(table.c.user_id.in_(user_ids))
+    statement = statement.group_by(table.c.user_id)
+
+    if not shard_router.enabled:
+        return db.session.execute(statement).all()
+
+    totals = {}
+    for user_id, total_steps in shard_router.fan_out(statement):
+        totals[user_id] = totals.get(user_id, 0) + total_steps
+    return list(totals.items())
+
+
+def renumber_snapshot(connection, metadata, user_id):
+    """Point a moved snapshot at the new id of the last event it folded (events keep their order when copied)"""
+    events, snapshots = metadata.tables['step_events'], metadata.tables['step_snapshots']
+    count = connection.execute(select(snapshots.c.event_count).where(snapshots.c.user_id == user_id)).scalar()
+    event_id = 0
+    if count:
+        event_id = connection.execute(
+            select(events.c.id).where(events.c.user_id == user_id).order_by(events.c.id).offset(count - 1).limit(1)
+        ).scalar()
+    connection.execute(snapshots.update().where(snapshots.c.user_id == user_id).values(event_id=event_id))
+
+
+def migrate_rows(source_engines, chunk_size=1000, verbose=True):
+    """Move each user's rows to their home shard under the current layout.
+
+    Rows are copied without their ids (each shard has its own sequence), in id
+    order, then deleted from the source. Any rows already on the target for a user being
+    moved come from an interrupted run and are replaced.
+    """
+    metadata = shard_metadata()
+    moved = 0
+    for source in source_engines:
+        for name in SHARDED_TABLES:
+            table = metadata.tables[name]
+            with source.connect() as connection:
+                user_ids = connection.execute(select(table.c.user_id).distinct()).scalars().all()
+            for user_id in user_ids:
+                target = shard_router.engine_for_user(user_id)
+                if target is source:
+                    continue
+                columns = [c for c in table.columns if c.name != 'id']
+                with source.connect() as connection, target.begin() as target_connection:
+                    target_connection.execute(delete(table).where(table.c.user_id == user_id))
+                    result = connection.execution_options(yield_per=chunk_size).execute(
+                        select(*columns).where(table.c.user_id == user_id).order_by(table.c.id)
+                    )
+                    for chunk in result.partitions(chunk_size):
+                        target_connection.execute(table.insert(), [dict(row._mapping) for row in chunk])
+                        moved += len(chunk)
+                    if name == 'step_snapshots':
+                        renumber_snapshot(target_connection, metadata, user_id)
+                with source.begin() as connection:
+                    connection.execute(delete(table).where(table.c.user_id == user_id))
+            if verbose:
+                print(f'{source.url}: {name} done')
+    return moved
+
+
+if __name__ == '__main__':
+    import argparse
+    from app import app
+    from models import db
+
+    parser = argparse.ArgumentParser(description='Manage step_logs/step ledger/boss_attacks shards')
+    parser.add_argument('command', choices=['init', 'migrate', 'status'])
+    parser.add_argument('--from', dest='source', choices=['primary'], help='move rows off the primary database')
+    parser.add_argument('--from-count', type=int, help='previous number of shards when rebalancing')
+    args = parser.parse_args()
+
+    if not shard_router.enabled:
+        raise SystemExit('STEP_SHARD_URLS is not set')
+
+    with app.app_context():
+        if args.command == 'init':
+            from migrations import backfill_step_rollups
+
+            shard_router.create_all()
+            rollups = shard_metadata().tables['step_rollups']
+            for engine in shard_router.engines:
+                with engine.begin() as connection:
+                    # Shards created before the rollups existed; migration 8 does the same on the primary
+                    if connection.execute(select(func.count()).select_from(rollups)).scalar() == 0:
+                        backfill_step_rollups(connection)
+            print(f'Created sharded tables on {len(shard_router.engines)} shards')
+        elif args.command == 'migrate':
+            if args.source == 'primary':
+                sources = [db.engine]
+            elif args.from_count:
+                sources = shard_router.engines[:args.from_count]
+            else:
+                raise SystemExit('Pass --from primary or --from-count N')
+            shard_router.create_all()
+            print(f'Moved {migrate_rows(sources)} rows')
+        else:
+            metadata = shard_metadata()
+            for index, engine in enumerate(shard_router.engines):
+                with engine.connect() as connection:
+                    counts = {
+                        name: connection.execute(select(func.count()).select_from(metadata.tables[name])).scalar()
+                        for name in SHARDED_TABLES
+                    }
+                print(f'shard {index} ({engine.url}): {counts}')
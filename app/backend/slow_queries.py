@@ -0,0 +1,283 @@
+"""
+Slow-query log.
+
+Any statement that takes longer than SLOW_QUERY_THRESHOLD_MS, on any engine
+(primary, replica, shards, the async engine), is written as one JSON line to
+SLOW_QUERY_LOG, a rotating file in the instance folder. Each line holds:
+
+- the SQL and its bound parameters (long values truncated)
+- the duration
+- a fingerprint of the SQL with literals and IN lists collapsed
+- the route being served and the first backend source line on the stack
+- the query's EXPLAIN plan
+
+The plan is captured on the same connection right after the statement. SELECTs
+only, and at most once per fingerprint per worker every
+SLOW_QUERY_EXPLAIN_TTL_SECONDS.
+
+A threshold of 0 logs every statement, which is how to see chatty loops (many
+fast queries from one line) while profiling.
+
+    python slow_queries.py                 # report grouped by fingerprint, slowest total first
+    python slow_queries.py --top 5 --route /api/users/search
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# Instrumentation that sits between the app code and the driver
+SKIP_FILES = {os.path.join(BACKEND_DIR, name) for name in ('slow_queries.py', 'metrics.py')}
+MAX_PARAMETER_LENGTH = 200
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LIST_RE = re.compile(r'\(\s*(?:\?|%s|:\w+)(?:\s*,\s*(?:\?|%s|:\w+))*\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+_COLUMNS_RE = re.compile(r'^SELECT .+? FROM ')
+
+FULL_SCAN_PATTERNS = (
+    re.compile(r'^SCAN (?:TABLE )?(\w+)(?!.* USING (?:COVERING )?INDEX)'),  # SQLite
+    re.compile(r'Seq Scan on (\w+)'),  # PostgreSQL
+)
+
+
+def fingerprint(statement):
+    normalized = _STRING_RE.sub('?', statement)
+    normalized = _NUMBER_RE.sub('?', normalized)
+    normalized = _LIST_RE.sub('(?)', normalized)
+    normalized = _SPACE_RE.sub(' ', normalized).strip()
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12], normalized
+
+
+def full_scans(plan):
+    """Tables a captured plan reads in full"""
+    tables = []
+    for line in plan or ():
+        for pattern in FULL_SCAN_PATTERNS:
+            match = pattern.search(line)
+            if match:
+                tables.append(match.group(1))
+    return tables
+
+
+def _caller():
+    """First frame in the backend's own code, outside the instrumentation modules"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(BACKEND_DIR) and filename not in SKIP_FILES and 'site-packages' not in filename:
+            return f'{os.path.relpath(filename, BACKEND_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+def _route():
+    if not has_request_context():
+        return None  # scripts, and the native ASGI handlers (their caller line names the handler)
+    return f'{request.method} {request.url_rule.rule if request.url_rule else request.path}'
+
+
+def _parameters(parameters):
+    def short(value):
+        if isinstance(value, (str, bytes)) and len(value) > MAX_PARAMETER_LENGTH:
+            return value[:MAX_PARAMETER_LENGTH] + '...'
+        return value
+
+    if isinstance(parameters, dict):
+        return {key: short(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [short(value) for value in parameters]
+    return parameters
+
+
+class SlowQueryLog:
+    def __init__(self):
+        self.app = None
+        self.threshold = None
+        self.explain = True
+        self.explain_ttl = 300
+        self.logger = None
+        self._plans = {}
+
+    def init_app(self, app):
+        self.app = app
+        path = app.config.get('SLOW_QUERY_LOG')
+        if not path:
+            return
+        if not os.path.isabs(path):
+            os.makedirs(app.instance_path, exist_ok=True)
+            path = os.path.join(app.instance_path, path)
+
+        self.logger = logging.getLogger('stepup.slow_queries')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(
+                path, maxBytes=app.config.get('SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024),
+                backupCount=app.config.get('SLOW_QUERY_LOG_BACKUPS', 5)
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+        self.threshold = app.config.get('SLOW_QUERY_THRESHOLD_MS', 200) / 1000
+        self.explain = app.config.get('SLOW_QUERY_EXPLAIN', True)
+        self.explain_ttl = app.config.get('SLOW_QUERY_EXPLAIN_TTL_SECONDS', 300)
+        app.extensions['slow_query_log'] = self
+
+    def _plan(self, conn, key, statement, parameters):
+        """(plan lines, error); cached per fingerprint since plans rarely change between runs"""
+        cached = self._plans.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1], None
+
+        dialect = conn.dialect.name
+        prefix = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+        cursor = conn.connection.cursor()
+        try:
+            if dialect != 'sqlite':
+                # A failed EXPLAIN must not abort the request's transaction
+                cursor.execute('SAVEPOINT slow_query_explain')
+            try:
+                cursor.execute(prefix + statement, parameters)
+                rows = cursor.fetchall()
+            except Exception as e:
+                if dialect != 'sqlite':
+                    cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                return None, str(e)
+            if dialect != 'sqlite':
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        finally:
+            cursor.close()
+
+        plan = [str(row[-1]) if dialect == 'sqlite' else ' '.join(str(col) for col in row) for row in rows]
+        if len(self._plans) > 512:
+            self._plans.clear()
+        self._plans[key] = (time.monotonic() + self.explain_ttl, plan)
+        return plan, None
+
+    def record(self, conn, statement, parameters, context, executemany, seconds):
+        key, _ = fingerprint(statement)
+        entry = {
+            'ts': datetime.utcnow().isoformat(timespec='milliseconds'),
+            'duration_ms': round(seconds * 1000, 3),
+            'fingerprint': key,
+            'sql': statement,
+            'parameters': None if executemany else _parameters(parameters),
+            'route': _route(),
+            'caller': _caller(),
+            'database': conn.engine.url.render_as_string(hide_password=True),
+        }
+        is_select = statement.lstrip().upper().startswith(('SELECT', 'WITH'))
+        if self.explain and is_select and not executemany:
+            try:
+                entry['plan'], error = self._plan(conn, key, statement, parameters)
+            except Exception as e:
+                entry['plan'], error = None, str(e)
+            if error:
+                entry['explain_error'] = error
+        self.logger.info(json.dumps(entry, default=str))
+
+
+slow_query_log = SlowQueryLog()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    if slow_query_log.threshold is not None:
+        context._slow_query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _check_duration(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_slow_query_started', None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    if seconds >= slow_query_log.threshold:
+        try:
+            slow_query_log.record(conn, statement, parameters, context, executemany, seconds)
+        except Exception as e:
+            slow_query_log.app.logger.warning(f'Failed to log slow query: {e}')
+
+
+def read_entries(path, backups):
+    """Entries from the log and its rotated copies, oldest first"""
+    paths = [f'{path}.{i}' for i in range(backups, 0, -1)] + [path]
+    for candidate in paths:
+        if not os.path.exists(candidate):
+            continue
+        with open(candidate) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # partially written line
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def report(entries, top=20, route=None):
+    groups = {}
+    for entry in entries:
+        if route and not (entry.get('route') or '').endswith(' ' + route):
+            continue
+        group = groups.setdefault(entry['fingerprint'], {'durations': [], 'routes': {}, 'callers': {}, 'slowest': entry})
+        group['durations'].append(entry['duration_ms'])
+        for name in ('routes', 'callers'):
+            value = entry.get(name[:-1])
+            if value:
+                group[name][value] = group[name].get(value, 0) + 1
+        if entry['duration_ms'] >= group['slowest']['duration_ms']:
+            group['slowest'] = entry
+        if entry.get('plan') is not None:
+            group['plan'] = entry['plan']
+
+    ranked = sorted(groups.items(), key=lambda item: -sum(item[1]['durations']))
+    lines = []
+    for key, group in ranked[:top]:
+        durations = group['durations']
+        plan = group.get('plan')
+        scans = full_scans(plan)
+        lines.append(
+            f'{key}  n={len(durations)}  total={sum(durations):.1f}ms  p50={_percentile(durations, 50):.1f}ms  '
+            f'p95={_percentile(durations, 95):.1f}ms  max={max(durations):.1f}ms'
+            + (f'  FULL SCAN: {", ".join(sorted(set(scans)))}' if scans else '')
+        )
+        # The column list rarely matters for tuning and hides the FROM/WHERE
+        lines.append(f'    {_COLUMNS_RE.sub("SELECT ... FROM ", fingerprint(group["slowest"]["sql"])[1])[:300]}')
+        for name in ('routes', 'callers'):
+            common = sorted(group[name].items(), key=lambda item: -item[1])[:3]
+            if common:
+                lines.append(f'    {name}: ' + ', '.join(f'{value} ({count})' for value, count in common))
+        for line in plan or ():
+            lines.append(f'    plan: {line}')
+    return '\n'.join(lines) if lines else 'No slow queries logged'
+
+
+if __name__ == '__main__':
+    import argparse
+    from app import app
+
+    parser = argparse.ArgumentParser(description='Summarize the slow-query log by query fingerprint')
+    parser.add_argument('--log', help='log file (default: SLOW_QUERY_LOG in the instance folder)')
+    parser.add_argument('--top', type=int, default=20, help='number of fingerprints to show')
+    parser.add_argument('--route', help='only queries issued by this route rule, e.g. /api/users/search')
+    args = parser.parse_args()
+
+    log_path = args.log or app.config.get('SLOW_QUERY_LOG') or 'slow_queries.log'
+    if not os.path.isabs(log_path) and not args.log:
+        log_path = os.path.join(app.instance_path, log_path)
+    print(report(read_entries(log_path, app.config.get('SLOW_QUERY_LOG_BACKUPS', 5)), args.top, args.route))
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Append-only step ledger.
+
+Every change to a user's step counts is inserted into `step_events`:
+
+- 'sync': steps added by a sync
+- 'set': a 'set'-mode correction of the day's total
+- 'attack': steps spent on a boss attack
+
+Each event records its change to the day's StepLog.steps_count and to
+User.total_steps_life. Request handlers only insert events, so syncs and
+attacks of the same user no longer update the same rows, and every total can
+be replayed.
+
+The `steps.project` job (jobs.py) folds a user's new events (the tail) into
+their snapshot. `step_snapshots` keeps the lifetime total up to an event id.
+step_logs rows, their day/week/month rollups (step_series.py) and
+users.total_steps_life are a projection of the ledger that lags it by the
+job's latency. A compare-and-set on the snapshot's event_id
+makes a concurrent fold of the same user fail and retry instead of applying
+events twice. Reads of the user's own current totals go through
+`current_steps`, snapshot plus tail in one statement: attack budgets, 'set'
+corrections, the sync response, and today's steps, lifetime total and streak
+on the profile, dashboard and weekly chart. Step history, series and
+leaderboards read the projection and see new steps once the job ran.
+
+A user's first fold records their pre-ledger totals (opening_*), which is
+where replays start. The ledger lives with step_logs on the user's shard.
+
+A boss attack damages the boss and adds EXP on the primary, and spends steps
+with an 'attack' event next to its boss_attacks row. Without sharding all of
+it commits in one transaction. With sharding one commit can't cover both
+databases, so the primary goes first: it commits the damage together with an
+`attack.record` job, and the job writes the shard side. The request runs that
+job right away, and workers retry it if that fails. The event's source holds
+the job's key, so an attempt whose shard commit went through but whose
+primary commit did not is not applied twice.
+
+    python step_ledger.py snapshot           # fold every tail, e.g. from cron in case jobs were lost
+    python step_ledger.py verify [--user N]  # replay events and report totals that differ
+    python step_ledger.py rebuild --user N   # rewrite a user's totals from the replay
+"""
+from contextlib import contextmanager
+from datetime import date, datetime
+from uuid import uuid4
+
+from sqlalchemy import select, update, func, and_
+from sqlalchemy.orm import Session
+
+from models import db, User, StepLog, StepEvent, StepSnapshot, BossAttack
+from invalidation import invalidate_on_commit
+from jobs import job_queue
+from sharding import shard_router
+from step_series import add_to_rollups
+
+events = StepEvent.__table__
+snapshots = StepSnapshot.__table__
+step_logs = StepLog.__table__
+
+
+class SnapshotConflict(RuntimeError):
+    """Another worker folded the same user's tail first; the job is retried"""
+
+
+def record(session, user_id, day, kind, steps_delta, lifetime_delta=0, source=None):
+    """Add an event and the job that folds it to `session`; call job_queue.notify() after committing"""
+    session.add(StepEvent(
+        user_id=user_id, date=day, kind=kind, steps_delta=steps_delta, lifetime_delta=lifetime_delta, source=source
+    ))
+    job_queue.enqueue(session, 'steps.project', {'user_id': user_id})
+
+
+def spend_on_attack(session, attack, day):
+    """Add a new BossAttack and its 'attack' event to `session`, or with sharding the job that writes them on the
+    user's shard; returns that job's id (None without sharding), to pass to job_queue.run_now after committing"""
+    if not shard_router.enabled:
+        session.add(attack)
+        record(session, attack.user_id, day, 'attack', -attack.steps_used)
+        return None
+    return job_queue.enqueue(session, 'attack.record', attack_payload(attack, day))
+
+
+def attack_payload(attack, day):
+    return {
+        'key': uuid4().hex, 'user_id': attack.user_id, 'boss_id': attack.boss_id, 'steps_used': attack.steps_used,
+        'damage_dealt': attack.damage_dealt, 'exp_gained': attack.exp_gained, 'date': day.isoformat(),
+        'attacked_at': datetime.utcnow().isoformat(),
+    }
+
+
+@job_queue.handler('attack.record')
+def record_attack(session, job):
+    """Write an attack from spend_on_attack on the user's shard, once"""
+    source = f"attack:{job['key']}"
+    with ledger_session(session, job['user_id']) as step_session:
+        applied = step_session.execute(
+            select(events.c.id).where(events.c.user_id == job['user_id'], events.c.source == source)
+        ).first()
+        if not applied:
+            step_session.add(BossAttack(
+                user_id=job['user_id'], boss_id=job['boss_id'], steps_used=job['steps_used'],
+                damage_dealt=job['damage_dealt'], exp_gained=job['exp_gained'],
+                attacked_at=datetime.fromisoformat(job['attacked_at']),
+            ))
+            step_session.add(StepEvent(
+                user_id=job['user_id'], date=date.fromisoformat(job['date']), kind='attack',
+                steps_delta=-job['steps_used'], source=source,
+            ))
+    job_queue.enqueue(session, 'steps.project', {'user_id': job['user_id']})
+
+
+def current_steps_query(user_id, day):
+    """One row: snapshot lifetime, StepLog steps on `day`, and the tail's lifetime and `day` changes"""
+    folded = select(snapshots.c.event_id).where(snapshots.c.user_id == user_id).scalar_subquery()
+    tail = and_(events.c.user_id == user_id, events.c.id > func.coalesce(folded, 0))
+    return select(
+        select(snapshots.c.lifetime_steps).where(snapshots.c.user_id == user_id).scalar_subquery(),
+        select(step_logs.c.steps_count).where(step_logs.c.user_id == user_id, step_logs.c.date == day)
+        .scalar_subquery(),
+        select(func.coalesce(func.sum(events.c.lifetime_delta), 0)).where(tail).scalar_subquery(),
+        select(func.coalesce(func.sum(events.c.steps_delta), 0)).where(tail, events.c.date == day).scalar_subquery(),
+    )
+
+
+def steps_from_row(row, total_steps_life):
+    """(lifetime steps, steps on the day) from a current_steps_query row"""
+    lifetime, day_steps, lifetime_tail, day_tail = row
+    # Without a snapshot nothing was folded yet, so users.total_steps_life is the pre-ledger total
+    lifetime = (total_steps_life if lifetime is None else lifetime) + lifetime_tail
+    return lifetime, max(0, (day_steps or 0) + day_tail)
+
+
+def current_steps(user, day):
+    row = db.session.execute(current_steps_query(user.id, day), bind_arguments={'mapper': StepEvent}).one()
+    return steps_from_row(row, user.total_steps_life)
+
+
+def fold(step_session, session, user_id):
+    """Apply the user's unfolded events to their snapshot, step_logs and total_steps_life; returns how many"""
+    snapshot = step_session.execute(select(StepSnapshot).where(StepSnapshot.user_id == user_id)).scalar()
+    tail = step_session.execute(
+        select(StepEvent).where(StepEvent.user_id == user_id, StepEvent.id > (snapshot.event_id if snapshot else 0))
+        .order_by(StepEvent.id)
+    ).scalars().all()
+    if not tail:
+        if snapshot is not None:
+            # With sharding the snapshot commits first; a fold whose primary commit failed left the total behind
+            raise_lifetime(session, user_id, snapshot.lifetime_steps)
+        return 0
+
+    if snapshot is None:
+        # First fold: step_logs and total_steps_life still hold exactly the pre-ledger totals
+        user = session.get(User, user_id)
+        if user is None:
+            return 0
+        opening_date = tail[0].date
+        opening_steps = step_session.execute(
+            select(StepLog.steps_count).where(StepLog.user_id == user_id, StepLog.date == opening_date)
+        ).scalar() or 0
+        snapshot = StepSnapshot(
+            user_id=user_id, event_id=0, event_count=0, lifetime_steps=user.total_steps_life,
+            opening_lifetime_steps=user.total_steps_life, opening_date=opening_date, opening_day_steps=opening_steps,
+        )
+        step_session.add(snapshot)
+        step_session.flush()  # a concurrent first fold fails here on unique_step_snapshot_user
+
+    lifetime = snapshot.lifetime_steps + sum(event.lifetime_delta for event in tail)
+    claimed = step_session.execute(
+        update(snapshots).where(snapshots.c.user_id == user_id, snapshots.c.event_id == snapshot.event_id).values(
+            event_id=tail[-1].id, event_count=snapshots.c.event_count + len(tail), lifetime_steps=lifetime,
+            taken_at=datetime.utcnow(),
+        )
+    ).rowcount == 1
+    if not claimed:
+        raise SnapshotConflict(f'Step events of user {user_id} were folded concurrently')
+
+    days = {}
+    for event in tail:
+        days.setdefault(event.date, []).append(event)
+    logs = {
+        log.date: log for log in step_session.execute(
+            select(StepLog).where(StepLog.user_id == user_id, StepLog.date.in_(list(days)))
+        ).scalars()
+    }
+    changes = {}
+    for day, day_events in days.items():
+        log = logs.get(day)
+        if log is None:
+            log = StepLog(user_id=user_id, steps_count=0, date=day, source=day_events[0].source)
+            step_session.add(log)
+        before = log_totals(log)
+        for event in day_events:
+            log.steps_count = max(0, log.steps_count + event.steps_delta)
+        log.distance_miles = log.steps_count / 2000
+        log.timestamp = datetime.utcnow()
+        changes[day] = [after - was for after, was in zip(log_totals(log), before)]
+    add_to_rollups(step_session, user_id, changes)
+
+    raise_lifetime(session, user_id, lifetime)
+    return len(tail)
+
+
+def log_totals(log):
+    """(steps, distance, active days) a step_logs row adds to its rollups (step_series.py)"""
+    return log.steps_count, log.distance_miles or 0.0, int(log.steps_count > 0)
+
+
+def raise_lifetime(session, user_id, lifetime):
+    """Set users.total_steps_life to `lifetime` unless it is higher already"""
+    # Lifetime totals only grow, so an older fold committing late can't move it backwards
+    raised = session.execute(
+        update(User.__table__).where(User.__table__.c.id == user_id, User.__table__.c.total_steps_life < lifetime)
+        .values(total_steps_life=lifetime)
+    ).rowcount
+    if raised:
+        invalidate_on_commit(session, ('leaderboard', 'all'))
+
+
+@contextmanager
+def ledger_session(session, user_id):
+    """Session on the database holding the user's ledger; committed on the way out when it isn't `session`"""
+    if not shard_router.enabled:
+        yield session
+        return
+    with Session(shard_router.engine_for_user(user_id)) as step_session:
+        yield step_session
+        step_session.commit()
+
+
+@job_queue.handler('steps.project')
+def project_steps(session, job):
+    with ledger_session(session, job['user_id']) as step_session:
+        fold(step_session, session, job['user_id'])
+
+
+def replay(step_session, user_id):
+    """(lifetime steps, {day: steps}) from the opening totals and every event, or None before the first fold"""
+    snapshot = step_session.execute(select(StepSnapshot).where(StepSnapshot.user_id == user_id)).scalar()
+    if snapshot is None:
+        return None
+    lifetime = snapshot.opening_lifetime_steps
+    days = {snapshot.opening_date: snapshot.opening_day_steps}
+    rows = step_session.execute(
+        select(events.c.date, events.c.steps_delta, events.c.lifetime_delta)
+        .where(events.c.user_id == user_id, events.c.id <= snapshot.event_id).order_by(events.c.id)
+        .execution_options(yield_per=1000)
+    )
+    for day, steps_delta, lifetime_delta in rows:
+        lifetime += lifetime_delta
+        days[day] = max(0, days.get(day, 0) + steps_delta)
+    return lifetime, days
+
+
+def differences(step_session, session, user_id, since):
+    """Fold, then compare the replay with the materialized totals: [(what, stored, replayed)]"""
+    fold(step_session, session, user_id)
+    replayed = replay(step_session, user_id)
+    if replayed is None:
+        return []
+    lifetime, days = replayed
+    found = []
+    snapshot_lifetime = step_session.execute(
+        select(snapshots.c.lifetime_steps).where(snapshots.c.user_id == user_id)
+    ).scalar()
+    if snapshot_lifetime != lifetime:
+        found.append(('lifetime', snapshot_lifetime, lifetime))
+    stored = dict(step_session.execute(
+        select(step_logs.c.date, step_logs.c.steps_count)
+        .where(step_logs.c.user_id == user_id, step_logs.c.date.in_([day for day in days if day >= since]))
+    ).all())
+    for day in sorted(day for day in days if day >= since):
+        if stored.get(day, 0) != days[day]:
+            found.append((day.isoformat(), stored.get(day), days[day]))
+    return found
+
+
+def rebuild(step_session, session, user_id, since):
+    """Overwrite the user's snapshot, step_logs (days from `since`, and their rollups) and total_steps_life with the
+    replay"""
+    fold(step_session, session, user_id)
+    replayed = replay(step_session, user_id)
+    if replayed is None:
+        return None
+    lifetime, days = replayed
+    step_session.execute(update(snapshots).where(snapshots.c.user_id == user_id).values(lifetime_steps=lifetime))
+    logs = {
+        log.date: log for log in step_session.execute(
+            select(StepLog).where(StepLog.user_id == user_id, StepLog.date.in_(list(days)))
+        ).scalars()
+    }
+    changes = {}
+    for day, steps in days.items():
+        if day < since:
+            continue  # compacted into step_log_monthly by retention.py
+        log = logs.get(day)
+        if log is None:
+            log = StepLog(user_id=user_id, steps_count=0, date=day)
+            step_session.add(log)
+        elif log.steps_count == steps:
+            continue
+        before = log_totals(log)
+        log.steps_count = steps
+        log.distance_miles = steps / 2000
+        changes[day] = [after - was for after, was in zip(log_totals(log), before)]
+    add_to_rollups(step_session, user_id, changes)
+    session.get(User, user_id).total_steps_life = lifetime
+    return lifetime, days
+
+
+def users_with_tails(engine):
+    with engine.connect() as connection:
+        folded = select(snapshots.c.event_id).where(snapshots.c.user_id == events.c.user_id).scalar_subquery()
+        return connection.execute(
+            select(events.c.user_id).where(events.c.id > func.coalesce(folded, 0)).distinct()
+        ).scalars().all()
+
+
+def users_in_ledger(engine):
+    with engine.connect() as connection:
+        return connection.execute(select(snapshots.c.user_id)).scalars().all()
+
+
+if __name__ == '__main__':
+    import argparse
+    from app import app
+    from retention import step_engines, months_ago
+
+    parser = argparse.ArgumentParser(description='Step ledger maintenance')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('snapshot', help="fold every user's unfolded events")
+    verify_parser = commands.add_parser('verify', help='replay events and report totals that differ')
+    verify_parser.add_argument('--user', type=int, help='only this user id')
+    rebuild_parser = commands.add_parser('rebuild', help="rewrite a user's totals from their events")
+    rebuild_parser.add_argument('--user', type=int, required=True)
+    args = parser.parse_args()
+
+    def each_user(user_ids):
+        """(user_id, ledger session, primary session) per user, each committed before the next"""
+        for user_id in user_ids:
+            with Session(db.engine) as session:
+                with ledger_session(session, user_id) as step_session:
+                    yield user_id, step_session, session
+                session.commit()
+
+    with app.app_context():
+        since = months_ago(date.today(), app.config.get('RETENTION_STEP_LOG_MONTHS', 13))
+        if args.command == 'snapshot':
+            folded = 0
+            for engine in step_engines():
+                for user_id, step_session, session in each_user(users_with_tails(engine)):
+                    folded += fold(step_session, session, user_id)
+            print(f'Folded {folded} event(s)')
+        elif args.command == 'verify':
+            user_ids = [args.user] if args.user else [u for engine in step_engines() for u in users_in_ledger(engine)]
+            mismatched = 0
+            for user_id, step_session, session in each_user(user_ids):
+                found = differences(step_session, session, user_id, since)
+                mismatched += bool(found)
+                for what, stored, replayed in found:
+                    print(f'user {user_id} {what}: stored {stored}, replayed {replayed}')
+            print(f'{len(user_ids)} user(s) checked, {mismatched} with differences')
+            if mismatched:
+                raise SystemExit(1)
+        else:
+            for user_id, step_session, session in each_user([args.user]):
+                rebuilt = rebuild(step_session, session, user_id, since)
+                print(f'user {user_id}: ' + ('no ledger yet' if rebuilt is None else
+                                              f'lifetime {rebuilt[0]}, {len(rebuilt[1])} day(s) replayed'))
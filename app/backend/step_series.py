@@ -0,0 +1,144 @@
+"""
+Step totals bucketed by day, week or month for charts.
+
+Series are read from `step_rollups`, one row per user and day, week (Monday to
+Sunday) or month, so a chart is a single index range scan over as many rows as
+it has non-empty buckets, whatever the resolution. The ledger fold
+(step_ledger.py) keeps the rollups in step with the day's step_logs rows by
+adding each change to the day, its week and its month, in the transaction that
+changes the row. Buckets without a rollup count as zero, like
+/api/user/weekly-steps. The result is returned as parallel arrays, so a
+multi-year chart is a few dozen numbers instead of one dict per logged day.
+
+The retention job drops day and week rollups with the daily rows it compacts
+into StepLogMonthly and keeps the month rollups, so at day or week resolution
+compacted months have no detail and are reported in `compacted_before`.
+
+`from` and `to` are widened to whole buckets (Monday to Sunday, first to last
+of the month), so the first and last buckets are never partial.
+"""
+from datetime import date, timedelta
+
+from sqlalchemy import select, func
+
+from models import db, StepLogMonthly, StepRollup
+
+RESOLUTIONS = ('day', 'week', 'month')
+DEFAULT_SPAN = {'day': 30, 'week': 12, 'month': 12}
+MAX_POINTS = 1000
+
+
+def bucket_start(day, resolution):
+    if resolution == 'week':
+        return day - timedelta(days=day.weekday())
+    if resolution == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket(start, resolution):
+    if resolution == 'week':
+        return start + timedelta(days=7)
+    if resolution == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def default_range(resolution, today=None):
+    """(from, to) covering the last DEFAULT_SPAN buckets up to today"""
+    end = today or date.today()
+    start = bucket_start(end, resolution)
+    for _ in range(DEFAULT_SPAN[resolution] - 1):
+        start = bucket_start(start - timedelta(days=1), resolution)
+    return start, end
+
+
+def bucket_end(day, resolution):
+    """Last day of the bucket `day` falls in"""
+    return next_bucket(bucket_start(day, resolution), resolution) - timedelta(days=1)
+
+
+def bucket_starts(start, end, resolution):
+    buckets = []
+    current = bucket_start(start, resolution)
+    while current <= end:
+        buckets.append(current)
+        if len(buckets) > MAX_POINTS:
+            raise ValueError(f'Range too large for {resolution} resolution (max {MAX_POINTS} points)')
+        current = next_bucket(current, resolution)
+    return buckets
+
+
+def step_series(user_id, start, end, resolution='day'):
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"resolution must be one of {', '.join(RESOLUTIONS)}")
+    if start > end:
+        raise ValueError("'from' must not be after 'to'")
+    start, end = bucket_start(start, resolution), bucket_end(end, resolution)
+
+    buckets = bucket_starts(start, end, resolution)
+    index = {bucket: i for i, bucket in enumerate(buckets)}
+    steps = [0] * len(buckets)
+    distance = [0.0] * len(buckets)
+    active_days = [0] * len(buckets)
+
+    rollups = db.session.execute(
+        select(StepRollup.start, StepRollup.steps_count, StepRollup.distance_miles, StepRollup.active_days)
+        .where(StepRollup.user_id == user_id, StepRollup.period == resolution,
+               StepRollup.start >= start, StepRollup.start <= end)
+    ).all()
+    for bucket, steps_count, distance_miles, bucket_active_days in rollups:
+        i = index[bucket]
+        steps[i] = steps_count
+        distance[i] = distance_miles
+        active_days[i] = bucket_active_days
+
+    compacted_before = None
+    if resolution != 'month':
+        last_compacted = db.session.execute(
+            select(func.max(StepLogMonthly.month))
+            .where(StepLogMonthly.user_id == user_id,
+                   StepLogMonthly.month >= start.replace(day=1), StepLogMonthly.month <= end)
+        ).scalar()
+        if last_compacted is not None:
+            compacted_before = next_bucket(last_compacted, 'month')
+
+    return {
+        'resolution': resolution,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'buckets': [bucket.isoformat() for bucket in buckets],
+        'steps': steps,
+        'distance_miles': [round(miles, 2) for miles in distance],
+        'active_days': active_days,
+        'compacted_before': compacted_before.isoformat() if compacted_before else None,
+    }
+
+
+def add_to_rollups(session, user_id, changes):
+    """Add {day: (steps, distance, active days)} changes of a user's step_logs rows to their day, week and month
+    rollups in `session`, the one holding the user's step_logs"""
+    totals = {}
+    for day, change in changes.items():
+        if not any(change):
+            continue
+        for period in RESOLUTIONS:
+            key = (period, bucket_start(day, period))
+            totals[key] = [total + delta for total, delta in zip(totals.get(key, (0, 0.0, 0)), change)]
+    if not totals:
+        return
+    rollups = {
+        (rollup.period, rollup.start): rollup for rollup in session.execute(
+            select(StepRollup).where(StepRollup.user_id == user_id, StepRollup.period.in_(RESOLUTIONS),
+                                     StepRollup.start.in_(sorted({start for _, start in totals})))
+        ).scalars()
+    }
+    for (period, start), (steps, distance, active) in totals.items():
+        rollup = rollups.get((period, start))
+        if rollup is None:
+            rollup = StepRollup(user_id=user_id, period=period, start=start, steps_count=0, distance_miles=0.0,
+                                active_days=0)
+            session.add(rollup)
+        rollup.steps_count += steps
+        rollup.distance_miles += distance
+        rollup.active_days += active
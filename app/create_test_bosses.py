@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 """
 Quick script to create some test boss data for testing the boss battle system
+
+For benchmark-sized data use backend/benchmarks/synthetic_data.py.
 """
 import sys
 import os
 
 # Add the backend directory to the Python path
-sys.path.insert(0, '/Users/tylerchoe/Downloads/JesusLovesYou/backend')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
 
 from models import db, Boss, BossManager
 from app import app
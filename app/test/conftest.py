@@ -0,0 +1,89 @@
+"""
+Shared fixtures for the backend tests.
+
+The app is imported once, with the testing config, against a scratch SQLite
+file; each test module gets that database emptied and migrated again.
+
+    cd app && python -m pytest test
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+sys.path.insert(0, BACKEND_DIR)
+
+# Set before app.py is imported: it reads its config once
+_fd, DB_PATH = tempfile.mkstemp(suffix='.db', prefix='stepup-test-')
+os.close(_fd)
+os.environ['FLASK_ENV'] = 'testing'
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+os.environ.setdefault('SECRET_KEY', 'test-secret')
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app as app_module
+    yield app_module
+    os.remove(DB_PATH)
+
+
+@pytest.fixture(scope='module')
+def app(app_module):
+    """The Flask app with an empty, fully migrated database"""
+    from models import db
+    from migrations import upgrade
+
+    app = app_module.app
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+        with db.engine.begin() as connection:
+            connection.execute(db.text('DROP TABLE IF EXISTS schema_version'))
+        upgrade(db.engine)
+    return app
+
+
+@pytest.fixture(scope='module')
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture(scope='module')
+def engine(app):
+    from models import db
+    with app.app_context():
+        return db.engine
+
+
+@pytest.fixture(scope='module')
+def capture_statements(engine):
+    """`with capture_statements() as statements:` collects (statement, parameters) for every SQL run on the engine"""
+    from sqlalchemy import event
+
+    @contextmanager
+    def capture():
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return capture
+
+
+def register_and_login(client, username, password='password123'):
+    client.post('/api/register', json={'username': username, 'password': password})
+    response = client.post('/api/login', json={'username': username, 'password': password})
+    return response.get_json()['token']
+
+
+def auth_header(token):
+    return {'Authorization': f'Bearer {token}'}
@@ -0,0 +1,137 @@
+"""
+Background job queue behaviour.
+
+Jobs are enqueued and committed directly and run one at a time with
+job_queue.run_one, so each test controls when a job is claimed. The handlers
+below add a SyncTombstone row per run (a table without foreign keys) so a test
+can count whose writes were committed.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, update, func
+from sqlalchemy.orm import Session
+
+from jobs import job_queue
+from models import db, Job, SyncTombstone
+
+jobs = Job.__table__
+runs = []
+
+
+@job_queue.handler('test.mark')
+def mark(session, job):
+    runs.append(job['n'])
+    session.add(SyncTombstone(user_id=0, entity='test', entity_id=job['n']))
+
+
+@job_queue.handler('test.fail')
+def fail(session, job):
+    if runs.count(job['n']) < job['failures']:
+        runs.append(job['n'])
+        raise RuntimeError(f"run {runs.count(job['n'])} of job {job['n']} failed")
+    mark(session, job)
+
+
+@job_queue.handler('test.reclaimed')
+def reclaimed(session, job):
+    """The first run outlives its visibility timeout, and another worker reclaims and finishes the job meanwhile"""
+    if job['n'] not in runs:
+        runs.append(job['n'])
+        with db.engine.begin() as connection:
+            job_id = connection.execute(
+                update(jobs).where(jobs.c.kind == 'test.reclaimed', jobs.c.status == 'running')
+                .values(locked_until=datetime.utcnow() - timedelta(seconds=1)).returning(jobs.c.id)
+            ).scalar_one()
+        assert job_queue.run_one(job_id)
+    mark(session, job)
+
+
+def enqueue(app, kind, payload, **kwargs):
+    with app.app_context(), Session(db.engine) as session:
+        job_id = job_queue.enqueue(session, kind, payload, **kwargs)
+        session.commit()
+    return job_id
+
+
+def job_row(engine, job_id):
+    with engine.connect() as connection:
+        return connection.execute(select(jobs).where(jobs.c.id == job_id)).one()
+
+
+def make_due(engine, job_id):
+    """As if the retry backoff had passed"""
+    with engine.begin() as connection:
+        connection.execute(update(jobs).where(jobs.c.id == job_id)
+                           .values(run_at=datetime.utcnow() - timedelta(seconds=1)))
+
+
+def marks(engine, n):
+    with engine.connect() as connection:
+        return connection.execute(
+            select(func.count()).where(SyncTombstone.entity == 'test', SyncTombstone.entity_id == n)
+        ).scalar()
+
+
+@pytest.fixture(autouse=True)
+def clear_runs():
+    runs.clear()
+
+
+def test_duplicate_enqueue_is_ignored(app, engine):
+    job_id = enqueue(app, 'test.mark', {'n': 1}, idempotency_key='mark-1')
+    assert enqueue(app, 'test.mark', {'n': 1}, idempotency_key='mark-1') is None
+    assert job_queue.run_one(job_id)
+    # Still taken once the job is done, until retention.py purges it
+    assert enqueue(app, 'test.mark', {'n': 1}, idempotency_key='mark-1') is None
+    assert job_queue.run_one() is False
+    assert runs == [1] and marks(engine, 1) == 1
+
+
+def test_job_reclaimed_after_its_visibility_timeout_applies_once(app, engine):
+    job_id = enqueue(app, 'test.reclaimed', {'n': 2})
+    lost = job_queue.stats['lost']
+
+    assert job_queue.run_one(job_id)
+
+    row = job_row(engine, job_id)
+    assert (row.status, row.attempts) == ('done', 2)
+    assert job_queue.stats['lost'] == lost + 1
+    assert marks(engine, 2) == 1  # the first run's writes were rolled back
+
+
+def test_failed_job_is_retried_after_a_backoff(app, engine):
+    job_id = enqueue(app, 'test.fail', {'n': 3, 'failures': 1})
+    assert job_queue.run_one(job_id)
+    row = job_row(engine, job_id)
+    assert (row.status, row.attempts) == ('pending', 1)
+    assert 'run 1 of job 3 failed' in row.last_error
+    assert row.run_at > datetime.utcnow()
+    assert job_queue.run_one(job_id) is False
+
+    make_due(engine, job_id)
+    assert job_queue.run_one(job_id)
+    row = job_row(engine, job_id)
+    assert (row.status, row.attempts, row.last_error) == ('done', 2, None)
+    assert marks(engine, 3) == 1
+
+
+def test_job_is_dead_lettered_after_max_attempts(app, engine):
+    job_id = enqueue(app, 'test.fail', {'n': 4, 'failures': 3}, max_attempts=2)
+    for _ in range(2):
+        assert job_queue.run_one(job_id)
+        make_due(engine, job_id)
+    row = job_row(engine, job_id)
+    assert (row.status, row.attempts) == ('failed', 2)
+    assert row.finished_at is not None
+    assert job_queue.run_one(job_id) is False
+    with app.app_context():
+        assert job_queue.depth()['failed'] == 1
+
+        # `python jobs.py retry` gives it a fresh set of attempts
+        assert job_queue.retry_failed('test.fail') == 1
+    assert job_queue.run_one(job_id)
+    make_due(engine, job_id)
+    assert job_queue.run_one(job_id)
+    assert job_row(engine, job_id).status == 'done'
+    assert marks(engine, 4) == 1
@@ -0,0 +1,195 @@
+"""
+Query budget regression tests.
+
+Seeds two users whose data differ only in size, one with a handful of
+friends, friend requests, leaderboard rivals and streak days, one with
+thousands of each, and calls every endpoint as both through the Flask test
+client. The number of SQL statements an endpoint runs must not exceed its
+entry in BUDGETS and must be the same for both users, so a per-row lookup
+(an N+1 loop) fails here instead of in production.
+"""
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from conftest import register_and_login, auth_header
+
+SIZES = (10, 10000)
+
+# endpoint -> statements one call runs, whatever the data size; lower these when an endpoint gets cheaper
+BUDGETS = {
+    'POST /api/register': 2,
+    'POST /api/login': 1,
+    'GET /api/user/profile': 8,
+    'POST /api/steps/sync': 7,
+    'GET /api/steps/history': 2,
+    'GET /api/steps/history?since': 2,
+    'GET /api/user/weekly-steps': 3,
+    'GET /api/steps/series?resolution=week': 3,
+    'GET /api/steps/series?resolution=month': 2,
+    'GET /api/user/level': 1,
+    'GET /api/journeys': 1,
+    'POST /api/journeys/<id>/start': 6,
+    'POST /api/journeys/end': 2,
+    'GET /api/dashboard': 11,
+    'GET /api/bosses': 2,
+    'POST /api/bosses/<id>/attack': 12,
+    'GET /api/friends': 4,
+    'GET /api/friends?since': 6,
+    'GET /api/users/search': 3,
+    'POST /api/friends/send-request': 4,
+    'POST /api/friends/respond': 3,
+    'DELETE /api/friends/remove': 5,
+    'GET /api/leaderboard': 4,
+    'GET /api/leaderboard?friends_only': 5,
+}
+
+LEADERBOARD_CALLS = [
+    (timeframe, friends_only) for timeframe in ('day', 'week', 'month', 'all') for friends_only in ('false', 'true')
+]
+
+# Budget keys of the calls endpoint_calls makes, in order
+CALL_KEYS = [
+    'POST /api/register', 'POST /api/login', 'GET /api/user/profile', 'POST /api/steps/sync',
+    'GET /api/steps/history', 'GET /api/steps/history?since', 'GET /api/user/weekly-steps',
+    'GET /api/steps/series?resolution=week', 'GET /api/steps/series?resolution=month', 'GET /api/user/level',
+    'GET /api/journeys', 'POST /api/journeys/<id>/start', 'GET /api/dashboard', 'GET /api/bosses',
+    'POST /api/bosses/<id>/attack', 'POST /api/journeys/end', 'GET /api/friends', 'GET /api/friends?since',
+    'GET /api/users/search', 'POST /api/friends/send-request', 'POST /api/friends/respond',
+    'DELETE /api/friends/remove',
+] + [
+    'GET /api/leaderboard' + ('?friends_only' if friends_only == 'true' else '')
+    for _, friends_only in LEADERBOARD_CALLS
+]
+CALL_IDS = [f'{i:02d} {key}' for i, key in enumerate(CALL_KEYS)]
+
+
+def seed_world(app, client, name, size):
+    """A user with `size` friends, requests, search matches and streak days; returns the ids and tokens used"""
+    from models import db, User, StepLog, StepLogMonthly, Friendship, UserLevel
+
+    token = register_and_login(client, name)
+    peer_token = register_and_login(client, f'{name}peer')
+    today = date.today()
+    with app.app_context():
+        user = User.query.filter_by(username=name).one()
+        peer = User.query.filter_by(username=f'{name}peer').one()
+
+        # Friends and people asking to be friends; all of them match a search for the user's name
+        fans = [User(username=f'{name}fan{i}', password_hash='x', total_steps_life=1000 + i) for i in range(2 * size)]
+        db.session.add_all(fans)
+        db.session.flush()
+        db.session.add_all([UserLevel(user_id=fan.id) for fan in fans])
+        db.session.add_all([
+            StepLog(user_id=fan.id, steps_count=1000 + i, date=today - timedelta(days=day))
+            for i, fan in enumerate(fans) for day in range(2)
+        ])
+        db.session.add_all([
+            Friendship(sender_id=fan.id, receiver_id=user.id, status='accepted' if i < size else 'pending',
+                       accepted_at=datetime.utcnow() if i < size else None)
+            for i, fan in enumerate(fans)
+        ])
+        invitation = Friendship(sender_id=peer.id, receiver_id=user.id, status='pending')
+        db.session.add(invitation)
+
+        # A `size`-day streak: daily rows for recent days, compacted monthly rows before them
+        daily_days = min(size, today.day)
+        db.session.add_all([
+            StepLog(user_id=user.id, steps_count=5000, date=today - timedelta(days=day)) for day in range(daily_days)
+        ])
+        month_end = today - timedelta(days=daily_days)
+        remaining = size - daily_days
+        while remaining > 0:
+            month = month_end.replace(day=1)
+            db.session.add(StepLogMonthly(
+                user_id=user.id, month=month, steps_count=5000 * month_end.day, distance_miles=2.5 * month_end.day,
+                active_days=month_end.day, trailing_active_days=month_end.day
+            ))
+            remaining -= month_end.day
+            month_end = month - timedelta(days=1)
+        db.session.commit()
+        return {
+            'name': name, 'token': token, 'peer_token': peer_token, 'fan': fans[size].username,
+            'friend_id': fans[0].id, 'invitation_id': invitation.id,
+        }
+
+
+def endpoint_calls(world, boss_id):
+    """(method, path, kwargs) for each of CALL_KEYS"""
+    from delta_sync import encode_cursor
+
+    user = auth_header(world['token'])
+    peer = auth_header(world['peer_token'])
+    since = encode_cursor(datetime.utcnow() - timedelta(hours=1))
+    return [
+        ('POST', '/api/register', {'json': {'username': world['name'] + 'new', 'password': 'password123'}}),
+        ('POST', '/api/login', {'json': {'username': world['name'], 'password': 'password123'}}),
+        ('GET', '/api/user/profile', {'headers': user}),
+        ('POST', '/api/steps/sync', {'headers': user, 'json': {'steps_count': 6000}}),
+        ('GET', '/api/steps/history', {'headers': user}),
+        ('GET', f'/api/steps/history?since={since}', {'headers': user}),
+        ('GET', '/api/user/weekly-steps', {'headers': user}),
+        ('GET', '/api/steps/series?resolution=week', {'headers': user}),
+        ('GET', '/api/steps/series?resolution=month&from=2000-01-01', {'headers': user}),
+        ('GET', '/api/user/level', {'headers': user}),
+        ('GET', '/api/journeys', {}),
+        ('POST', '/api/journeys/1/start', {'headers': user}),
+        ('GET', '/api/dashboard', {'headers': user}),
+        ('GET', '/api/bosses', {'headers': user}),
+        ('POST', f'/api/bosses/{boss_id}/attack', {'headers': user, 'json': {'steps_to_use': 100}}),
+        ('POST', '/api/journeys/end', {'headers': user}),
+        ('GET', '/api/friends', {'headers': user}),
+        ('GET', f'/api/friends?since={since}', {'headers': user}),
+        ('GET', f'/api/users/search?q={world["name"]}fan', {'headers': user}),
+        ('POST', '/api/friends/send-request', {'headers': peer, 'json': {'username': world['fan']}}),
+        ('POST', '/api/friends/respond',
+         {'headers': user, 'json': {'request_id': world['invitation_id'], 'action': 'accept'}}),
+        ('DELETE', '/api/friends/remove', {'headers': user, 'json': {'user_id': world['friend_id']}}),
+    ] + [
+        ('GET', f'/api/leaderboard?timeframe={timeframe}&friends_only={friends_only}&limit=50', {'headers': user})
+        for timeframe, friends_only in LEADERBOARD_CALLS
+    ]
+
+
+@pytest.fixture(scope='module')
+def statement_counts(app, client, capture_statements):
+    """{size: [(HTTP status, statements run) per call]}, each size's calls made in order as its own user"""
+    from models import db, Boss
+    from jobs import job_queue
+
+    with app.app_context():
+        boss = Boss(name='Budget Boss', description='Seeded', max_health=10 ** 9, current_health=10 ** 9,
+                    exp_reward=100, boss_type='Global')
+        db.session.add(boss)
+        db.session.commit()
+        boss_id = boss.id
+
+    worlds = {size: seed_world(app, client, f'size{size}x', size) for size in SIZES}
+    # Count what the handler itself runs; jobs it enqueues are another transaction
+    eager, job_queue.eager = job_queue.eager, False
+    try:
+        counts = {}
+        for size, world in worlds.items():
+            counts[size] = []
+            for method, path, kwargs in endpoint_calls(world, boss_id):
+                with capture_statements() as statements:
+                    response = client.open(path, method=method, **kwargs)
+                counts[size].append((response.status_code, len(statements)))
+    finally:
+        job_queue.eager = eager
+    return counts
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('call', range(len(CALL_KEYS)), ids=CALL_IDS)
+def test_within_budget(statement_counts, call, size):
+    status, count = statement_counts[size][call]
+    key = CALL_KEYS[call]
+    assert status < 400, f'{key}: HTTP {status}'
+    assert count <= BUDGETS[key], f'{key}: {count} statements with {size} rows, budget is {BUDGETS[key]}'
+
+
+@pytest.mark.parametrize('call', range(len(CALL_KEYS)), ids=CALL_IDS)
+def test_independent_of_data_size(statement_counts, call):
+    counts = {size: statement_counts[size][call][1] for size in SIZES}
+    assert len(set(counts.values())) == 1, f'{CALL_KEYS[call]}: statements by number of rows {counts}'
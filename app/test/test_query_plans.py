@@ -0,0 +1,156 @@
+"""
+Query plan regression tests.
+
+Calls every endpoint through the Flask test client against a seeded
+database, captures each SELECT it issues, runs EXPLAIN QUERY PLAN on it and
+fails when a query falls back to a full table scan that isn't on the allow
+list below. Background jobs run eagerly (testing config), so their queries
+are checked with the endpoint that enqueues them.
+"""
+import re
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from conftest import register_and_login, auth_header
+
+# (path, table) -> why a full scan is acceptable there
+ALLOWED_SCANS = {
+    ('/api/users/search', 'users'): 'substring ilike cannot use a b-tree index',
+}
+
+POPULATION = 300
+HISTORY_DAYS = 60
+
+# `SCAN CONSTANT ROW` is a SELECT without FROM, e.g. one made of scalar subqueries
+SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(?!CONSTANT ROW)(\w+)')
+
+# (method, path, caller, kwargs) in the order they run; {since} and {bosses_since} are cursors from an hour ago
+ENDPOINT_CALLS = [
+    ('POST', '/api/register', None, {'json': {'username': 'dave', 'password': 'password123'}}),
+    ('POST', '/api/login', None, {'json': {'username': 'alice', 'password': 'password123'}}),
+    ('GET', '/api/journeys', None, {}),
+    ('GET', '/api/bosses?since={bosses_since}', 'alice', {}),
+    ('POST', '/api/journeys/1/start', 'alice', {}),
+    ('POST', '/api/steps/sync', 'alice', {'json': {'steps_count': 500}}),
+    ('GET', '/api/user/profile', 'alice', {}),
+    ('GET', '/api/steps/history', 'alice', {}),
+    ('GET', '/api/steps/history?since={since}', 'alice', {}),
+    ('GET', '/api/user/weekly-steps', 'alice', {}),
+    ('GET', '/api/steps/series?resolution=week', 'alice', {}),
+    ('GET', '/api/steps/series?resolution=month&from=2020-01-01', 'alice', {}),
+    ('GET', '/api/user/level', 'alice', {}),
+    ('GET', '/api/dashboard', 'alice', {}),
+    ('GET', '/api/bosses', 'alice', {}),
+    ('POST', '/api/bosses/1/attack', 'alice', {'json': {'steps_to_use': 100}}),
+    ('GET', '/api/friends', 'alice', {}),
+    ('GET', '/api/friends?since={since}', 'alice', {}),
+    ('GET', '/api/users/search?q=ca', 'alice', {}),
+    ('POST', '/api/friends/send-request', 'carol', {'json': {'username': 'bob'}}),
+    ('POST', '/api/journeys/end', 'alice', {}),
+    ('DELETE', '/api/friends/remove', 'bob', {'json': {'user_id': 1}}),
+] + [
+    ('GET', f'/api/leaderboard?timeframe={timeframe}&friends_only={friends_only}', 'alice', {})
+    for timeframe in ('day', 'week', 'month', 'all') for friends_only in ('false', 'true')
+]
+
+
+def explain(engine, statement, parameters):
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    return [row[-1] for row in rows]
+
+
+def seed(app, client):
+    from models import db, Boss, BossManager, User, StepLog, Friendship, UserLevel, Journey, Job
+    from step_series import add_to_rollups
+
+    tokens = {name: register_and_login(client, name) for name in ('alice', 'bob', 'carol')}
+    with app.app_context():
+        BossManager.spawn_daily_bosses()
+        db.session.add(Boss(name='Global Boss', description='Seeded', max_health=50000,
+                            current_health=50000, exp_reward=100, boss_type='Global'))
+        db.session.commit()
+
+    client.post('/api/steps/sync', json={'steps_count': 8000}, headers=auth_header(tokens['alice']))
+    client.post('/api/steps/sync', json={'steps_count': 3000}, headers=auth_header(tokens['bob']))
+    client.post('/api/friends/send-request', json={'username': 'bob'}, headers=auth_header(tokens['alice']))
+    client.post('/api/friends/send-request', json={'username': 'alice'}, headers=auth_header(tokens['carol']))
+    request_id = client.get('/api/friends', headers=auth_header(tokens['bob'])).get_json()['friend_requests'][0]['id']
+    client.post('/api/friends/respond', json={'request_id': request_id, 'action': 'accept'},
+                headers=auth_header(tokens['bob']))
+
+    # Background population so ANALYZE gives the planner realistic statistics
+    with app.app_context():
+        users = [User(username=f'filler{i}', password_hash='x', total_steps_life=i * 100) for i in range(POPULATION)]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add_all([UserLevel(user_id=user.id) for user in users])
+        db.session.add_all([
+            StepLog(user_id=user.id, steps_count=1000 + day * 10, date=date.today() - timedelta(days=day))
+            for user in users for day in range(1, HISTORY_DAYS)
+        ])
+        for user in users:
+            add_to_rollups(db.session, user.id, {
+                date.today() - timedelta(days=day): (1000 + day * 10, 0.0, 1) for day in range(1, HISTORY_DAYS)
+            })
+        db.session.add_all([
+            Friendship(sender_id=user.id, receiver_id=users[(i + offset) % POPULATION].id,
+                       status='accepted' if offset % 2 else 'pending')
+            for i, user in enumerate(users) for offset in (1, 2, 3)
+        ])
+        db.session.add_all([
+            Journey(start_city='A', end_city='B', total_distance_miles=100.0, user_id=user.id,
+                    personal_progress_miles=100.0, is_active=False, is_template=False)
+            for user in users for _ in range(2)
+        ])
+        db.session.add_all([
+            Boss(name=f'Old Boss {day}', description='Defeated', max_health=1000, current_health=-1,
+                 exp_reward=10, boss_type='Daily', is_active=False)
+            for day in range(HISTORY_DAYS * 3)
+        ])
+        db.session.add_all([
+            Job(kind='steps.progress', payload='{}', status=status, finished_at=datetime.utcnow())
+            for status in ('done', 'failed') for _ in range(POPULATION)
+        ])
+        db.session.commit()
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+    return tokens
+
+
+@pytest.fixture(scope='module')
+def plans(app, client, engine, capture_statements):
+    """(method, path) -> (HTTP status, [(statement, plan lines)]) for every call, made in order"""
+    from delta_sync import encode_cursor
+
+    tokens = seed(app, client)
+    hour_ago = datetime.utcnow() - timedelta(hours=1)
+    cursors = {'since': encode_cursor(hour_ago), 'bosses_since': encode_cursor(hour_ago, journey=0)}
+    results = {}
+    for method, path, caller, kwargs in ENDPOINT_CALLS:
+        if caller:
+            kwargs = dict(kwargs, headers=auth_header(tokens[caller]))
+        with capture_statements() as statements:
+            response = client.open(path.format(**cursors), method=method, **kwargs)
+        selects = [
+            (statement, explain(engine, statement, parameters)) for statement, parameters in statements
+            if statement.lstrip().upper().startswith('SELECT')
+        ]
+        results[method, path] = response.status_code, selects
+    return results
+
+
+@pytest.mark.parametrize('method, path', [(method, path) for method, path, _, _ in ENDPOINT_CALLS])
+def test_endpoint_queries_use_indexes(plans, method, path):
+    status, selects = plans[method, path]
+    assert status < 500, f'{method} {path}: HTTP {status}'
+
+    route = path.split('?')[0]
+    scans = []
+    for statement, plan in selects:
+        for detail in plan:
+            match = SCAN_RE.match(detail)
+            if match and (route, match.group(1)) not in ALLOWED_SCANS:
+                scans.append(f'full scan of {match.group(1)}: {" ".join(statement.split())}')
+    assert not scans, '\n'.join(scans)
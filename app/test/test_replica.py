@@ -0,0 +1,32 @@
+"""
+Read-your-writes marker.
+
+The marker a response carries after a write is signed for the user who wrote,
+so only that user's own marker keeps their reads on the primary; a forged
+timestamp or another user's marker is ignored.
+"""
+import time
+
+from flask import g
+
+from replica import WRITE_COOKIE, WRITE_HEADER, make_marker, last_write
+
+
+def marker_seen(app, user_id, marker, header=False):
+    sent = {'headers': {WRITE_HEADER: marker}} if header else {'headers': {'Cookie': f'{WRITE_COOKIE}={marker}'}}
+    with app.test_request_context('/', **sent):
+        g.user_id = user_id
+        return last_write()
+
+
+def test_only_the_writers_signed_marker_counts(app):
+    wrote_at = time.time()
+    marker = make_marker(app.config['SECRET_KEY'], 1, wrote_at)
+
+    assert marker_seen(app, 1, marker) == round(wrote_at, 3)
+    assert marker_seen(app, 1, marker, header=True) == round(wrote_at, 3)
+    assert marker_seen(app, 2, marker) == 0
+    assert marker_seen(app, None, marker) == 0
+    assert marker_seen(app, 1, f'{wrote_at + 3600:.3f}') == 0
+    assert marker_seen(app, 1, f'{wrote_at + 3600:.3f}:{marker.partition(":")[2]}') == 0
+    assert marker_seen(app, 1, make_marker('not-the-secret', 1, wrote_at)) == 0
@@ -0,0 +1,102 @@
+"""
+Sharded writes.
+
+Turns on two SQLite shards for this module and checks that a user's step
+ledger, step_logs and boss_attacks rows land on the shard jump_hash picks for
+them (not the default one, and not the primary), and that the attack.record
+job applies an attack once when it is retried after its shard commit went
+through (see step_ledger.py).
+"""
+import pytest
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from conftest import register_and_login, auth_header
+
+SHARDED = ('step_events', 'step_logs', 'boss_attacks')
+
+
+@pytest.fixture(scope='module')
+def shards(app, tmp_path_factory):
+    from sharding import shard_router
+
+    directory = tmp_path_factory.mktemp('shards')
+    app.config['STEP_SHARD_URLS'] = [f'sqlite:///{directory}/shard{i}.db' for i in range(2)]
+    shard_router.init_app(app)
+    shard_router.create_all()
+    yield shard_router.engines
+    for engine in shard_router.engines:
+        engine.dispose()
+    app.config['STEP_SHARD_URLS'] = []
+    shard_router.init_app(app)
+
+
+def user_on_shard(app, client, shard, name):
+    """(user id, token) of a new user whose rows belong on `shard`"""
+    from models import User
+    from sharding import shard_router
+
+    for i in range(20):
+        token = register_and_login(client, f'{name}{i}')
+        with app.app_context():
+            user_id = User.query.filter_by(username=f'{name}{i}').one().id
+        if shard_router.shard_index(user_id) == shard:
+            return user_id, token
+    raise AssertionError(f'no user hashed to shard {shard}')
+
+
+def rows_of(engine, table, user_id):
+    from models import db
+    table = db.metadata.tables[table]
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).where(table.c.user_id == user_id)).scalar()
+
+
+def global_boss(app):
+    from models import db, Boss
+    with app.app_context():
+        boss = Boss(name='Shard Boss', description='Seeded', max_health=10 ** 6, current_health=10 ** 6,
+                    exp_reward=10, boss_type='Global')
+        db.session.add(boss)
+        db.session.commit()
+        return boss.id
+
+
+def test_writes_go_to_the_users_shard(app, client, engine, shards):
+    from models import db, Boss
+
+    user_id, token = user_on_shard(app, client, 1, 'syncer')
+    boss_id = global_boss(app)
+    headers = auth_header(token)
+    assert client.post('/api/steps/sync', json={'steps_count': 5000}, headers=headers).status_code == 200
+    assert client.post(f'/api/bosses/{boss_id}/attack', json={'steps_to_use': 100},
+                       headers=headers).status_code == 200
+
+    for table in SHARDED:
+        assert rows_of(shards[1], table, user_id) > 0, f'{table} not on the user\'s shard'
+        assert rows_of(shards[0], table, user_id) == 0, f'{table} on the default shard'
+        assert rows_of(engine, table, user_id) == 0, f'{table} on the primary'
+    with app.app_context():
+        assert db.session.get(Boss, boss_id).current_health == 10 ** 6 - 100
+    profile = client.get('/api/user/profile', headers=headers).get_json()
+    assert (profile['today_steps'], profile['total_steps_life']) == (4900, 5000)
+
+
+def test_attack_recorded_once_when_its_primary_commit_is_lost(app, client, engine, shards):
+    from datetime import date, datetime
+    import step_ledger
+
+    user_id, _ = user_on_shard(app, client, 1, 'retrier')
+    boss_id = global_boss(app)
+    job = {
+        'key': 'retried', 'user_id': user_id, 'boss_id': boss_id, 'steps_used': 100, 'damage_dealt': 100,
+        'exp_gained': 0, 'date': date.today().isoformat(), 'attacked_at': datetime.utcnow().isoformat(),
+    }
+    with app.app_context():
+        for _ in range(2):
+            with Session(engine) as session:
+                step_ledger.record_attack(session, job)
+                session.rollback()  # the shard side committed, marking the job done did not
+
+    assert rows_of(shards[1], 'boss_attacks', user_id) == 1
+    assert rows_of(shards[1], 'step_events', user_id) == 1
@@ -0,0 +1,133 @@
+"""
+Step ledger behaviour.
+
+Folds are run by hand here, with another writer slipped in right before the
+fold's compare-and-set on the snapshot, to check that events appended or
+folded concurrently are applied exactly once. The API tests turn eager jobs
+off so the ledger's tail is still unfolded when the next request reads it.
+"""
+from contextlib import contextmanager
+from datetime import date
+
+import pytest
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+import step_ledger
+from jobs import job_queue
+from models import db, User, Boss, StepLog, StepSnapshot
+from conftest import register_and_login, auth_header
+
+
+def new_user(app, client, name, steps):
+    """(user id, token) of a user with `steps` synced and folded today"""
+    token = register_and_login(client, name)
+    client.post('/api/steps/sync', json={'steps_count': steps}, headers=auth_header(token))
+    with app.app_context():
+        return User.query.filter_by(username=name).one().id, token
+
+
+def append(engine, user_id, steps):
+    with Session(engine) as session:
+        step_ledger.record(session, user_id, date.today(), 'sync', steps, lifetime_delta=steps)
+        session.commit()
+
+
+@contextmanager
+def before_snapshot_update(session, run):
+    """Call `run()` once, just before `session` runs the fold's compare-and-set on step_snapshots"""
+    def intercept(state):
+        if state.is_update and state.statement.table.name == 'step_snapshots' and not done:
+            done.append(True)
+            run()
+
+    done = []
+    event.listen(session, 'do_orm_execute', intercept)
+    try:
+        yield
+    finally:
+        event.remove(session, 'do_orm_execute', intercept)
+
+
+def totals(engine, user_id):
+    """(snapshot lifetime, today's step_logs steps, users.total_steps_life)"""
+    with Session(engine) as session:
+        return (
+            session.execute(select(StepSnapshot.lifetime_steps).where(StepSnapshot.user_id == user_id)).scalar(),
+            session.execute(select(StepLog.steps_count).where(StepLog.user_id == user_id,
+                                                              StepLog.date == date.today())).scalar(),
+            session.get(User, user_id).total_steps_life,
+        )
+
+
+def test_events_appended_during_a_fold_are_left_for_the_next(app, client, engine):
+    user_id, _ = new_user(app, client, 'appender', 1000)
+    append(engine, user_id, 200)
+
+    with app.app_context(), Session(engine) as session:
+        with before_snapshot_update(session, lambda: append(engine, user_id, 30)):
+            assert step_ledger.fold(session, session, user_id) == 1
+        session.commit()
+    assert totals(engine, user_id) == (1200, 1200, 1200)
+
+    with app.app_context(), Session(engine) as session:
+        assert step_ledger.fold(session, session, user_id) == 1
+        session.commit()
+    assert totals(engine, user_id) == (1230, 1230, 1230)
+
+
+def test_concurrent_fold_of_the_same_tail_conflicts(app, client, engine):
+    user_id, _ = new_user(app, client, 'racer', 1000)
+    append(engine, user_id, 200)
+
+    def fold_elsewhere():
+        with Session(engine) as other:
+            step_ledger.fold(other, other, user_id)
+            other.commit()
+
+    with app.app_context(), Session(engine) as session:
+        with before_snapshot_update(session, fold_elsewhere):
+            with pytest.raises(step_ledger.SnapshotConflict):
+                step_ledger.fold(session, session, user_id)
+        session.rollback()
+    assert totals(engine, user_id) == (1200, 1200, 1200)
+
+    # The retried job finds nothing left to fold
+    with app.app_context(), Session(engine) as session:
+        assert step_ledger.fold(session, session, user_id) == 0
+        session.commit()
+    assert totals(engine, user_id) == (1200, 1200, 1200)
+
+
+@pytest.fixture
+def lagging_jobs():
+    """Jobs stay pending until run_pending(), like workers that haven't got to them yet"""
+    job_queue.eager = False
+    yield
+    job_queue.eager = True
+
+
+def test_set_mode_sync_after_an_unfolded_attack(app, client, engine, lagging_jobs):
+    user_id, token = new_user(app, client, 'setter', 0)
+    headers = auth_header(token)
+    with app.app_context():
+        boss = Boss(name='Ledger Boss', description='Seeded', max_health=10 ** 6, current_health=10 ** 6,
+                    exp_reward=10, boss_type='Global')
+        db.session.add(boss)
+        db.session.commit()
+        boss_id = boss.id
+
+    client.post('/api/steps/sync', json={'steps_count': 5000}, headers=headers)
+    assert client.post(f'/api/bosses/{boss_id}/attack', json={'steps_to_use': 1000},
+                       headers=headers).status_code == 200
+    # The device reports its own total for the day; the attack's spend is still in the ledger's tail
+    synced = client.post('/api/steps/sync', json={'steps_count': 6000, 'mode': 'set'}, headers=headers).get_json()
+    assert (synced['steps_added'], synced['total_steps_today'], synced['total_steps_life']) == (2000, 6000, 7000)
+
+    with app.app_context():
+        job_queue.run_pending()
+    assert totals(engine, user_id) == (7000, 6000, 7000)
+    profile = client.get('/api/user/profile', headers=headers).get_json()
+    assert (profile['today_steps'], profile['total_steps_life']) == (6000, 7000)
+    with app.app_context(), Session(engine) as session:
+        assert step_ledger.differences(session, session, user_id, date.today()) == []
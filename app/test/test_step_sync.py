@@ -0,0 +1,25 @@
+"""
+Step sync responses and the ledger behind them.
+
+Background jobs run eagerly in testing, so the steps.progress and
+steps.project jobs a sync enqueues have run by the time the next request
+starts, but not when the sync builds its own response.
+"""
+from conftest import register_and_login, auth_header
+
+
+def test_sync_reports_last_known_progress_while_it_is_pending(app, client):
+    headers = auth_header(register_and_login(client, 'walker'))
+    client.post('/api/journeys/1/start', headers=headers)
+
+    first = client.post('/api/steps/sync', json={'steps_count': 25000}, headers=headers).get_json()
+    assert first['progress_pending'] and first['progress_job_id']
+    assert (first['level'], first['current_exp'], first['level_ups']) == (1, 0, 0)
+    assert first['journey_progress']['progress_miles'] == 0
+    assert first['journey_progress']['miles_added'] == 12.5
+
+    second = client.post('/api/steps/sync', json={'steps_count': 0}, headers=headers).get_json()
+    assert not second['progress_pending'] and second['progress_job_id'] is None
+    assert second['current_exp'] == 250
+    assert second['journey_progress']['progress_miles'] == 12.5
+    assert second['journey_progress']['miles_added'] == 0